@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Measures the overhead of injecting a captcha into a (synthetic) ticket page
+with many comments: Genshi Transformer vs. FirstMatchInjector vs. no filter.
+
+    python benchmark_injection.py [number of comments]
+"""
+
+import sys
+import time
+
+from genshi.builder import tag
+from genshi.core import Stream
+from genshi.filters.transform import Transformer
+from genshi.input import HTML
+
+from trac_captcha.injection import FirstMatchInjector
+
+
+def build_ticket_page(nr_comments):
+    comment = '''<div class="change" id="trac-change-%(i)d">
+        <h3 class="change"><span class="threading">comment:%(i)d</span>
+        Changed 2 years ago by <span class="trac-author">user%(i)d</span></h3>
+        <ul class="changes"><li><strong>status</strong> changed to <em>new</em></li></ul>
+        <div class="comment searchable"><p>Comment number %(i)d with <a href="#">a link</a>
+        and <code>some code</code>.</p></div></div>'''
+    comments = [comment % dict(i=i) for i in range(nr_comments)]
+    html = '''<html><head><title>#1 ticket</title></head><body>
+        <div id="ticket"><h2>ticket summary</h2></div>
+        <div id="changelog">%s</div>
+        <form id="propertyform" method="post"><textarea name="comment"></textarea>
+        <div class="buttons"><input type="submit" name="preview" value="Preview"/>
+        <input type="submit" name="submit" value="Submit changes"/></div></form>
+        </body></html>''' % ''.join(comments)
+    return list(HTML(html, encoding='utf-8'))
+
+
+def widget():
+    return tag.div(tag.script(src='https://www.google.com/recaptcha/api.js'),
+                   tag.div(class_='g-recaptcha', **{'data-sitekey': 'site'}))
+
+
+def measure(render, nr_runs):
+    render()
+    start = time.time()
+    for i in range(nr_runs):
+        render()
+    return (time.time() - start) / nr_runs
+
+
+def main(argv=None):
+    argv = argv or sys.argv
+    nr_comments = (len(argv) > 1) and int(argv[1]) or 1000
+    events = build_ticket_page(nr_comments)
+    selector = '//div[@class="buttons"]'
+    transformer = Transformer(selector)
+    injector = FirstMatchInjector(selector)
+    
+    variants = [
+        ('no filter', lambda: Stream(events).render('xhtml')),
+        ('Transformer', lambda: (Stream(events) | transformer.before(widget())).render('xhtml')),
+        ('FirstMatchInjector', lambda: (Stream(events) | injector.before(widget())).render('xhtml')),
+    ]
+    nr_runs = 20
+    print '%d comments, %d events, %d runs' % (nr_comments, len(events), nr_runs)
+    print '%-20s %10s %10s' % ('variant', 'ms/page', 'overhead')
+    baseline = None
+    for name, render in variants:
+        duration = measure(render, nr_runs)
+        if baseline is None:
+            baseline = duration
+        overhead = (duration - baseline) / baseline * 100
+        print '%-20s %10.2f %9.1f%%' % (name, duration * 1000, overhead)
+
+
+if __name__ == '__main__':
+    main()
+
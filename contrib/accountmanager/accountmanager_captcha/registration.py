@@ -23,12 +23,12 @@
 # THE SOFTWARE.
 
 import acct_mgr.web_ui
-from genshi.filters.transform import Transformer
 from trac.core import Component, implements, TracError
 from trac.web.api import ITemplateStreamFilter
 from trac.web.chrome import add_warning
 
 from trac_captcha.controller import TracCaptchaController
+from trac_captcha.injection import injector_for
 
 # AccountManager does not have an interface to veto user registration
 # we could implemented IRequestFilter.pre_process_request, but then we need to
@@ -37,8 +37,12 @@ from trac_captcha.controller import TracCaptchaController
 # session but currently they are only stored in the request data.
 original_user_creation = acct_mgr.web_ui._create_user
 def captcha_protected_user_creation(req, env, check_permissions=True):
-    AccountManagerRegistrationCaptcha(env).validate_registration(req)
-    return original_user_creation(req, env, check_permissions)
+    registration_captcha = AccountManagerRegistrationCaptcha(env)
+    registration_captcha.validate_registration(req)
+    result = original_user_creation(req, env, check_permissions)
+    # the token is only used up if the account was actually created
+    registration_captcha.burn_token(req)
+    return result
 acct_mgr.web_ui._create_user = captcha_protected_user_creation
 
 
@@ -49,7 +53,8 @@ class AccountManagerRegistrationCaptcha(Component):
     # --- Fake interface to validate newly registered users...  ----------------
     
     def validate_registration(self, req):
-        error_message = TracCaptchaController(self.env).check_captcha_solution(req)
+        controller = TracCaptchaController(self.env)
+        error_message = controller.check_captcha_solution(req, 'registration')
         if error_message is None:
             return
         # AccountManager can not retain the password...
@@ -60,12 +65,17 @@ class AccountManagerRegistrationCaptcha(Component):
         add_warning(req, error_message)
         raise error
     
+    def burn_token(self, req):
+        error_message = TracCaptchaController(self.env).burn_pending_token(req)
+        if error_message is not None:
+            self.env.log.warning('Captcha token for registration of %r was used by a concurrent submission' % req.args.get('user'))
+    
     # --- ITemplateStreamFilter ------------------------------------------------
     
     def filter_stream(self, req, method, filename, stream, data):
         if filename != 'register.html':
             return stream
-        transformer = Transformer('//form[@id="acctmgr_registerform"]/input[@type="submit"]')
-        return TracCaptchaController(self.env).inject_captcha_into_stream(req, stream, transformer)
+        injector = injector_for('//form[@id="acctmgr_registerform"]/input[@type="submit"]')
+        return TracCaptchaController(self.env).inject_captcha_into_stream(req, stream, injector, 'registration')
     
 
@@ -22,18 +22,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from genshi.filters.transform import Transformer
 from trac.core import Component, implements
 from trac.web.api import ITemplateStreamFilter
 
 from trac_captcha.controller import TracCaptchaController
+from trac_captcha.injection import injector_for
 
-from tracdiscussion.api import IDiscussionFilter
+from tracdiscussion.api import IDiscussionChangeListener, IDiscussionFilter
 
 
 class TracDiscussionCaptcha(Component):
     
-    implements(ITemplateStreamFilter, IDiscussionFilter)
+    implements(ITemplateStreamFilter, IDiscussionChangeListener, IDiscussionFilter)
     
     # --- IDiscussionFilter ----------------------------------------------------
     
@@ -43,19 +43,54 @@ class TracDiscussionCaptcha(Component):
     def filter_message(self, context, message):
         return self.reject_if_captcha_not_solved(context.req, message)
     
+    # --- IDiscussionChangeListener --------------------------------------------
+    # The token is only used up when the topic/message was actually stored.
+    
+    def topic_created(self, context, topic):
+        self.burn_token(context.req)
+    
+    def message_created(self, context, message):
+        self.burn_token(context.req)
+    
+    def forum_created(self, context, forum):
+        pass
+    
+    def forum_changed(self, context, forum, old_forum):
+        pass
+    
+    def forum_deleted(self, context, forum):
+        pass
+    
+    def topic_changed(self, context, topic, old_topic):
+        pass
+    
+    def topic_deleted(self, context, topic):
+        pass
+    
+    def message_changed(self, context, message, old_message):
+        pass
+    
+    def message_deleted(self, context, message):
+        pass
     
     # --- ITemplateStreamFilter ------------------------------------------------
     
     def filter_stream(self, req, method, filename, stream, data):
         if filename not in ('topic-add.html', 'message-list.html', 'wiki-message-list.html'):
             return stream
-        transformer = Transformer('//div[@class="buttons"]')
-        return TracCaptchaController(self.env).inject_captcha_into_stream(req, stream, transformer)
+        injector = injector_for('//div[@class="buttons"]')
+        return TracCaptchaController(self.env).inject_captcha_into_stream(req, stream, injector, 'discussion')
     
     # --- private API ----------------------------------------------------------
     def reject_if_captcha_not_solved(self, req, submission):
-        error_message = TracCaptchaController(self.env).check_captcha_solution(req)
+        controller = TracCaptchaController(self.env)
+        error_message = controller.check_captcha_solution(req, 'discussion')
         if error_message is None:
             return (True, submission)
         return (False, error_message)
+    
+    def burn_token(self, req):
+        error_message = TracCaptchaController(self.env).burn_pending_token(req)
+        if error_message is not None:
+            self.env.log.warning('Captcha token for %s was used by a concurrent submission' % req.path_info)
 
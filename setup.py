@@ -34,6 +34,7 @@ setuptools.setup(
     # simple_super is not zip_safe
     zip_safe=False,
     packages=setuptools.find_packages(exclude=['tests']),
+    package_data={'trac_captcha': ['htdocs/*.js']},
     classifiers = (
             'Development Status :: 4 - Beta',
             'Framework :: Trac',
@@ -47,7 +48,10 @@ setuptools.setup(
         'trac.plugins': [
             'trac_captcha = trac_captcha',
             'trac_recaptcha = trac_recaptcha',
-        ]
+        ],
+        'console_scripts': [
+            'trac-captcha-sidecar = trac_recaptcha.sidecar:main',
+        ],
     },
     test_suite = 'nose.collector',
     **externally_defined_parameters
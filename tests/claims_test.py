@@ -0,0 +1,86 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.claims import pack_claims, provider_claim, purpose_claim, \
+    quota_claim, scope_claim, scope_matches, scope_realm, score_claim, \
+    token_provider, token_purpose, token_quota, token_score, token_scope, \
+    unpack_claims
+from trac_captcha.cryptobox import Token
+
+
+class ClaimsTest(PythonicTestCase):
+    
+    def test_can_pack_and_unpack_claims(self):
+        claims = {1: 'foo', 7: ''}
+        self.assert_equals(claims, unpack_claims(pack_claims(claims)))
+        self.assert_equals('', pack_claims(None))
+        self.assert_equals({}, unpack_claims(''))
+    
+    def test_rejects_truncated_claims(self):
+        data = pack_claims({1: 'foo'})
+        self.assert_none(unpack_claims(data[:-1]))
+        self.assert_none(unpack_claims(data[:1]))
+    
+    def token_with_claims(self, claims):
+        return Token(3, 0, 42, 1000, claims, '', '')
+    
+    def test_can_extract_quota_from_token(self):
+        token = self.token_with_claims(quota_claim(10, used=3))
+        self.assert_equals((10, 3), token_quota(token))
+    
+    def test_tokens_without_quota_claim_are_unlimited(self):
+        self.assert_none(token_quota(self.token_with_claims({})))
+        self.assert_none(token_quota(self.token_with_claims({1: 'foo'})))
+    
+    def test_can_extract_scope_from_token(self):
+        token = self.token_with_claims(scope_claim(u'ticket:1234'))
+        self.assert_equals(u'ticket:1234', token_scope(token))
+        self.assert_equals('*', token_scope(self.token_with_claims(scope_claim('*'))))
+    
+    def test_wildcard_scope_matches_all_scopes(self):
+        self.assert_true(scope_matches('*', 'ticket:1'))
+        self.assert_true(scope_matches('ticket:1', 'ticket:1'))
+        self.assert_false(scope_matches('ticket:1', 'ticket:2'))
+        self.assert_false(scope_matches('ticket:1', '*'))
+    
+    def test_can_extract_score_from_token(self):
+        self.assert_equals(0.7, token_score(self.token_with_claims(score_claim(0.7))))
+        self.assert_equals(1.0, token_score(self.token_with_claims(score_claim(1.5))))
+        self.assert_none(token_score(self.token_with_claims({})))
+    
+    def test_can_extract_purpose_from_token(self):
+        self.assert_equals('cookie', token_purpose(self.token_with_claims(purpose_claim('cookie'))))
+        self.assert_none(token_purpose(self.token_with_claims({})))
+    
+    def test_can_extract_provider_from_token(self):
+        token = self.token_with_claims(provider_claim('FakeCaptcha'))
+        self.assert_equals('FakeCaptcha', token_provider(token))
+        self.assert_equals('provider', token_purpose(token))
+        self.assert_none(token_provider(self.token_with_claims({})))
+    
+    def test_can_extract_realm_from_scope(self):
+        self.assert_equals('ticket', scope_realm('ticket:1234'))
+        self.assert_equals('registration', scope_realm('registration'))
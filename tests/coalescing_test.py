@@ -0,0 +1,137 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.api import CaptchaFailedError
+from trac_recaptcha.client import reCAPTCHAClient
+from trac_recaptcha.coalescing import SingleFlight, VerificationCoalescer
+
+
+class SingleFlightTest(PythonicTestCase):
+    
+    def test_concurrent_callers_share_one_call(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        proceed = threading.Event()
+        results = []
+        def slow_call():
+            started.set()
+            proceed.wait(5)
+            return 42
+        def follower():
+            results.append(single_flight.do('key', lambda: self.fail('must not be called')))
+        
+        leader = threading.Thread(target=lambda: results.append(single_flight.do('key', slow_call)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=follower) for i in range(3)]
+        for thread in followers:
+            thread.start()
+        while single_flight.coalesced < 3:
+            proceed.wait(0.01)
+        proceed.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        
+        self.assert_equals([42] * 4, results)
+        self.assert_equals(1, single_flight.executed)
+    
+    def test_propagates_exceptions(self):
+        def fail():
+            raise ValueError('foo')
+        self.assert_raises(ValueError, lambda: SingleFlight().do('key', fail))
+
+
+class VerificationCoalescerTest(PythonicTestCase):
+    
+    def setUp(self):
+        self.super()
+        self.now = 1000
+        self.coalescer = VerificationCoalescer(ttl=5, clock=lambda: self.now)
+        self.nr_requests = 0
+    
+    def client(self, server_response='true\n'):
+        def transport(url, data):
+            self.nr_requests += 1
+            if server_response is None:
+                raise IOError('server down')
+            return server_response
+        return reCAPTCHAClient('foo', transport=transport, coalescer=self.coalescer)
+    
+    def verify(self, client):
+        client.verify('127.0.0.1', 'challenge', 'response')
+    
+    def test_caches_verdict_for_duplicate_submissions(self):
+        client = self.client()
+        self.verify(client)
+        self.verify(client)
+        self.assert_equals(1, self.nr_requests)
+        
+        self.now += 6
+        self.verify(client)
+        self.assert_equals(2, self.nr_requests)
+    
+    def test_caches_failed_verifications(self):
+        client = self.client('false\nincorrect-captcha-sol')
+        for i in range(2):
+            e = self.assert_raises(CaptchaFailedError, lambda: self.verify(client))
+            self.assert_equals('incorrect-captcha-sol', e.captcha_data['error_code'])
+        self.assert_equals(1, self.nr_requests)
+    
+    def test_does_not_cache_unreachable_server(self):
+        client = self.client(None)
+        for i in range(2):
+            self.assert_raises(CaptchaFailedError, lambda: self.verify(client))
+        self.assert_equals(2, self.nr_requests)
+    
+    def test_uses_remote_ip_and_solution_as_key(self):
+        client = self.client()
+        self.verify(client)
+        client.verify('127.0.0.2', 'challenge', 'response')
+        client.verify('127.0.0.1', 'challenge', 'other response')
+        self.assert_equals(3, self.nr_requests)
+    
+    def test_reports_unreachable_server_if_identical_verification_takes_too_long(self):
+        self.coalescer = VerificationCoalescer(ttl=5, wait_timeout=0.05, clock=lambda: self.now)
+        started = threading.Event()
+        proceed = threading.Event()
+        def slow_transport(url, data):
+            started.set()
+            proceed.wait(5)
+            return 'true\n'
+        slow_client = reCAPTCHAClient('foo', transport=slow_transport, coalescer=self.coalescer)
+        leader = threading.Thread(target=lambda: self.verify(slow_client))
+        leader.start()
+        try:
+            started.wait(5)
+            e = self.assert_raises(CaptchaFailedError, lambda: self.verify(self.client()))
+            self.assert_equals('recaptcha-not-reachable', e.captcha_data['error_code'])
+        finally:
+            proceed.set()
+            leader.join(5)
+        self.assert_equals(0, self.nr_requests)
+
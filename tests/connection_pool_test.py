@@ -0,0 +1,139 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import socket
+
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.test_util.http_server import LocalHTTPServer
+from trac_recaptcha.client import reCAPTCHAClient
+from trac_recaptcha.connection_pool import DNSCache, HTTPConnectionPool, \
+    PooledTransport, pool_for_url
+
+
+class HTTPConnectionPoolTest(PythonicTestCase):
+    
+    def setUp(self):
+        self.super()
+        self.now = 1000
+        self.server = LocalHTTPServer().start()
+        self.pool = self.build_pool()
+    
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+        self.super()
+    
+    def build_pool(self, **kwargs):
+        kwargs.setdefault('clock', lambda: self.now)
+        return HTTPConnectionPool('http', '127.0.0.1', self.server.server_address[1], **kwargs)
+    
+    def post(self, data='foo'):
+        return PooledTransport(self.pool)(self.server.url('/verify'), data)
+    
+    def test_reuses_connections(self):
+        for i in range(3):
+            self.assert_equals('true\n', self.post())
+        self.assert_equals(1, self.server.nr_connections)
+        self.assert_equals(dict(created=1, reused=2, idle=1, maxsize=4), self.pool.stats())
+        self.assert_equals(('/verify', 'foo'), self.server.requests[-1])
+    
+    def test_discards_idle_connections_after_timeout(self):
+        self.post()
+        self.now += 61
+        self.post()
+        self.assert_equals(2, self.pool.stats()['created'])
+    
+    def test_keeps_at_most_maxsize_idle_connections(self):
+        self.pool = self.build_pool(maxsize=1)
+        connections = [self.pool.new_connection() for i in range(2)]
+        for connection in connections:
+            self.pool.release(connection)
+        self.assert_equals(1, self.pool.stats()['idle'])
+    
+    def test_retries_if_server_closed_idle_connection(self):
+        self.post()
+        connection, last_used = self.pool._idle[0]
+        connection.sock.shutdown(socket.SHUT_RDWR)
+        self.assert_equals('true\n', self.post())
+        self.assert_equals(2, self.pool.stats()['created'])
+    
+    def test_discards_idle_connections_closed_by_server(self):
+        self.post()
+        self.server.close_connections()
+        self.assert_equals('true\n', self.post())
+        self.assert_equals(dict(created=2, reused=0, idle=1, maxsize=4), self.pool.stats())
+    
+    def test_does_not_resend_request_if_connection_broke_after_sending(self):
+        self.post()
+        def drop_connection(path, body):
+            raise socket.error('connection dropped')
+        self.server.responder = drop_connection
+        self.assert_raises(IOError, self.post)
+        self.assert_equals(2, len(self.server.requests))
+    
+    def test_can_prewarm_connections(self):
+        self.pool.prewarm(2)
+        self.post()
+        self.assert_equals(dict(created=2, reused=1, idle=2, maxsize=4), self.pool.stats())
+    
+    def test_raises_ioerror_on_http_errors(self):
+        self.server.responder = lambda path, body: (500, 'error')
+        self.assert_raises(IOError, self.post)
+    
+    def test_can_be_used_as_recaptcha_transport(self):
+        client = reCAPTCHAClient('foo', transport=PooledTransport(self.pool))
+        client.verify_server = lambda: self.server.url('/verify')
+        client.verify('127.0.0.1', 'challenge', 'response')
+        self.assert_contains('privatekey=foo', self.server.requests[0][1])
+    
+    def test_returns_same_pool_for_same_host(self):
+        pool = pool_for_url('http://www.example.com/verify')
+        self.assert_equals(pool, pool_for_url('http://www.example.com/foo'))
+        self.assert_not_equals(pool, pool_for_url('http://www.example.com/', maxsize=2))
+
+
+class DNSCacheTest(PythonicTestCase):
+    
+    def setUp(self):
+        self.super()
+        self.now = 1000
+        self.lookups = []
+        self.cache = DNSCache(ttl=300, resolver=self.resolve, clock=lambda: self.now)
+    
+    def resolve(self, host, port, family, socktype):
+        self.lookups.append(host)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+    
+    def test_caches_addresses(self):
+        self.cache.resolve('foo.example', 80)
+        self.cache.resolve('foo.example', 80)
+        self.assert_equals(['foo.example'], self.lookups)
+    
+    def test_resolves_again_after_ttl(self):
+        self.cache.resolve('foo.example', 80)
+        self.now += 301
+        self.cache.resolve('foo.example', 80)
+        self.assert_equals(2, len(self.lookups))
+
@@ -22,9 +22,28 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from trac_captcha.test_util import CaptchaTest
-from trac_captcha.controller import TracCaptchaController
+from Cookie import SimpleCookie
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from genshi.builder import tag
+from genshi.input import HTML
+from trac.core import Component, implements
+
+from trac_captcha.api import CaptchaFailedError, ICaptcha
+from trac_captcha.claims import purpose_claim, quota_claim, scope_claim, \
+    score_claim, token_provider
+from trac_captcha.speculative import SpeculativeCaptchaVerification
+from trac_captcha.test_util import CaptchaTest, FakeCaptcha
+from trac_captcha.controller import CAPTCHA_COOKIE_NAME, initialize_captcha_data, \
+    PROVIDER_FIELD, TracCaptchaController
 from trac_captcha.cryptobox import CryptoBox
+from trac_captcha.deferred import LOADER_SCRIPT
+from trac_captcha.injection import injector_for
+from trac_captcha.token_key_store import load_token_key, provision_token_key
 
 
 class TracCaptchaControllerTest(CaptchaTest):
@@ -33,6 +52,14 @@ class TracCaptchaControllerTest(CaptchaTest):
         self.super()
         self.controller = TracCaptchaController(self.env)
         self.assert_false(self.has_permission('anonymous', 'CAPTCHA_SKIP'))
+        self.temp_directories = []
+    
+    def tearDown(self):
+        if self.temp_directories:
+            self.controller.replay_store().close()
+        for directory in self.temp_directories:
+            shutil.rmtree(directory)
+        self.super()
     
     def captcha_token(self):
         return CryptoBox(self.controller.token_key()).generate_token()
@@ -47,8 +74,13 @@ class TracCaptchaControllerTest(CaptchaTest):
         self.assert_equals('', self.env.config.get('trac-captcha', 'token_key'))
         self.assert_not_none(self.controller.token_key())
         
-        stored_token = self.env.config.get('trac-captcha', 'token_key')
-        self.assert_equals(self.controller.token_key(), stored_token)
+        self.assert_equals(self.controller.token_key(), load_token_key(self.env))
+        # trac.ini must not be written while serving requests
+        self.assert_equals('', self.env.config.get('trac-captcha', 'token_key'))
+    
+    def test_all_processes_use_the_same_generated_token_key(self):
+        token_key = self.controller.token_key()
+        self.assert_equals(token_key, provision_token_key(self.env, 'other key'))
     
     def test_returns_token_key_if_stored_in_config(self):
         self.env.config.set('trac-captcha', 'token_key', 'foobar')
@@ -69,3 +101,406 @@ class TracCaptchaControllerTest(CaptchaTest):
         self.assert_false(self.controller.should_skip_captcha(req))
 
 
+    
+    def test_remembers_verified_tokens(self):
+        token = self.captcha_token()
+        self.assert_true(self.controller.is_token_valid(token))
+        self.assert_true(self.controller.is_token_valid(token))
+        
+        stats = self.controller.token_cache_stats()
+        self.assert_equals(1, stats['hits'])
+        self.assert_equals(1, stats['size'])
+    
+    def test_does_not_remember_invalid_tokens(self):
+        self.assert_false(self.controller.is_token_valid('foobar'))
+        self.assert_equals(0, self.controller.token_cache_stats()['size'])
+
+    
+    def test_warns_only_once_about_unavailable_mac_algorithm(self):
+        self.env.config.set('trac-captcha', 'mac_algorithm', 'invalid')
+        warnings = []
+        self.env.log.warning = lambda message, *args: warnings.append(message)
+        try:
+            self.assert_true(self.controller.is_token_valid(self.captcha_token()))
+            self.assert_true(self.controller.is_token_valid(self.captcha_token()))
+        finally:
+            del self.env.log.warning
+        self.assert_equals(1, len(warnings))
+    
+    def test_tokens_remain_valid_after_key_rotation(self):
+        token = self.captcha_token()
+        old_key = self.controller.token_key()
+        self.controller.rotate_token_key()
+        
+        self.assert_not_equals(old_key, self.controller.token_key())
+        self.assert_true(self.controller.is_token_valid(token))
+    
+    def test_tokens_are_invalid_after_grace_period(self):
+        token = self.captcha_token()
+        self.controller.rotate_token_key(grace_period=-1)
+        self.assert_false(self.controller.is_token_valid(token))
+
+    
+    # --- cross-form cookie ----------------------------------------------------
+    
+    def request_with_cookie(self, cookie_value):
+        req = self.request('/')
+        req.incookie = SimpleCookie()
+        req.incookie[CAPTCHA_COOKIE_NAME] = cookie_value
+        return req
+    
+    def cookie_token(self, claims=None):
+        cookie_claims = purpose_claim('cookie')
+        cookie_claims.update(claims or {})
+        return self.controller.key_ring().generate_token(claims=cookie_claims)
+    
+    def test_skip_captcha_if_valid_cookie_found(self):
+        self.env.config.set('trac-captcha', 'cookie_ttl', '3600')
+        req = self.request_with_cookie(self.cookie_token())
+        self.assert_true(self.controller.should_skip_captcha(req))
+    
+    def test_ignore_cookie_if_disabled(self):
+        req = self.request_with_cookie(self.cookie_token())
+        self.assert_false(self.controller.should_skip_captcha(req))
+    
+    def test_ignore_invalid_cookies(self):
+        self.env.config.set('trac-captcha', 'cookie_ttl', '3600')
+        req = self.request_with_cookie('foobar')
+        self.assert_false(self.controller.should_skip_captcha(req))
+    
+    def test_rejects_form_token_in_cookie(self):
+        self.env.config.set('trac-captcha', 'cookie_ttl', '3600')
+        req = self.request('/')
+        self.controller.add_token_for_request(req)
+        form_token = req.captcha_data['token']
+        self.assert_false(self.controller.should_skip_captcha(self.request_with_cookie(form_token)))
+        self.assert_false(self.controller.should_skip_captcha(self.request_with_cookie(self.captcha_token())))
+    
+    def test_rejects_cookie_token_in_form(self):
+        self.env.config.set('trac-captcha', 'cookie_ttl', '3600')
+        req = self.request('/')
+        self.controller.set_captcha_cookie(req)
+        cookie_token = req.outcookie[CAPTCHA_COOKIE_NAME].value
+        self.assert_true(self.controller.should_skip_captcha(self.request_with_cookie(cookie_token)))
+        self.assert_false(self.controller.should_skip_captcha(self.request('/', __captcha_token=cookie_token)))
+    
+    # --- single use tokens ----------------------------------------------------
+    
+    def use_temporary_replay_store(self):
+        directory = tempfile.mkdtemp()
+        self.temp_directories.append(directory)
+        self.env.config.set('trac-captcha', 'replay_store_file', 
+                            os.path.join(directory, 'replay.bloom'))
+    
+    def enable_single_use_tokens(self):
+        self.use_temporary_replay_store()
+        self.env.config.set('trac-captcha', 'single_use_tokens', 'true')
+    
+    def test_only_one_concurrent_submission_can_use_a_token(self):
+        self.enable_single_use_tokens()
+        token = self.captcha_token()
+        first_req = self.request('/', __captcha_token=token)
+        second_req = self.request('/', __captcha_token=token)
+        self.assert_none(self.controller.check_captcha_solution(first_req))
+        self.assert_none(self.controller.check_captcha_solution(second_req))
+        
+        self.assert_none(self.controller.burn_pending_token(first_req))
+        self.assert_not_none(self.controller.burn_pending_token(second_req))
+        self.assert_false(self.controller.is_token_valid(token))
+    
+    def test_pending_token_belongs_to_its_request(self):
+        self.enable_single_use_tokens()
+        token = self.captcha_token()
+        self.assert_true(self.controller.should_skip_captcha(self.request('/', __captcha_token=token)))
+        
+        self.assert_none(self.controller.burn_pending_token(self.request('/')))
+        self.assert_true(self.controller.is_token_valid(token))
+    
+    # --- submission budget ----------------------------------------------------
+    
+    def test_rejects_tokens_with_exhausted_submission_budget(self):
+        self.use_temporary_replay_store()
+        key_ring = self.controller.key_ring()
+        self.assert_true(self.controller.is_token_valid(key_ring.generate_token(claims=quota_claim(2, 1))))
+        self.assert_false(self.controller.is_token_valid(key_ring.generate_token(claims=quota_claim(2, 2))))
+    
+    def test_reissues_form_token_after_submission(self):
+        self.use_temporary_replay_store()
+        self.env.config.set('trac-captcha', 'token_submission_budget', '2')
+        req = self.request('/')
+        self.controller.add_token_for_request(req)
+        token = req.captcha_data['token']
+        
+        req = self.request('/', __captcha_token=token)
+        self.assert_true(self.controller.should_skip_captcha(req))
+        self.controller.burn_pending_token(req)
+        new_token = req.captcha_data['token']
+        self.assert_not_equals(token, new_token)
+        self.assert_equals(self.controller.token_expiration(token),
+                           self.controller.token_expiration(new_token))
+        
+        req = self.request('/', __captcha_token=new_token)
+        self.assert_true(self.controller.should_skip_captcha(req))
+        self.controller.burn_pending_token(req)
+        self.assert_false('token' in req.captcha_data)
+    
+    def test_superseded_budget_tokens_can_not_be_reused(self):
+        self.use_temporary_replay_store()
+        self.env.config.set('trac-captcha', 'token_submission_budget', '2')
+        self.assert_false(self.controller.single_use_tokens)
+        req = self.request('/')
+        self.controller.add_token_for_request(req)
+        token = req.captcha_data['token']
+        
+        req = self.request('/', __captcha_token=token)
+        self.assert_true(self.controller.should_skip_captcha(req))
+        self.assert_none(self.controller.burn_pending_token(req))
+        self.assert_false(self.controller.should_skip_captcha(self.request('/', __captcha_token=token)))
+    
+    def test_reissues_cookie_token_after_submission(self):
+        self.use_temporary_replay_store()
+        self.env.config.set('trac-captcha', 'cookie_ttl', '3600')
+        cookie_token = self.cookie_token(claims=quota_claim(1))
+        req = self.request_with_cookie(cookie_token)
+        req.outcookie = SimpleCookie()
+        self.assert_true(self.controller.should_skip_captcha(req))
+        self.controller.burn_pending_token(req)
+        
+        exhausted_token = req.outcookie[CAPTCHA_COOKIE_NAME].value
+        self.assert_false(self.controller.should_skip_captcha(self.request_with_cookie(exhausted_token)))
+    
+    # --- token scope and lifetime ---------------------------------------------
+    
+    def test_tokens_are_only_valid_for_their_scope(self):
+        req = self.request('/')
+        self.controller.add_token_for_request(req, scope='ticket:1')
+        token = req.captcha_data['token']
+        
+        self.assert_true(self.controller.is_token_valid(token, 'ticket:1'))
+        self.assert_false(self.controller.is_token_valid(token, 'ticket:2'))
+        self.assert_false(self.controller.is_token_valid(token, 'registration'))
+    
+    def test_unscoped_tokens_are_valid_everywhere(self):
+        self.assert_true(self.controller.is_token_valid(self.captcha_token(), 'ticket:1'))
+    
+    def test_score_tokens_can_not_be_used_to_skip_captchas(self):
+        token = self.controller.key_ring().generate_token(claims=score_claim(0.9))
+        self.assert_false(self.controller.is_token_valid(token))
+    
+    def test_can_configure_token_lifetime_per_realm(self):
+        self.env.config.set('trac-captcha', 'token_ttl', '600')
+        self.env.config.set('trac-captcha', 'token_ttl.ticket', '86400')
+        self.assert_equals(86400, self.controller.token_ttl_for('ticket:1'))
+        self.assert_equals(600, self.controller.token_ttl_for('registration'))
+        self.assert_equals(600, self.controller.token_ttl_for('*'))
+        self.assert_equals(86400, self.controller.max_token_ttl())
+    
+    def test_caches_longest_token_lifetime(self):
+        self.env.config.set('trac-captcha', 'token_ttl', '600')
+        scanned_sections = []
+        def options(section, compmgr=None):
+            scanned_sections.append(section)
+            return []
+        self.env.config.options = options
+        try:
+            self.assert_equals(600, self.controller.max_token_ttl())
+            self.assert_equals(600, self.controller.max_token_ttl())
+            self.assert_equals(1, len(scanned_sections))
+            
+            self.env.config.set('trac-captcha', 'cookie_ttl', '3600')
+            self.assert_equals(3600, self.controller.max_token_ttl())
+            self.assert_equals(2, len(scanned_sections))
+        finally:
+            del self.env.config.options
+    
+    def test_renews_tokens_after_half_of_their_lifetime(self):
+        self.env.config.set('trac-captcha', 'token_ttl.ticket', '86400')
+        token = self.controller.key_ring().generate_token(ttl=600, claims=scope_claim('ticket:1'))
+        req = self.request('/', __captcha_token=token)
+        self.assert_true(self.controller.should_skip_captcha(req, 'ticket:1'))
+        self.controller.burn_pending_token(req)
+        
+        new_token = req.captcha_data['token']
+        self.assert_true(self.controller.is_token_valid(new_token, 'ticket:1'))
+        self.assert_false(self.controller.is_token_valid(new_token, 'ticket:2'))
+        self.assert_true(self.controller.token_expiration(new_token) > time.time() + 80000)
+    
+    # --- speculative verification ---------------------------------------------
+    
+    def post_captcha_solution(self, solution):
+        self.enable_captcha(FakeCaptcha)
+        self.env.config.set('trac-captcha', 'speculative_verification', 'true')
+        req = self.request('/', fake_captcha=solution)
+        req.environ['REQUEST_METHOD'] = 'POST'
+        SpeculativeCaptchaVerification(self.env).pre_process_request(req, None)
+        self.assert_true('verification' in req.captcha_data)
+        return req
+    
+    def test_uses_result_of_speculative_verification(self):
+        req = self.post_captcha_solution('open sesame')
+        self.assert_none(self.controller.check_captcha_solution(req))
+        self.assert_false('verification' in req.captcha_data)
+    
+    def test_rejects_wrong_solution_after_speculative_verification(self):
+        req = self.post_captcha_solution('wrong')
+        self.assert_not_none(self.controller.check_captcha_solution(req))
+    
+    def test_applies_cookies_of_speculative_verification_in_request_thread(self):
+        self.enable_captcha(CookieCaptcha)
+        self.env.config.set('trac-captcha', 'speculative_verification', 'true')
+        req = self.post_request('/', cookie_captcha='solved')
+        SpeculativeCaptchaVerification(self.env).pre_process_request(req, None)
+        req.captcha_data['verification'].result(timeout=5)
+        self.assert_false('verified' in req.outcookie)
+        
+        self.assert_none(self.controller.check_captcha_solution(req))
+        self.assert_equals('yes', req.outcookie['verified'].value)
+        self.assert_equals('/trac', req.outcookie['verified']['path'])
+    
+    def test_shuts_down_old_executor_when_number_of_workers_changes(self):
+        old_executor = self.controller.executor()
+        self.env.config.set('trac-captcha', 'speculative_workers', '2')
+        executor = self.controller.executor()
+        
+        self.assert_equals(2, executor.max_workers)
+        self.assert_true(old_executor.is_shut_down)
+        self.assert_equals(executor, self.controller.executor())
+    
+    # --- stream injection -----------------------------------------------------
+    
+    def inject_captcha(self, html):
+        self.enable_captcha(FakeCaptcha)
+        generated = []
+        real_captcha_html = self.controller.captcha_html
+        def captcha_html(req):
+            generated.append(req)
+            return real_captcha_html(req)
+        self.controller.captcha_html = captcha_html
+        stream = HTML(html, encoding='utf-8')
+        injector = injector_for('//div[@class="buttons"]')
+        req = self.request('/')
+        req.chrome = dict()
+        html = self.controller.inject_captcha_into_stream(req, stream, injector).render()
+        self.scripts = [script['href'] for script in req.chrome.get('scripts', [])]
+        return html, len(generated)
+    
+    def test_generates_captcha_only_if_selector_matches(self):
+        self.assert_equals(('<p>read only</p>', 0), self.inject_captcha('<p>read only</p>'))
+    
+    def test_inserts_captcha_only_once(self):
+        html, nr_generated = self.inject_captcha('<div class="buttons"/><div class="buttons"/>')
+        self.assert_equals(1, nr_generated)
+        self.assert_equals(1, html.count('fake captcha'))
+        self.assert_equals([], self.scripts)
+    
+    def test_serves_loader_script_as_static_file(self):
+        prefix, htdocs_dir = self.controller.get_htdocs_dirs()[0]
+        self.assert_equals('trac_captcha/deferred.js', LOADER_SCRIPT)
+        script_path = os.path.join(htdocs_dir, LOADER_SCRIPT[len(prefix)+1:])
+        self.assert_contains('window.TracCaptchaDeferred', file(script_path).read())
+    
+    def test_can_defer_loading_of_captcha(self):
+        self.env.config.set('trac-captcha', 'deferred_loading', 'True')
+        html, nr_generated = self.inject_captcha('<div class="buttons"/>')
+        self.assert_equals(1, nr_generated)
+        self.assert_contains('id="trac-captcha-1"', html)
+        self.assert_contains('class="trac-captcha-deferred"', html)
+        self.assert_contains(".push(['watch', 'trac-captcha-1', '", html)
+        self.assert_contains("['https://www.google.com', 'https://www.gstatic.com'], false]);", html)
+        # the loader is a static script which browsers can cache
+        self.assert_equals(['/trac/chrome/trac_captcha/deferred.js'], self.scripts)
+        # the widget is only inserted by the loader script
+        self.assert_contains('\\x3cdiv>fake captcha: \\x3c/div>', html)
+        self.assert_false('<div>fake captcha' in html)
+    
+    # --- provider failover ----------------------------------------------------
+    
+    def use_captcha_chain(self):
+        self.enable_component(FakeCaptcha)
+        self.enable_component(UnavailableCaptcha)
+        self.env.config.set('trac-captcha', 'captchas', 'UnavailableCaptcha, FakeCaptcha')
+        self.env.config.set('trac-captcha', 'failover_min_samples', '2')
+    
+    def provider_field(self, captcha_class):
+        provider_token = self.controller.provider_token(captcha_class(self.env))
+        return {PROVIDER_FIELD: provider_token}
+    
+    def displayed_provider(self, **args):
+        req = self.request('/', **args)
+        initialize_captcha_data(req)
+        html = unicode(self.controller.captcha_html(req))
+        provider_token = re.search('name="%s" value="([^"]+)"' % PROVIDER_FIELD, html).group(1)
+        return token_provider(self.controller.verified_token(provider_token))
+    
+    def test_displays_first_captcha_of_chain(self):
+        self.use_captcha_chain()
+        self.assert_equals('UnavailableCaptcha', self.displayed_provider())
+    
+    def test_skips_captchas_with_high_error_rate(self):
+        self.use_captcha_chain()
+        for i in range(2):
+            req = self.request('/', **self.provider_field(UnavailableCaptcha))
+            self.assert_not_none(self.controller.check_captcha_solution(req))
+        
+        self.assert_equals(1.0, self.controller.provider_health_stats()['UnavailableCaptcha']['error_rate'])
+        self.assert_equals('FakeCaptcha', self.displayed_provider())
+        self.assert_equals('FakeCaptcha', 
+            self.displayed_provider(**self.provider_field(UnavailableCaptcha)))
+    
+    def test_displays_skipped_captcha_again_after_health_max_age(self):
+        self.use_captcha_chain()
+        for i in range(2):
+            req = self.request('/', **self.provider_field(UnavailableCaptcha))
+            self.controller.check_captcha_solution(req)
+        self.assert_equals('FakeCaptcha', self.displayed_provider())
+        
+        health = self.controller.provider_health(UnavailableCaptcha(self.env))
+        health.clock = lambda: time.time() + self.controller.health_max_age + 1
+        self.assert_equals('UnavailableCaptcha', self.displayed_provider())
+    
+    def test_ignores_unsigned_provider_field(self):
+        self.use_captcha_chain()
+        for i in range(2):
+            req = self.request('/', **self.provider_field(UnavailableCaptcha))
+            self.controller.check_captcha_solution(req)
+        
+        req = self.request('/', fake_captcha='wrong', **{PROVIDER_FIELD: 'FakeCaptcha'})
+        self.assert_none(self.controller.submitted_captcha(req))
+        self.assert_equals('FakeCaptcha', self.controller.captcha_for_request(req).__class__.__name__)
+        # provider tokens can not be used to skip the captcha
+        self.assert_false(self.controller.is_token_valid(self.provider_field(FakeCaptcha)[PROVIDER_FIELD]))
+    
+    def test_verifies_submission_with_displayed_captcha(self):
+        self.use_captcha_chain()
+        req = self.request('/', fake_captcha='open sesame', **self.provider_field(FakeCaptcha))
+        self.assert_none(self.controller.check_captcha_solution(req))
+        # wrong solutions do not count as errors
+        req = self.request('/', fake_captcha='wrong', **self.provider_field(FakeCaptcha))
+        self.assert_not_none(self.controller.check_captcha_solution(req))
+        stats = self.controller.provider_health_stats()['FakeCaptcha']
+        self.assert_equals(2, stats['samples'])
+        self.assert_equals(0.0, stats['error_rate'])
+
+
+class UnavailableCaptcha(Component):
+    implements(ICaptcha)
+    
+    def genshi_stream(self, req):
+        return tag.div('unavailable captcha').generate()
+    
+    def assert_captcha_completed(self, req):
+        raise CaptchaFailedError('not reachable', dict(error_code='recaptcha-not-reachable'))
+
+
+class CookieCaptcha(Component):
+    implements(ICaptcha)
+    
+    def genshi_stream(self, req):
+        return tag.div('cookie captcha').generate()
+    
+    def has_solution(self, req):
+        return 'cookie_captcha' in req.args
+    
+    def assert_captcha_completed(self, req):
+        TracCaptchaController(self.env).set_cookie(req, 'verified', 'yes', 60)
+
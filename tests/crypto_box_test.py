@@ -22,12 +22,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import base64
 from datetime import datetime, timedelta
+import struct
+import time
 
 from trac.util.datefmt import localtz
 from trac_dev_platform.test.lib.pythonic_testcase import *
 
-from trac_captcha.cryptobox import CryptoBox
+from trac_captcha.cryptobox import CryptoBox, TokenVerifier
+from trac_captcha.mac import available_mac_engines, HMACEngine
 
 
 class CryptBoxTest(PythonicTestCase):
@@ -68,5 +72,83 @@ class CryptBoxTest(PythonicTestCase):
     
     def test_can_generate_valid_tokens(self):
         self.assert_true(self.box.is_token_valid(self.box.generate_token()))
+    
+    # --- binary tokens (version 2) --------------------------------------------
+    
+    def test_generates_compact_tokens(self):
+        token = self.box.generate_token()
+        self.assert_equals(35, len(token))
+        self.assert_false('=' in token)
+        self.assert_true(len(self.token()) >= 4 * len(token))
+    
+    def test_knows_expiration_time_of_tokens(self):
+        before = int(time.time())
+        valid_until = self.box.token_expiration(self.box.generate_token(ttl=60))
+        self.assert_true(before + 60 <= valid_until <= int(time.time()) + 60)
+    
+    def test_can_detect_expired_binary_tokens(self):
+        self.assert_invalid(self.box.generate_token(ttl=-1))
+    
+    def test_can_detect_tampered_binary_tokens(self):
+        token = self.box.generate_token()
+        data = base64.urlsafe_b64decode(token + '=')
+        version, algorithm, key_id, expires = struct.unpack('>BBII', data[:10])
+        tampered_header = struct.pack('>BBII', version, algorithm, key_id, expires + 3600)
+        self.assert_invalid(base64.urlsafe_b64encode(tampered_header + data[10:]))
+    
+    def test_rejects_tokens_signed_with_different_key(self):
+        self.assert_invalid(CryptoBox('baz').generate_token())
+    
+    def test_accepts_unicode_tokens(self):
+        self.assert_true(self.box.is_token_valid(unicode(self.box.generate_token())))
+    
+    def test_accepts_version_2_tokens(self):
+        body = struct.pack('>BII', 2, self.box.key_id(), int(time.time()) + 60)
+        token = base64.urlsafe_b64encode(body + self.box.mac(body, HMACEngine.algorithm_id))
+        self.assert_true(self.box.is_token_valid(token))
+    
+    def test_accepts_tokens_signed_with_all_available_algorithms(self):
+        for engine in available_mac_engines():
+            box = CryptoBox('foobar', mac_engine=engine)
+            self.assert_true(self.box.is_token_valid(box.generate_token()))
+    
+    def test_rejects_tokens_with_unknown_algorithm(self):
+        data = base64.urlsafe_b64decode(self.box.generate_token() + '=')
+        self.assert_invalid(base64.urlsafe_b64encode(data[:1] + '\xff' + data[2:]))
+    
+    def test_can_sign_additional_claims(self):
+        token = self.box.generate_token(claims={1: 'foo'}, expires=int(time.time()) + 60)
+        verified_token = self.box.verify(token)
+        self.assert_equals({1: 'foo'}, verified_token.claims)
+        
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        tampered_data = data.replace('foo', 'bar')
+        self.assert_invalid(base64.urlsafe_b64encode(tampered_data))
+    
+    def test_can_verify_legacy_tokens(self):
+        verified_token = self.box.verify(self.token())
+        self.assert_equals(1, verified_token.version)
+        self.assert_equals({}, verified_token.claims)
+    
+    def test_can_reject_legacy_tokens(self):
+        box = CryptoBox('foobar', accept_legacy_tokens=False)
+        self.assert_false(box.is_token_valid(self.token()))
+        self.assert_true(box.is_token_valid(box.generate_token()))
+
 
 
+
+class TokenVerifierTest(PythonicTestCase):
+    
+    def test_signs_messages_like_cryptobox(self):
+        verifier = TokenVerifier('foobar')
+        box = CryptoBox('foobar')
+        self.assert_equals(box.sign_message('foo'), verifier.sign_message('foo'))
+        # the pre-keyed HMAC state must not be modified by signing
+        self.assert_equals(box.sign_message('bar'), verifier.sign_message('bar'))
+    
+    def test_accepts_tokens_generated_by_cryptobox(self):
+        verifier = TokenVerifier('foobar')
+        self.assert_true(verifier.is_token_valid(CryptoBox('foobar').generate_token()))
+        self.assert_false(verifier.is_token_valid(CryptoBox('baz').generate_token()))
+
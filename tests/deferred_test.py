@@ -0,0 +1,69 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from genshi.builder import tag
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.deferred import deferred_captcha_tag, included_captcha_tag, \
+    js_literal, render_events
+
+
+class DeferredCaptchaTest(PythonicTestCase):
+    
+    def render(self, widget, **kwargs):
+        return render_events(deferred_captcha_tag(widget, 'trac-captcha-1', **kwargs))
+    
+    def test_escapes_strings_for_inline_scripts(self):
+        self.assert_equals(u"'\\x3c/script>\\n\\'\\\\'", js_literal(u"</script>\n'\\"))
+        self.assert_equals(u"'\\u2028'", js_literal(u'\u2028'))
+    
+    def test_inserts_only_placeholder_and_loader(self):
+        html = self.render(tag.script(src='//example.com/captcha.js'))
+        self.assert_contains('<div ', html)
+        self.assert_contains('id="trac-captcha-1"', html)
+        self.assert_false('<script src=' in html)
+        watch_call = ".push(['watch', 'trac-captcha-1', " + \
+            "'\\x3cscript src=\"//example.com/captcha.js\">\\x3c/script>', [], false]);"
+        self.assert_contains(watch_call, html)
+    
+    def test_page_contains_only_widget_configuration(self):
+        html = self.render('captcha')
+        self.assert_false('function' in html)
+        self.assert_contains('window.TracCaptchaDeferredQueue', html)
+        self.assert_true(len(html) < 300)
+    
+    def test_can_add_resource_hints_and_load_immediately(self):
+        html = self.render('captcha', preconnect=['https://example.com'], immediate=True)
+        self.assert_contains("'captcha', ['https://example.com'], true]);", html)
+    
+    def test_accepts_streams(self):
+        html = self.render(tag.p('captcha').generate())
+        self.assert_contains("'\\x3cp>captcha\\x3c/p>'", html)
+    
+    def test_can_fetch_widget_from_url(self):
+        include_tag = included_captcha_tag('/trac/captcha/widget', 'trac-captcha-2')
+        html = render_events(include_tag)
+        self.assert_contains('id="trac-captcha-2"', html)
+        self.assert_contains(".push(['include', 'trac-captcha-2', '/trac/captcha/widget', [], false]);", html)
+
@@ -0,0 +1,157 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.test_util.http_server import LocalHTTPServer
+from trac_recaptcha.client import reCAPTCHAClient
+from trac_recaptcha.event_loop import AsyncTransport, EventLoopEngine
+from trac_recaptcha.resilience import Deadline, DeadlineExceeded
+
+
+class EventLoopEngineTest(PythonicTestCase):
+    
+    def setUp(self):
+        self.super()
+        self.delay = 0
+        self.server = LocalHTTPServer(self.respond).start()
+        self.engine = EventLoopEngine()
+    
+    def tearDown(self):
+        self.server.stop()
+        self.super()
+    
+    def respond(self, path, body):
+        time.sleep(self.delay)
+        return (200, 'true\n%s' % body)
+    
+    def test_can_send_request(self):
+        future = self.engine.submit(self.server.url('/verify'), 'foo=bar')
+        self.assert_equals((200, 'true\nfoo=bar'), future.result(timeout=5))
+        self.assert_equals(('/verify', 'foo=bar'), self.server.requests[-1])
+        self.assert_equals(dict(in_flight=0, completed=1, failed=0), self.engine.stats())
+    
+    def test_multiplexes_requests_in_single_thread(self):
+        self.delay = 0.3
+        futures = [self.engine.submit(self.server.url(), str(i)) for i in range(10)]
+        start = time.time()
+        results = [future.result(timeout=5) for future in futures]
+        
+        self.assert_equals([(200, 'true\n%d' % i) for i in range(10)], results)
+        # requests were sent concurrently
+        self.assert_true(time.time() - start < 2)
+        self.assert_equals(10, self.server.nr_connections)
+    
+    def test_fails_requests_after_deadline(self):
+        self.delay = 1
+        future = self.engine.submit(self.server.url(), 'foo', expires=time.time() + 0.1)
+        self.assert_raises(DeadlineExceeded, lambda: future.result(timeout=5))
+        self.assert_equals(dict(in_flight=0, completed=0, failed=1), self.engine.stats())
+    
+    def test_reports_connection_errors(self):
+        self.server.stop()
+        future = self.engine.submit(self.server.url(), 'foo', expires=time.time() + 5)
+        self.assert_raises(IOError, lambda: future.result(timeout=5))
+    
+    def test_reports_unresolvable_hosts(self):
+        def resolver(*args):
+            raise socket.gaierror('unknown host')
+        self.engine.dns_cache.resolver = resolver
+        future = self.engine.submit('http://invalid.example/', 'foo')
+        self.assert_true(future.done())
+        self.assert_raises(IOError, lambda: future.result())
+
+
+class AsyncTransportTest(PythonicTestCase):
+    
+    def setUp(self):
+        self.super()
+        self.status = 200
+        self.server = LocalHTTPServer(lambda path, body: (self.status, 'true\n')).start()
+        self.transport = AsyncTransport(EventLoopEngine(), timeout=5)
+    
+    def tearDown(self):
+        self.server.stop()
+        self.super()
+    
+    def test_returns_response_body(self):
+        self.assert_equals('true\n', self.transport(self.server.url(), 'foo'))
+    
+    def test_raises_ioerror_for_http_errors(self):
+        self.status = 500
+        self.assert_raises(IOError, lambda: self.transport(self.server.url(), 'foo'))
+    
+    def test_respects_deadline(self):
+        self.server.responder = lambda path, body: (time.sleep(1), (200, 'true\n'))[1]
+        deadline = Deadline(0.1)
+        self.assert_raises(DeadlineExceeded, lambda: self.transport(self.server.url(), 'foo', deadline=deadline))
+    
+    def test_can_be_used_by_recaptcha_client(self):
+        client = reCAPTCHAClient('private', transport=self.transport)
+        client.verify_server = lambda: self.server.url('/verify')
+        client.verify('127.0.0.1', 'challenge', 'response')
+        self.assert_equals('/verify', self.server.requests[-1][0])
+
+
+class OldPythonTest(PythonicTestCase):
+    
+    def run_python(self, code):
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join(sys.path)
+        process = subprocess.Popen([sys.executable, '-c', '\n'.join(code)], env=environment,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        return (process.returncode, output)
+    
+    def test_can_import_engine_without_nonblocking_ssl(self):
+        code = [
+            'import sys, types',
+            '# ssl module of Python < 2.7.9',
+            "ssl = types.ModuleType('ssl')",
+            'ssl.SSLError = type("SSLError", (IOError,), {})',
+            "sys.modules['ssl'] = ssl",
+            'from trac_recaptcha.event_loop import EventLoopEngine',
+            "future = EventLoopEngine().submit('https://127.0.0.1/verify', '')",
+            'try:',
+            '    future.result(timeout=5)',
+            'except IOError, e:',
+            '    print str(e)',
+        ]
+        self.assert_equals((0, 'HTTPS is not supported (requires Python 2.7.9+ with SSL support)\n'), 
+                           self.run_python(code))
+    
+    def test_engine_is_only_imported_if_configured(self):
+        code = [
+            'import sys',
+            'import trac_recaptcha.integration',
+            "print 'trac_recaptcha.event_loop' in sys.modules",
+        ]
+        self.assert_equals((0, 'False\n'), self.run_python(code))
+
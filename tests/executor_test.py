@@ -0,0 +1,81 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.lib.executor import BoundedExecutor, FutureTimeout
+
+
+class BoundedExecutorTest(PythonicTestCase):
+    
+    def test_can_execute_function_in_background(self):
+        future = BoundedExecutor().submit(lambda a, b: a + b, 20, b=22)
+        self.assert_equals(42, future.result(timeout=5))
+        self.assert_true(future.done())
+    
+    def test_reraises_exceptions(self):
+        def fail():
+            raise ValueError('foo')
+        future = BoundedExecutor().submit(fail)
+        self.assert_raises(ValueError, lambda: future.result(timeout=5))
+    
+    def test_raises_timeout_if_function_takes_too_long(self):
+        proceed = threading.Event()
+        future = BoundedExecutor().submit(proceed.wait, 5)
+        self.assert_raises(FutureTimeout, lambda: future.result(timeout=0.01))
+        proceed.set()
+    
+    def test_rejects_functions_if_queue_is_full(self):
+        proceed = threading.Event()
+        started = threading.Event()
+        def block():
+            started.set()
+            proceed.wait(5)
+        executor = BoundedExecutor(max_workers=1, max_pending=1)
+        executor.submit(block)
+        started.wait(5)
+        self.assert_not_none(executor.submit(block))
+        self.assert_none(executor.submit(block))
+        proceed.set()
+        
+        stats = executor.stats()
+        self.assert_equals(1, stats['workers'])
+        self.assert_equals(1, stats['rejected'])
+    
+    def test_workers_exit_after_shutdown(self):
+        executor = BoundedExecutor(max_workers=2)
+        futures = [executor.submit(lambda: 42) for i in range(2)]
+        workers = list(executor._workers)
+        executor.shutdown()
+        
+        for future in futures:
+            self.assert_equals(42, future.result(timeout=5))
+        for worker in workers:
+            worker.join(5)
+            self.assert_false(worker.isAlive())
+        self.assert_equals(0, executor.stats()['workers'])
+        self.assert_none(executor.submit(lambda: 42))
+
@@ -0,0 +1,65 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.health import ProviderHealth
+
+
+class ProviderHealthTest(PythonicTestCase):
+    
+    def test_can_compute_p95_latency(self):
+        health = ProviderHealth()
+        self.assert_none(health.p95())
+        for i in range(1, 101):
+            health.record(i / 100.0)
+        self.assert_equals(0.95, health.p95())
+        self.assert_equals(0.5, health.latency_percentile(50))
+    
+    def test_can_compute_error_rate(self):
+        health = ProviderHealth()
+        self.assert_equals(0.0, health.error_rate())
+        health.record(0.1, failed=True)
+        health.record(0.1)
+        self.assert_equals(0.5, health.error_rate())
+    
+    def test_only_keeps_recent_samples(self):
+        health = ProviderHealth(window=3)
+        for i in range(3):
+            health.record(10, failed=True)
+        for i in range(3):
+            health.record(0.1)
+        self.assert_equals(dict(samples=3, error_rate=0.0, p95=0.1), health.stats())
+    
+    def test_ignores_old_samples(self):
+        self.now = 1000
+        health = ProviderHealth(max_age=60, clock=lambda: self.now)
+        health.record(10, failed=True)
+        self.now += 30
+        health.record(0.1)
+        self.assert_equals(dict(samples=2, error_rate=0.5, p95=10), health.stats())
+        
+        self.now += 31
+        self.assert_equals(dict(samples=1, error_rate=0.0, p95=0.1), health.stats())
+
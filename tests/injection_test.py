@@ -0,0 +1,65 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from genshi.builder import tag
+from genshi.input import HTML
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.injection import FirstMatchInjector, injector_for
+
+
+class FirstMatchInjectorTest(PythonicTestCase):
+    
+    def inject(self, html, content, selector='//div[@class="buttons"]'):
+        stream = HTML(html, encoding='utf-8')
+        return (stream | FirstMatchInjector(selector).before(content)).render()
+    
+    def test_inserts_content_before_first_match_only(self):
+        html = '<form><div class="buttons">a</div><div class="buttons">b</div></form>'
+        expected = '<form><p>captcha</p><div class="buttons">a</div><div class="buttons">b</div></form>'
+        self.assert_equals(expected, self.inject(html, tag.p('captcha')))
+    
+    def test_can_insert_text(self):
+        self.assert_equals('<div>foo<div class="buttons"/></div>', 
+                           self.inject('<div><div class="buttons"/></div>', 'foo'))
+    
+    def test_calls_content_callable_only_if_selector_matches(self):
+        calls = []
+        def content():
+            calls.append(True)
+            return tag.p('captcha')
+        self.assert_equals('<p>read only</p>', self.inject('<p>read only</p>', content))
+        self.assert_equals(0, len(calls))
+        self.inject('<div class="buttons"/>', content)
+        self.assert_equals(1, len(calls))
+    
+    def test_supports_nested_selectors(self):
+        html = '<form id="register"><p><input type="submit"/></p><input type="submit"/></form>'
+        expected = '<form id="register"><p><input type="submit"/></p>foo<input type="submit"/></form>'
+        selector = '//form[@id="register"]/input[@type="submit"]'
+        self.assert_equals(expected, self.inject(html, 'foo', selector=selector))
+    
+    def test_caches_injectors(self):
+        self.assert_true(injector_for('//div') is injector_for('//div'))
+
@@ -0,0 +1,70 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.cryptobox import CryptoBox
+from trac_captcha.keyring import KeyRing, parse_retired_keys, serialize_retired_keys
+
+
+class KeyRingTest(PythonicTestCase):
+    
+    def setUp(self):
+        self.super()
+        self.now = int(time.time())
+    
+    def test_signs_tokens_with_active_key(self):
+        key_ring = KeyRing('new', [('old', self.now + 60)])
+        token = key_ring.generate_token()
+        self.assert_true(CryptoBox('new').is_token_valid(token))
+        self.assert_true(key_ring.is_token_valid(token))
+    
+    def test_retired_keys_can_verify_tokens_until_retirement(self):
+        key_ring = KeyRing('new', [('old', self.now + 60)])
+        old_token = CryptoBox('old').generate_token()
+        self.assert_true(key_ring.is_token_valid(old_token))
+        self.assert_equals(self.now + 60, key_ring.token_expiration(old_token))
+        self.assert_none(key_ring.token_expiration(old_token, now=self.now + 61))
+    
+    def test_rejects_tokens_signed_by_unknown_keys(self):
+        key_ring = KeyRing('new', [('old', self.now + 60)])
+        self.assert_false(key_ring.is_token_valid(CryptoBox('other').generate_token()))
+        self.assert_false(key_ring.is_token_valid('foobar'))
+        self.assert_false(key_ring.is_token_valid(None))
+    
+    def test_can_verify_legacy_tokens_with_retired_keys(self):
+        box = CryptoBox('old')
+        payload = box.token_payload()
+        legacy_token = payload + '||' + box.sign_message(payload)
+        self.assert_true(KeyRing('new', [('old', self.now + 60)]).is_token_valid(legacy_token))
+        self.assert_false(KeyRing('new').is_token_valid(legacy_token))
+    
+    def test_can_parse_retired_keys_from_configuration(self):
+        retired_keys = [('foo', 1234), ('bar', 5678)]
+        serialized = serialize_retired_keys(retired_keys)
+        self.assert_equals(retired_keys, parse_retired_keys(serialized.split(',')))
+        self.assert_equals([], parse_retired_keys(['foo', 'bar:baz', ':123']))
+
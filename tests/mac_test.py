@@ -0,0 +1,65 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.mac import available_mac_engines, calibrate_mac_engines, \
+    compare_digest, default_mac_engine, mac_engine_by_id, mac_engine_by_name
+
+
+class MACEngineTest(PythonicTestCase):
+    
+    def test_can_compare_digests(self):
+        self.assert_true(compare_digest('foo', 'foo'))
+        self.assert_false(compare_digest('foo', 'bar'))
+        self.assert_false(compare_digest('foo', 'foobar'))
+    
+    def test_prefers_blake2b_if_available(self):
+        engine_names = [engine.name for engine in available_mac_engines()]
+        self.assert_contains('hmac', engine_names)
+        self.assert_equals(engine_names[0], default_mac_engine().name)
+        if 'blake2b' in engine_names:
+            self.assert_equals('blake2b', default_mac_engine().name)
+    
+    def test_can_find_engines(self):
+        hmac = mac_engine_by_name('hmac')
+        self.assert_equals(hmac, mac_engine_by_id(hmac.algorithm_id))
+        self.assert_none(mac_engine_by_name('invalid'))
+        self.assert_none(mac_engine_by_id(255))
+    
+    def test_keyed_state_depends_on_key(self):
+        for engine in available_mac_engines():
+            first = engine.keyed_state('foo')
+            first.update('message')
+            second = engine.keyed_state('bar')
+            second.update('message')
+            self.assert_not_equals(first.digest(), second.digest())
+    
+    def test_can_calibrate_engines(self):
+        results = calibrate_mac_engines(duration=0.01)
+        self.assert_equals(len(available_mac_engines()), len(results))
+        for name, signs, verifications in results:
+            self.assert_true(signs > 0)
+            self.assert_true(verifications > 0)
+
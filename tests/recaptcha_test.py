@@ -36,12 +36,13 @@ from trac_dev_platform.test.lib.pythonic_testcase import *
 
 from trac_captcha.api import CaptchaFailedError
 from trac_captcha.compat import json
+from trac_captcha.controller import initialize_captcha_data
 from trac_captcha.lib.attribute_dict import AttrDict
 from trac_recaptcha.client import reCAPTCHAClient
 from trac_recaptcha.genshi_widget import GenshiReCAPTCHAWidget
 from trac_recaptcha.integration import reCAPTCHAImplementation, trac_hostname
 
-from trac_captcha.test_util import CaptchaTest
+from trac_captcha.test_util import CaptchaTest, FakeCaptcha
 
 # http://recaptcha.net/apidocs/captcha/client
 example_http_snippet = '''
@@ -316,6 +317,12 @@ class reCAPTCHAImplementationTest(CaptchaTest, ReCAPTCHATestMixin):
         self.enable_captcha(reCAPTCHAImplementation)
         self.env.config.set('recaptcha', 'public_key', '1234567')
         self.env.config.set('recaptcha', 'private_key', '1234567')
+        self.real_verify = reCAPTCHAClient.__dict__['verify']
+    
+    def tearDown(self):
+        # client_with_probe() patches the class
+        reCAPTCHAClient.verify = self.real_verify
+        self.super()
     
     def client_with_probe(self, real_probe):
         client = reCAPTCHAClient
@@ -390,6 +397,8 @@ class reCAPTCHAImplementationTest(CaptchaTest, ReCAPTCHATestMixin):
     
     def generated_xml(self, req=None):
         req = req or self.request('/')
+        # the fallback captcha needs the captcha data (set by the controller)
+        initialize_captcha_data(req)
         stream = reCAPTCHAImplementation(self.env).genshi_stream(req)
         return unicode(stream)
     
@@ -408,4 +417,68 @@ class reCAPTCHAImplementationTest(CaptchaTest, ReCAPTCHATestMixin):
         req = self.request('/')
         req.locale = None
         self.assert_false('RecaptchaOptions' in self.generated_xml(req))
-
+    
+    # --- widget cache ---------------------------------------------------------
+    
+    def test_renders_widget_only_once_per_language_and_error(self):
+        captcha = reCAPTCHAImplementation(self.env)
+        first_xml = self.generated_xml()
+        self.assert_equals(first_xml, self.generated_xml())
+        stats = captcha.widget_cache().stats()
+        self.assert_equals(1, stats['hits'])
+        self.assert_equals(1, stats['misses'])
+        
+        req = self.request('/')
+        req.locale = Locale('fr')
+        self.assert_contains('{"lang": "fr"}', self.generated_xml(req))
+        self.assert_equals(2, len(captcha.widget_cache()))
+    
+    def test_cached_widget_is_a_single_event(self):
+        stream = reCAPTCHAImplementation(self.env).genshi_stream(self.request('/'))
+        self.assert_equals(1, len(list(stream)))
+    
+    def test_discards_cached_widgets_when_configuration_changes(self):
+        self.assert_false('blueberry' in self.generated_xml())
+        self.env.config.set('recaptcha', 'theme', 'blueberry')
+        self.assert_contains('{"theme": "blueberry"}', self.generated_xml())
+    
+    def test_can_disable_widget_cache(self):
+        self.env.config.set('recaptcha', 'widget_cache_size', '0')
+        self.assert_none(reCAPTCHAImplementation(self.env).widget_cache())
+        self.assert_contains('1234567', self.generated_xml())
+    
+    # --- circuit breaker ------------------------------------------------------
+    
+    def open_circuit(self, policy):
+        self.env.config.set('recaptcha', 'circuit_open_policy', policy)
+        self.env.config.set('recaptcha', 'fallback_captcha', 'FakeCaptcha')
+        self.enable_component(FakeCaptcha)
+        breaker = reCAPTCHAImplementation(self.env).circuit_breaker()
+        breaker.reset()
+        for i in range(breaker.min_calls):
+            breaker.record_failure()
+        self.assert_true(breaker.is_open())
+    
+    def solve_recaptcha(self):
+        req = self.request('/', recaptcha_challenge_field='foo',
+                           recaptcha_response_field='bar')
+        reCAPTCHAImplementation(self.env).assert_captcha_completed(req)
+    
+    def test_rejects_submissions_while_circuit_is_open(self):
+        self.open_circuit('reject')
+        e = self.assert_raises(CaptchaFailedError, self.solve_recaptcha)
+        self.assert_equals('recaptcha-not-reachable', e.captcha_data['error_code'])
+    
+    def test_can_accept_submissions_while_circuit_is_open(self):
+        self.open_circuit('accept')
+        self.solve_recaptcha()
+    
+    def test_can_use_fallback_captcha_while_circuit_is_open(self):
+        self.open_circuit('fallback')
+        self.assert_contains('fake captcha', self.generated_xml())
+        
+        req = self.request('/', fake_captcha='open sesame')
+        reCAPTCHAImplementation(self.env).assert_captcha_completed(req)
+        req = self.request('/', fake_captcha='foo')
+        verify = lambda: reCAPTCHAImplementation(self.env).assert_captcha_completed(req)
+        self.assert_raises(CaptchaFailedError, verify)
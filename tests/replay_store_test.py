@@ -0,0 +1,101 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import shutil
+import tempfile
+
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.replay_store import BloomReplayStore
+
+
+class BloomReplayStoreTest(PythonicTestCase):
+    
+    def setUp(self):
+        self.super()
+        self.now = 100000
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'replay.bloom')
+        self.store = self.replay_store()
+    
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+        self.super()
+    
+    def replay_store(self):
+        return BloomReplayStore(self.filename, bucket_seconds=3600, nr_buckets=6,
+                                bucket_size=1024, clock=lambda: self.now)
+    
+    def test_remembers_used_tokens(self):
+        self.assert_false(self.store.was_used('foo', self.now + 60))
+        self.store.mark_used('foo', self.now + 60)
+        self.assert_true(self.store.was_used('foo', self.now + 60))
+        self.assert_true(self.store.was_used(u'foo', self.now + 60))
+        self.assert_false(self.store.was_used('bar', self.now + 60))
+    
+    def test_marking_tokens_is_a_check_and_set_operation(self):
+        self.assert_true(self.store.mark_used('foo', self.now + 60))
+        self.assert_false(self.store.mark_used('foo', self.now + 60))
+        self.assert_true(self.store.mark_used('bar', self.now + 60))
+    
+    def test_shares_used_tokens_via_file(self):
+        self.store.mark_used('foo', self.now + 60)
+        other_store = self.replay_store()
+        try:
+            self.assert_true(other_store.was_used('foo', self.now + 60))
+        finally:
+            other_store.close()
+    
+    def test_has_fixed_size(self):
+        for i in range(100):
+            self.store.mark_used('token %d' % i, self.now + 60)
+        self.assert_equals(self.store.file_size, os.path.getsize(self.store.path))
+    
+    def test_uses_separate_file_for_other_settings(self):
+        self.store.mark_used('foo', self.now + 60)
+        other_store = BloomReplayStore(self.filename, bucket_seconds=3600, 
+            nr_buckets=8, bucket_size=1024, clock=lambda: self.now)
+        try:
+            self.assert_false(other_store.was_used('foo', self.now + 60))
+            self.assert_not_equals(self.store.path, other_store.path)
+        finally:
+            other_store.close()
+        # the original file was not touched
+        self.assert_equals(self.store.file_size, os.path.getsize(self.store.path))
+        self.assert_true(self.store.was_used('foo', self.now + 60))
+    
+    def test_refuses_to_reset_unexpected_file(self):
+        file(self.store.path, 'wb').write('foo')
+        self.assert_raises(ValueError, lambda: self.store.was_used('foo', self.now + 60))
+        self.assert_equals('foo', file(self.store.path, 'rb').read())
+    
+    def test_resets_buckets_with_expired_tokens(self):
+        self.store.mark_used('foo', self.now + 60)
+        self.now += 6 * 3600
+        self.store.mark_used('bar', self.now + 60)
+        self.assert_false(self.store.was_used('foo', self.now - 6 * 3600 + 60))
+        self.assert_true(self.store.was_used('bar', self.now + 60))
+
@@ -0,0 +1,246 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+import time
+
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.api import CaptchaFailedError
+from trac_captcha.test_util.http_server import LocalHTTPServer
+from trac_recaptcha.client import reCAPTCHAClient, UrlopenTransport
+from trac_recaptcha.connection_pool import HTTPConnectionPool, PooledTransport
+from trac_recaptcha.resilience import Bulkhead, BulkheadFullError, \
+    CircuitBreaker, Deadline, DeadlineExceeded, ResilientTransport
+
+
+class DeadlineTest(PythonicTestCase):
+    
+    def setUp(self):
+        self.super()
+        self.now = 1000
+        self.deadline = Deadline(10, clock=lambda: self.now)
+    
+    def test_limits_timeouts_to_remaining_time(self):
+        self.assert_equals(3, self.deadline.timeout(3))
+        self.now += 8
+        self.assert_equals(2, self.deadline.timeout(3))
+        self.assert_equals(2, self.deadline.timeout())
+    
+    def test_raises_exception_if_no_time_left(self):
+        self.now += 10
+        self.assert_raises(DeadlineExceeded, self.deadline.timeout)
+    
+    def test_can_have_unlimited_time(self):
+        self.assert_equals(3, Deadline().timeout(3))
+        self.assert_none(Deadline().timeout())
+
+
+class BulkheadTest(PythonicTestCase):
+    
+    def test_fails_fast_if_all_slots_are_in_use(self):
+        bulkhead = Bulkhead(1)
+        bulkhead.acquire()
+        self.assert_raises(BulkheadFullError, bulkhead.acquire)
+        bulkhead.release()
+        bulkhead.acquire()
+        stats = bulkhead.stats()
+        self.assert_equals(2, stats['acquired'])
+        self.assert_equals(1, stats['rejected'])
+    
+    def test_records_time_spent_waiting_for_a_slot(self):
+        bulkhead = Bulkhead(1, max_wait=5)
+        bulkhead.acquire()
+        timer = threading.Timer(0.05, bulkhead.release)
+        timer.start()
+        waited = bulkhead.acquire()
+        timer.join()
+        
+        self.assert_true(waited > 0)
+        self.assert_equals(waited, bulkhead.stats()['longest_wait'])
+
+
+class CircuitBreakerTest(PythonicTestCase):
+    
+    def setUp(self):
+        self.super()
+        self.now = 1000
+        self.transitions = []
+        self.breaker = CircuitBreaker(error_rate=0.5, window=4, min_calls=2, 
+            reset_timeout=30, clock=lambda: self.now,
+            listener=lambda old, new: self.transitions.append((old, new)))
+    
+    def open_breaker(self):
+        for i in range(2):
+            self.assert_true(self.breaker.allow_request())
+            self.breaker.record_failure()
+    
+    def test_opens_if_error_rate_is_reached(self):
+        self.breaker.record_success()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assert_false(self.breaker.is_open())
+        self.breaker.record_failure()
+        
+        self.assert_true(self.breaker.is_open())
+        self.assert_false(self.breaker.allow_request())
+        self.assert_equals([('closed', 'open')], self.transitions)
+    
+    def test_waits_for_minimum_number_of_calls(self):
+        self.breaker.record_failure()
+        self.assert_false(self.breaker.is_open())
+    
+    def test_allows_single_probe_after_reset_timeout(self):
+        self.open_breaker()
+        self.now += 31
+        self.assert_false(self.breaker.is_open())
+        self.assert_true(self.breaker.allow_request())
+        self.assert_false(self.breaker.allow_request())
+        self.assert_equals('half-open', self.breaker.state)
+    
+    def test_closes_after_successful_probe(self):
+        self.open_breaker()
+        self.now += 31
+        self.breaker.allow_request()
+        self.breaker.record_success()
+        
+        self.assert_equals('closed', self.breaker.state)
+        self.assert_true(self.breaker.allow_request())
+        expected = {'closed->open': 1, 'open->half-open': 1, 'half-open->closed': 1}
+        self.assert_equals(expected, self.breaker.stats()['transitions'])
+    
+    def test_opens_again_after_failed_probe(self):
+        self.open_breaker()
+        self.now += 31
+        self.breaker.allow_request()
+        self.breaker.record_failure()
+        
+        self.assert_true(self.breaker.is_open())
+        self.assert_equals(('half-open', 'open'), self.transitions[-1])
+    
+    def test_client_does_not_contact_server_while_open(self):
+        self.open_breaker()
+        def transport(url, data):
+            self.fail('must not contact verify server')
+        client = reCAPTCHAClient('foo', transport=transport, circuit_breaker=self.breaker)
+        e = self.assert_raises(CaptchaFailedError, lambda: client.verify('127.0.0.1', 'foo', 'bar'))
+        self.assert_equals('recaptcha-not-reachable', e.captcha_data['error_code'])
+        self.assert_true(e.captcha_data['circuit_open'])
+    
+    def test_client_records_unexpected_errors_of_probes(self):
+        self.open_breaker()
+        self.now += 31
+        def transport(url, data):
+            raise ValueError('unexpected error')
+        client = reCAPTCHAClient('foo', transport=transport, circuit_breaker=self.breaker)
+        self.assert_raises(ValueError, lambda: client.verify('127.0.0.1', 'foo', 'bar'))
+        self.assert_true(self.breaker.is_open())
+        
+        self.now += 31
+        self.assert_true(self.breaker.allow_request())
+    
+    def test_client_records_failures(self):
+        def transport(url, data):
+            raise IOError('server down')
+        client = reCAPTCHAClient('foo', transport=transport, circuit_breaker=self.breaker)
+        for i in range(2):
+            self.assert_raises(CaptchaFailedError, lambda: client.verify('127.0.0.1', 'foo', 'bar'))
+        self.assert_true(self.breaker.is_open())
+
+
+class ResilientTransportTest(PythonicTestCase):
+    
+    def setUp(self):
+        self.super()
+        self.server = LocalHTTPServer().start()
+        self.pool = HTTPConnectionPool('http', '127.0.0.1', self.server.server_address[1])
+    
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+        self.super()
+    
+    def verify(self, transport):
+        client = reCAPTCHAClient('foo', transport=transport)
+        client.verify_server = lambda: self.server.url('/verify')
+        client.verify('127.0.0.1', 'challenge', 'response')
+    
+    def assert_not_reachable(self, transport):
+        e = self.assert_raises(CaptchaFailedError, lambda: self.verify(transport))
+        self.assert_equals('recaptcha-not-reachable', e.captcha_data['error_code'])
+    
+    def test_can_verify_captcha(self):
+        self.verify(ResilientTransport(PooledTransport(self.pool), bulkhead=Bulkhead(1)))
+        self.assert_equals(1, len(self.server.requests))
+    
+    def test_fails_fast_if_bulkhead_is_full(self):
+        bulkhead = Bulkhead(1)
+        bulkhead.acquire()
+        self.assert_not_reachable(ResilientTransport(PooledTransport(self.pool), bulkhead=bulkhead))
+        self.assert_equals(0, len(self.server.requests))
+    
+    def slow_responder(self, path, body):
+        time.sleep(0.5)
+        return (200, 'true\n')
+    
+    def test_aborts_slow_requests_after_read_timeout(self):
+        self.server.responder = self.slow_responder
+        start = time.time()
+        self.assert_not_reachable(PooledTransport(self.pool, read_timeout=0.1))
+        self.assert_true(time.time() - start < 0.4)
+    
+    def test_aborts_slow_requests_after_total_timeout(self):
+        self.server.responder = self.slow_responder
+        transport = ResilientTransport(PooledTransport(self.pool, read_timeout=5),
+                                       total_timeout=0.1)
+        start = time.time()
+        self.assert_not_reachable(transport)
+        self.assert_true(time.time() - start < 0.4)
+    
+    def dribbling_responder(self, path, body):
+        # each part arrives well within the read timeout
+        self.server.part_delay = 0.2
+        return (200, ['true\n'.ljust(1024)] + ['x' * 1024] * 3)
+    
+    def test_total_timeout_limits_all_reads_of_a_response(self):
+        self.server.responder = self.dribbling_responder
+        transport = ResilientTransport(PooledTransport(self.pool, read_timeout=5),
+                                       total_timeout=0.3)
+        start = time.time()
+        self.assert_not_reachable(transport)
+        self.assert_true(time.time() - start < 0.5)
+    
+    def test_urllib2_transport_raises_ioerror_for_protocol_errors(self):
+        # httplib raises BadStatusLine if the server closes the connection 
+        # without a response
+        self.server.responder = lambda path, body: None
+        self.assert_not_reachable(UrlopenTransport(timeout=5))
+    
+    def test_total_timeout_limits_urllib2_transport(self):
+        self.server.responder = self.dribbling_responder
+        transport = ResilientTransport(UrlopenTransport(timeout=5), total_timeout=0.3)
+        start = time.time()
+        self.assert_not_reachable(transport)
+        self.assert_true(time.time() - start < 0.7)
+
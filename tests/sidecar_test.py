@@ -0,0 +1,192 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_recaptcha.client import CaptchaFailedError
+from trac_recaptcha.sidecar import pack_frame, read_frame, SidecarClient, \
+    SidecarServer, SidecarUnavailable
+
+
+class FakeClient(object):
+    def __init__(self, server):
+        self.server = server
+    
+    def verify(self, remote_ip, challenge, response):
+        self.server.verifications.append((remote_ip, challenge, response))
+        if response == 'wrong':
+            raise CaptchaFailedError(u'Incorrect captcha input', dict(error_code='incorrect-captcha-sol'))
+        if response == 'down':
+            raise CaptchaFailedError(u'Incorrect captcha input', 
+                dict(error_code='recaptcha-not-reachable', circuit_open=True))
+
+
+class FakeSiteverifyClient(object):
+    def __init__(self, server, provider, secret_key, site_key):
+        self.server = server
+        self.provider = provider
+        self.secret_key = secret_key
+        self.site_key = site_key
+    
+    def verify(self, remote_ip, response, expected_action=None):
+        self.server.verifications.append((self.provider.name, self.secret_key, 
+            self.site_key, remote_ip, response, expected_action))
+        if response == 'wrong':
+            raise CaptchaFailedError(u'Incorrect captcha input', dict(error_code='invalid-input-response'))
+        return dict(success=True, score=0.9)
+
+
+class FramingTest(PythonicTestCase):
+    
+    def reader(self, data):
+        data = [data]
+        def read(nr_bytes):
+            chunk, data[0] = data[0][:nr_bytes], data[0][nr_bytes:]
+            return chunk
+        return read
+    
+    def test_can_pack_and_read_frames(self):
+        frame = pack_frame(['verify', '', u'\xe4'.encode('utf-8')])
+        self.assert_equals(['verify', '', '\xc3\xa4'], read_frame(self.reader(frame)))
+    
+    def test_returns_none_at_end_of_stream(self):
+        self.assert_none(read_frame(self.reader('')))
+    
+    def test_rejects_truncated_frames(self):
+        frame = pack_frame(['verify', 'foo'])
+        self.assert_raises(IOError, lambda: read_frame(self.reader(frame[:-1])))
+
+
+class SidecarTest(PythonicTestCase):
+    
+    def setUp(self):
+        self.super()
+        self.tempdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tempdir, 'sidecar.sock')
+        self.server = None
+        self.client = SidecarClient(self.socket_path, timeout=5)
+    
+    def tearDown(self):
+        self.client.close()
+        self.stop_server()
+        shutil.rmtree(self.tempdir)
+        self.super()
+    
+    def start_server(self, siteverify=True):
+        siteverify_client_factory = None
+        if siteverify:
+            siteverify_client_factory = lambda provider, secret_key, site_key: \
+                FakeSiteverifyClient(self.server, provider, secret_key, site_key)
+        self.server = SidecarServer(self.socket_path, lambda private_key: FakeClient(self.server),
+                                    siteverify_client_factory=siteverify_client_factory)
+        self.server.verifications = []
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        thread.setDaemon(True)
+        thread.start()
+    
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+    
+    def test_can_verify_solution(self):
+        self.start_server()
+        self.client.verify('private', '127.0.0.1', 'challenge', u'r\xe4sponse')
+        self.assert_equals([('127.0.0.1', 'challenge', u'r\xe4sponse')], self.server.verifications)
+    
+    def test_raises_captcha_error_if_solution_was_rejected(self):
+        self.start_server()
+        e = self.assert_raises(CaptchaFailedError, 
+            lambda: self.client.verify('private', '127.0.0.1', 'challenge', 'wrong'))
+        self.assert_equals(dict(error_code='incorrect-captcha-sol'), e.captcha_data)
+        self.assert_equals(u'Incorrect captcha input', e.msg)
+    
+    def test_passes_open_circuit_to_caller(self):
+        self.start_server()
+        e = self.assert_raises(CaptchaFailedError, 
+            lambda: self.client.verify('private', '127.0.0.1', 'challenge', 'down'))
+        self.assert_true(e.captcha_data['circuit_open'])
+    
+    def test_can_verify_siteverify_solution(self):
+        self.start_server()
+        result = self.client.siteverify('recaptcha-v3', 'secret', None, '127.0.0.1', 
+                                        'response', expected_action='submit')
+        self.assert_equals(dict(success=True, score=0.9), result)
+        self.assert_equals([('recaptcha-v3', 'secret', None, '127.0.0.1', 'response', 'submit')], 
+                           self.server.verifications)
+    
+    def test_raises_captcha_error_if_siteverify_solution_was_rejected(self):
+        self.start_server()
+        e = self.assert_raises(CaptchaFailedError, 
+            lambda: self.client.siteverify('hcaptcha', 'secret', 'site', '127.0.0.1', 'wrong'))
+        self.assert_equals(dict(error_code='invalid-input-response'), e.captcha_data)
+    
+    def test_raises_sidecar_unavailable_if_daemon_does_not_support_siteverify(self):
+        self.start_server(siteverify=False)
+        self.assert_raises(SidecarUnavailable, 
+            lambda: self.client.siteverify('hcaptcha', 'secret', 'site', '127.0.0.1', 'response'))
+        self.assert_equals([], self.server.verifications)
+    
+    def test_reuses_connection(self):
+        self.start_server()
+        for i in range(3):
+            self.client.verify('private', '127.0.0.1', 'challenge', 'response')
+        self.assert_equals(1, len(self.client._idle))
+    
+    def test_raises_sidecar_unavailable_if_daemon_is_not_running(self):
+        self.assert_raises(SidecarUnavailable, 
+            lambda: self.client.verify('private', '127.0.0.1', 'challenge', 'response'))
+    
+    def test_reconnects_after_daemon_restart(self):
+        self.start_server()
+        self.client.verify('private', '127.0.0.1', 'challenge', 'response')
+        self.client._idle[0].shutdown(socket.SHUT_RDWR)
+        self.client.verify('private', '127.0.0.1', 'challenge', 'response')
+        self.assert_equals(2, len(self.server.verifications))
+
+
+class StandaloneImportTest(PythonicTestCase):
+    
+    def test_can_import_sidecar_without_trac_and_genshi(self):
+        code = '\n'.join([
+            'import sys',
+            "sys.modules['trac'] = sys.modules['genshi'] = None",
+            'import trac_recaptcha.sidecar',
+        ])
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join(sys.path)
+        process = subprocess.Popen([sys.executable, '-c', code], env=environment,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assert_equals((0, ''), (process.returncode, output))
+
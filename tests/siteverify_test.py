@@ -0,0 +1,236 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from Cookie import SimpleCookie
+import cgi
+import os
+import shutil
+import tempfile
+import threading
+
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.api import CaptchaFailedError
+from trac_captcha.compat import json
+from trac_captcha.test_util import CaptchaTest, LocalHTTPServer
+from trac_recaptcha.integration import reCAPTCHAImplementation
+from trac_recaptcha.providers import ESCALATED_FIELD, hCaptchaImplementation, \
+    reCAPTCHAv2Implementation, reCAPTCHAv3Implementation, SCORE_COOKIE_NAME, \
+    TurnstileImplementation
+from trac_recaptcha.sidecar import SidecarServer
+from trac_recaptcha.siteverify import hCaptchaProvider, reCAPTCHAv2Provider, \
+    reCAPTCHAv3Provider, SiteverifyClient, TurnstileProvider
+from trac_recaptcha.siteverify_widget import SiteverifyWidget
+
+
+class SiteverifyClientTest(PythonicTestCase):
+    
+    def setUp(self):
+        self.super()
+        self.result = dict(success=True)
+        self.server = LocalHTTPServer(lambda path, body: (200, json.dumps(self.result))).start()
+    
+    def tearDown(self):
+        self.server.stop()
+        self.super()
+    
+    def client(self, provider=None, **kwargs):
+        provider = provider or reCAPTCHAv2Provider()
+        provider.verify_url = self.server.url('/siteverify')
+        return SiteverifyClient(provider, 'secret', **kwargs)
+    
+    def sent_parameters(self):
+        path, body = self.server.requests[-1]
+        return dict([(key, values[0]) for key, values in cgi.parse_qs(body).items()])
+    
+    def test_sends_correct_request(self):
+        self.assert_equals(dict(success=True), self.client().verify('127.0.0.1', 'token'))
+        expected = dict(secret='secret', response='token', remoteip='127.0.0.1')
+        self.assert_equals(expected, self.sent_parameters())
+    
+    def test_hcaptcha_sends_site_key(self):
+        self.client(hCaptchaProvider(), site_key='site').verify('127.0.0.1', 'token')
+        self.assert_equals('site', self.sent_parameters()['sitekey'])
+    
+    def test_raises_exception_with_error_code_of_server(self):
+        self.result = {'success': False, 'error-codes': ['timeout-or-duplicate']}
+        e = self.assert_raises(CaptchaFailedError, lambda: self.client().verify('127.0.0.1', 'token'))
+        self.assert_equals('timeout-or-duplicate', e.captcha_data['error_code'])
+    
+    def test_do_not_ask_server_if_no_response_given(self):
+        e = self.assert_raises(CaptchaFailedError, lambda: self.client().verify('127.0.0.1', ''))
+        self.assert_equals('missing-input-response', e.captcha_data['error_code'])
+        self.assert_equals(0, len(self.server.requests))
+    
+    def test_invalid_json_means_server_not_reachable(self):
+        self.server.responder = lambda path, body: (200, 'true\n')
+        e = self.assert_raises(CaptchaFailedError, lambda: self.client().verify('127.0.0.1', 'token'))
+        self.assert_equals('recaptcha-not-reachable', e.captcha_data['error_code'])
+    
+    def test_v3_checks_action(self):
+        self.result = dict(success=True, score=0.9, action='login')
+        client = self.client(reCAPTCHAv3Provider())
+        self.assert_equals(0.9, client.verify('127.0.0.1', 'token', expected_action='login')['score'])
+        e = self.assert_raises(CaptchaFailedError, 
+            lambda: client.verify('127.0.0.1', 'token', expected_action='submit'))
+        self.assert_equals('action-mismatch', e.captcha_data['error_code'])
+
+
+class SiteverifyWidgetTest(PythonicTestCase):
+    
+    def test_can_generate_widget(self):
+        xml = unicode(SiteverifyWidget(reCAPTCHAv2Provider(), 'site', theme='dark').xml())
+        self.assert_contains('src="https://www.google.com/recaptcha/api.js"', xml)
+        self.assert_contains('class="g-recaptcha"', xml)
+        self.assert_contains('data-sitekey="site"', xml)
+        self.assert_contains('data-theme="dark"', xml)
+    
+    def test_passes_language_to_widget(self):
+        xml = unicode(SiteverifyWidget(hCaptchaProvider(), 'site', language='de').xml())
+        self.assert_contains('api.js?hl=de', xml)
+        xml = unicode(SiteverifyWidget(TurnstileProvider(), 'site', language='de').xml())
+        self.assert_contains('data-language="de"', xml)
+    
+    def test_can_generate_invisible_widget(self):
+        xml = unicode(SiteverifyWidget(reCAPTCHAv3Provider(), 'site').xml(invisible_action='submit'))
+        self.assert_contains('api.js?render=site', xml)
+        self.assert_contains('name="g-recaptcha-response"', xml)
+        self.assert_contains("grecaptcha.execute('site', {action: 'submit'})", xml)
+    
+    def test_invisible_widget_submits_form_if_recaptcha_is_not_loaded(self):
+        xml = unicode(SiteverifyWidget(reCAPTCHAv3Provider(), 'site').xml(invisible_action='submit'))
+        self.assert_contains('if (field.value || !window.grecaptcha) {', xml)
+        self.assert_contains('var button = event.submitter || lastButton;', xml)
+
+
+class SiteverifyCaptchaTest(CaptchaTest):
+    
+    def setUp(self):
+        self.super()
+        self.result = dict(success=True, score=0.9, action='submit')
+        self.server = LocalHTTPServer(lambda path, body: (200, json.dumps(self.result))).start()
+        self.env.config.set('recaptcha-v3', 'site_key', 'site')
+        self.env.config.set('recaptcha-v3', 'secret_key', 'secret')
+        # every test must contact the verify server
+        self.env.config.set('recaptcha', 'verdict_cache_ttl', '0')
+        self.enable_captcha(reCAPTCHAv3Implementation)
+    
+    def tearDown(self):
+        self.server.stop()
+        self.super()
+    
+    def solve(self, req=None):
+        captcha = reCAPTCHAv3Implementation(self.env)
+        client = captcha.client()
+        client.provider = reCAPTCHAv3Provider()
+        client.provider.verify_url = self.server.url('/siteverify')
+        req = req or self.request('/', **{'g-recaptcha-response': 'token'})
+        captcha.assert_captcha_completed(req, client)
+        return req
+    
+    def test_accepts_high_scores(self):
+        self.solve()
+    
+    def test_rejects_low_scores(self):
+        self.result['score'] = 0.1
+        e = self.assert_raises(CaptchaFailedError, self.solve)
+        self.assert_equals('low-score', e.captcha_data['error_code'])
+    
+    def test_escalates_low_scores_to_interactive_captcha(self):
+        self.env.config.set('recaptcha-v2', 'site_key', 'interactive')
+        self.env.config.set('recaptcha-v2', 'secret_key', 'secret')
+        self.enable_component(reCAPTCHAv2Implementation)
+        self.result['score'] = 0.1
+        e = self.assert_raises(CaptchaFailedError, self.solve)
+        self.assert_true(e.captcha_data['escalate'])
+        
+        req = self.request('/')
+        req.captcha_data = e.captcha_data
+        xml = unicode(reCAPTCHAv3Implementation(self.env).genshi_stream(req))
+        self.assert_contains('data-sitekey="interactive"', xml)
+        self.assert_contains('name="%s"' % ESCALATED_FIELD, xml)
+    
+    def test_escalates_submissions_without_token(self):
+        self.env.config.set('recaptcha-v2', 'site_key', 'interactive')
+        self.env.config.set('recaptcha-v2', 'secret_key', 'secret')
+        self.enable_component(reCAPTCHAv2Implementation)
+        e = self.assert_raises(CaptchaFailedError, lambda: self.solve(self.request('/')))
+        self.assert_true(e.captcha_data['escalate'])
+        self.assert_equals(0, len(self.server.requests))
+    
+    def test_caches_accepted_score_in_signed_cookie(self):
+        score_token = self.solve().outcookie[SCORE_COOKIE_NAME].value
+        nr_requests = len(self.server.requests)
+        
+        req = self.request('/')
+        req.incookie = SimpleCookie()
+        req.incookie[SCORE_COOKIE_NAME] = score_token
+        self.solve(req)
+        self.assert_equals(nr_requests, len(self.server.requests))
+        self.assert_equals('', unicode(reCAPTCHAv3Implementation(self.env).genshi_stream(req)))
+    
+    def test_has_solution_if_response_field_was_submitted(self):
+        captcha = reCAPTCHAv3Implementation(self.env)
+        self.assert_true(captcha.has_solution(self.request('/', **{'g-recaptcha-response': 'x'})))
+        self.assert_false(captcha.has_solution(self.request('/')))
+    
+    def test_verifies_solution_with_sidecar_if_configured(self):
+        tempdir = tempfile.mkdtemp()
+        socket_path = os.path.join(tempdir, 'sidecar.sock')
+        def siteverify_client_factory(provider, secret_key, site_key):
+            provider = reCAPTCHAv3Provider()
+            provider.verify_url = self.server.url('/siteverify')
+            return SiteverifyClient(provider, secret_key, site_key=site_key)
+        sidecar = SidecarServer(socket_path, None, 
+                                siteverify_client_factory=siteverify_client_factory)
+        thread = threading.Thread(target=sidecar.serve_forever, args=(0.05,))
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            self.env.config.set('recaptcha', 'sidecar_socket', socket_path)
+            class NoClient(object):
+                def verify(self, *args, **kwargs):
+                    raise AssertionError('verified in-process')
+            req = self.request('/', **{'g-recaptcha-response': 'token'})
+            reCAPTCHAv3Implementation(self.env).assert_captcha_completed(req, NoClient())
+        finally:
+            reCAPTCHAImplementation(self.env).sidecar().close()
+            sidecar.shutdown()
+            sidecar.server_close()
+            shutil.rmtree(tempdir)
+        self.assert_equals(1, len(self.server.requests))
+    
+    def test_prewarms_verify_servers_of_all_configured_captchas(self):
+        self.enable_component(hCaptchaImplementation)
+        self.env.config.set('trac-captcha', 'captchas', 
+                            'reCAPTCHAv3Implementation, hCaptchaImplementation')
+        verify_urls = reCAPTCHAImplementation(self.env).verify_urls()
+        self.assert_equals([reCAPTCHAv3Provider.verify_url, hCaptchaProvider.verify_url], 
+                           verify_urls)
+    
+    def test_displays_error_message_if_keys_are_missing(self):
+        self.enable_captcha(TurnstileImplementation)
+        xml = unicode(TurnstileImplementation(self.env).genshi_stream(self.request('/')))
+        self.assert_contains('[turnstile] site_key, secret_key', xml)
+
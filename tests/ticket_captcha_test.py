@@ -22,10 +22,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+from Cookie import SimpleCookie
+import os
+import shutil
+import tempfile
+
 from BeautifulSoup import BeautifulSoup
 from trac.ticket import Ticket
 
-from trac_captcha.controller import TracCaptchaController
+from trac_captcha.controller import FORM_TOKEN_COOKIE_NAME, TracCaptchaController
 from trac_captcha.cryptobox import CryptoBox
 from trac_captcha.lib.version import Version
 from trac_captcha.test_util import CaptchaTest, FakeCaptcha
@@ -39,6 +44,14 @@ class TicketCaptchaTest(CaptchaTest):
         self.enable_captcha(FakeCaptcha)
         self.grant_permission('anonymous', 'TICKET_CREATE')
         self.grant_permission('anonymous', 'TICKET_VIEW')
+        self.temp_directories = []
+    
+    def tearDown(self):
+        if self.temp_directories:
+            TracCaptchaController(self.env).replay_store().close()
+        for directory in self.temp_directories:
+            shutil.rmtree(directory)
+        self.super()
     
     def assert_number_of_tickets(self, nr_tickets):
         db = self.env.get_db_cnx()
@@ -237,3 +250,119 @@ class TicketCaptchaTest(CaptchaTest):
         self.assert_not_none(self.input_with_captcha_token(response))
         self.assert_false(self.is_fake_captcha_visible(response))
 
+    
+    # --- single use tokens ----------------------------------------------------
+    
+    def use_temporary_replay_store(self):
+        directory = tempfile.mkdtemp()
+        self.temp_directories.append(directory)
+        self.env.config.set('trac-captcha', 'replay_store_file', 
+                            os.path.join(directory, 'replay.bloom'))
+    
+    def enable_single_use_tokens(self):
+        self.use_temporary_replay_store()
+        self.env.config.set('trac-captcha', 'single_use_tokens', 'true')
+    
+    def test_can_not_reuse_token_after_ticket_was_saved(self):
+        self.enable_single_use_tokens()
+        controller = TracCaptchaController(self.env)
+        valid_token = CryptoBox(controller.token_key()).generate_token()
+        req = self.post_request('/newticket', field_summary='Foo', 
+                                __captcha_token=valid_token)
+        self.assert_equals(303, self.simulate_request(req).code())
+        
+        req = self.post_request('/newticket', field_summary='Bar', 
+                                __captcha_token=valid_token)
+        response = self.simulate_request(req)
+        self.assert_fake_captcha_warning_visible(response)
+        self.assert_number_of_tickets(1)
+    
+    def test_does_not_use_up_token_if_ticket_was_not_saved(self):
+        self.enable_single_use_tokens()
+        controller = TracCaptchaController(self.env)
+        valid_token = CryptoBox(controller.token_key()).generate_token()
+        # Trac rejects tickets without summary but calls all manipulators
+        req = self.post_request('/newticket', field_summary='', 
+                                __captcha_token=valid_token)
+        self.assert_equals(200, self.simulate_request(req).code())
+        self.assert_number_of_tickets(0)
+        
+        req = self.post_request('/newticket', field_summary='Foo', 
+                                __captcha_token=valid_token)
+        self.assert_equals(303, self.simulate_request(req).code())
+        self.assert_number_of_tickets(1)
+    
+    # --- submission budget ----------------------------------------------------
+    
+    def view_ticket_with_cookie(self, ticket, cookie_value):
+        req = self.request('/ticket/%d' % ticket.id)
+        req.incookie = SimpleCookie()
+        req.incookie[FORM_TOKEN_COOKIE_NAME] = cookie_value
+        return req, self.simulate_request(req)
+    
+    def test_reissued_token_survives_redirect_after_saving_the_ticket(self):
+        self.use_temporary_replay_store()
+        self.env.config.set('trac-captcha', 'token_submission_budget', '2')
+        ticket = self.add_ticket()
+        self.grant_permission('anonymous', 'TICKET_APPEND')
+        req = self.request('/')
+        TracCaptchaController(self.env).add_token_for_request(req, scope='ticket:%d' % ticket.id)
+        token = req.captcha_data['token']
+        
+        parameters = self.inject_form_parameters({'__captcha_token': token}, ticket=ticket)
+        req = self.post_request('/ticket/%d' % ticket.id, comment='foo', 
+                                action='leave', **parameters)
+        self.assert_equals(303, self.simulate_request(req).code())
+        reissued_token = req.outcookie[FORM_TOKEN_COOKIE_NAME].value
+        self.assert_not_equals(token, reissued_token)
+        
+        ticket = Ticket(self.env, tkt_id=ticket.id)
+        req, response = self.view_ticket_with_cookie(ticket, reissued_token)
+        self.assert_equals(reissued_token, self.input_with_captcha_token(response)['value'])
+        self.assert_false(self.is_fake_captcha_visible(response))
+        self.assert_equals('', req.outcookie[FORM_TOKEN_COOKIE_NAME].value)
+        
+        response = self.post_comment(ticket, 'bar', __captcha_token=reissued_token)
+        self.assert_equals(303, response.code())
+        self.assert_number_of_comments_for_ticket(2, Ticket(self.env, tkt_id=ticket.id))
+    
+    def test_renewed_token_survives_redirect_after_saving_the_ticket(self):
+        ticket = self.add_ticket()
+        self.grant_permission('anonymous', 'TICKET_APPEND')
+        controller = TracCaptchaController(self.env)
+        claims = controller.new_token_claims('ticket:%d' % ticket.id)
+        token = controller.key_ring().generate_token(ttl=60, claims=claims)
+        
+        parameters = self.inject_form_parameters({'__captcha_token': token}, ticket=ticket)
+        req = self.post_request('/ticket/%d' % ticket.id, comment='foo', 
+                                action='leave', **parameters)
+        self.assert_equals(303, self.simulate_request(req).code())
+        renewed_token = req.outcookie[FORM_TOKEN_COOKIE_NAME].value
+        self.assert_true(controller.token_expiration(renewed_token) > controller.token_expiration(token))
+        
+        ticket = Ticket(self.env, tkt_id=ticket.id)
+        req, response = self.view_ticket_with_cookie(ticket, renewed_token)
+        self.assert_equals(renewed_token, self.input_with_captcha_token(response)['value'])
+    
+    def test_ignores_carried_token_for_other_tickets(self):
+        self.use_temporary_replay_store()
+        self.env.config.set('trac-captcha', 'token_submission_budget', '2')
+        ticket = self.add_ticket()
+        self.grant_permission('anonymous', 'TICKET_APPEND')
+        req = self.request('/')
+        TracCaptchaController(self.env).add_token_for_request(req, scope='ticket:new')
+        
+        req, response = self.view_ticket_with_cookie(ticket, req.captcha_data['token'])
+        self.assert_none(self.input_with_captcha_token(response))
+        self.assert_fake_captcha_is_visible(response)
+    
+    def test_can_use_single_use_token_for_several_previews(self):
+        self.enable_single_use_tokens()
+        controller = TracCaptchaController(self.env)
+        valid_token = CryptoBox(controller.token_key()).generate_token()
+        for i in range(2):
+            req = self.post_request('/newticket', field_summary='Foo', 
+                                    __captcha_token=valid_token, preview='Preview')
+            response = self.simulate_request(req)
+            self.assert_false(self.is_fake_captcha_visible(response))
+
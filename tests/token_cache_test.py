@@ -0,0 +1,91 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from trac_dev_platform.test.lib.pythonic_testcase import *
+
+from trac_captcha.lib.lru_cache import LRUCache
+from trac_captcha.token_cache import VerifiedTokenCache
+
+
+class LRUCacheTest(PythonicTestCase):
+    
+    def test_can_store_and_retrieve_items(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('foo', 42)
+        self.assert_equals(42, cache.get('foo'))
+        self.assert_none(cache.get('bar'))
+        self.assert_equals(dict(hits=1, misses=1, evictions=0, size=1, maxsize=2),
+                           cache.stats())
+    
+    def test_evicts_least_recently_used_item(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('foo', 1)
+        cache.set('bar', 2)
+        cache.get('foo')
+        cache.set('baz', 3)
+        
+        self.assert_true('foo' in cache)
+        self.assert_false('bar' in cache)
+        self.assert_true('baz' in cache)
+        self.assert_equals(1, cache.stats()['evictions'])
+    
+    def test_can_remove_items(self):
+        cache = LRUCache()
+        cache.set('foo', 1)
+        self.assert_equals(1, cache.pop('foo'))
+        self.assert_equals(0, len(cache))
+        cache.set('bar', 2)
+        cache.clear()
+        self.assert_none(cache.get('bar'))
+
+
+class VerifiedTokenCacheTest(PythonicTestCase):
+    
+    def setUp(self):
+        self.super()
+        self.now = 1000
+        self.cache = VerifiedTokenCache(maxsize=10, clock=lambda: self.now)
+    
+    def test_knows_remembered_tokens(self):
+        self.assert_false(self.cache.is_known_valid('key', 'token'))
+        self.cache.remember('key', 'token', 2000)
+        self.assert_true(self.cache.is_known_valid('key', 'token'))
+        self.assert_true(self.cache.is_known_valid('key', u'token'))
+    
+    def test_drops_expired_tokens(self):
+        self.cache.remember('key', 'token', 2000)
+        self.now = 2001
+        self.assert_false(self.cache.is_known_valid('key', 'token'))
+        self.assert_equals(0, self.cache.stats()['size'])
+        self.assert_equals(1, self.cache.stats()['expired'])
+    
+    def test_clears_cache_if_token_key_changes(self):
+        self.cache.remember('key', 'token', 2000)
+        self.assert_false(self.cache.is_known_valid('new key', 'token'))
+        self.assert_false(self.cache.is_known_valid('key', 'token'))
+    
+    def test_ignores_non_string_tokens(self):
+        self.assert_false(self.cache.is_known_valid('key', None))
+        self.assert_false(self.cache.is_known_valid('key', ['token']))
+
@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from genshi.builder import tag
+from trac.core import Component, implements
+from trac.web.api import RequestDone
+
+from trac_captcha.api import ICaptcha
+from trac_captcha.controller import TracCaptchaController, PROVIDER_FIELD, \
+    WIDGET_PATH
+from trac_captcha.lib.attribute_dict import AttrDict
+from trac_captcha.test_util import CaptchaTest, FakeCaptcha
+from trac_captcha.web_ui import CaptchaWidgetModule
+
+
+class CaptchaWidgetModuleTest(CaptchaTest):
+    
+    def setUp(self):
+        self.super()
+        self.enable_captcha(FakeCaptcha)
+        self.env.config.set('trac-captcha', 'widget_endpoint', 'True')
+        self.module = CaptchaWidgetModule(self.env)
+    
+    def fetch_widget(self, args=None, **headers):
+        environ = dict([('HTTP_' + name.upper(), value) for name, value in headers.items()])
+        req = self.request(WIDGET_PATH, request_attributes=environ, **(args or {}))
+        response = AttrDict(status=None, headers={}, body='')
+        def send_response(code=200):
+            response.status = code
+        def send_header(name, value):
+            response.headers[name] = str(value)
+        def write(data):
+            response.body += data
+        req.send_response = send_response
+        req.send_header = send_header
+        req.end_headers = lambda: None
+        req.write = write
+        self.assert_true(self.module.match_request(req))
+        self.assert_raises(RequestDone, lambda: self.module.process_request(req))
+        return response
+    
+    def test_serves_captcha_fragment(self):
+        response = self.fetch_widget()
+        self.assert_equals(200, response.status)
+        self.assert_equals('<div>fake captcha: </div>', response.body)
+        self.assert_equals('text/html;charset=utf-8', response.headers['Content-Type'])
+    
+    def test_fragment_is_cacheable(self):
+        headers = self.fetch_widget().headers
+        self.assert_equals('public, max-age=300', headers['Cache-Control'])
+        # the fragment only depends on the URL
+        self.assert_false('Vary' in headers)
+        self.assert_true(headers['ETag'].startswith('"'))
+    
+    def test_uses_language_from_url_not_from_session(self):
+        self.enable_captcha(LocaleCaptcha)
+        self.assert_equals('<div>locale: None</div>', self.fetch_widget().body)
+        self.assert_equals('<div>locale: de</div>', self.fetch_widget(dict(lang='de')).body)
+        self.assert_equals('<div>locale: None</div>', self.fetch_widget(dict(lang='../x')).body)
+    
+    def test_sends_not_modified_if_etag_matches(self):
+        etag = self.fetch_widget().headers['ETag']
+        response = self.fetch_widget(if_none_match=etag)
+        self.assert_equals(304, response.status)
+        self.assert_equals('', response.body)
+        self.assert_equals(etag, response.headers['ETag'])
+        
+        self.assert_equals(200, self.fetch_widget(if_none_match='"foo"').status)
+    
+    def test_endpoint_is_disabled_by_default(self):
+        self.env.config.remove('trac-captcha', 'widget_endpoint')
+        self.assert_false(self.module.match_request(self.request(WIDGET_PATH)))
+    
+    def test_pages_fetch_widget_from_endpoint(self):
+        req = self.request('/newticket')
+        html = TracCaptchaController(self.env).included_captcha_html(req).generate().render()
+        self.assert_contains(".push(['include', 'trac-captcha-1', '", html)
+        self.assert_contains("/captcha/widget', ", html)
+        self.assert_false('fake captcha' in html)
+    
+    def test_page_passes_language_to_endpoint(self):
+        req = self.request('/newticket')
+        req.locale = 'de_DE'
+        html = TracCaptchaController(self.env).included_captcha_html(req).generate().render()
+        self.assert_contains("/captcha/widget?lang=de_DE', ", html)
+    
+    def use_captcha_chain(self):
+        self.enable_component(LocaleCaptcha)
+        self.env.config.set('trac-captcha', 'captchas', 'LocaleCaptcha, FakeCaptcha')
+    
+    def test_page_contains_provider_field_for_shared_fragment(self):
+        self.use_captcha_chain()
+        req = self.request('/newticket')
+        html = TracCaptchaController(self.env).included_captcha_html(req).generate().render()
+        self.assert_contains("/captcha/widget?provider=LocaleCaptcha', ", html)
+        self.assert_contains('name="%s"' % PROVIDER_FIELD, html)
+        
+        response = self.fetch_widget(dict(provider='FakeCaptcha'))
+        self.assert_equals('<div>fake captcha: </div>', response.body)
+        # signed provider tokens differ for every page so they must not be
+        # part of the cached fragment
+        self.assert_false(PROVIDER_FIELD in response.body)
+        etag = response.headers['ETag']
+        self.assert_equals(304, self.fetch_widget(dict(provider='FakeCaptcha'), if_none_match=etag).status)
+
+
+class LocaleCaptcha(Component):
+    implements(ICaptcha)
+    
+    def genshi_stream(self, req):
+        return tag.div('locale: %s' % req.locale).generate()
+    
+    def assert_captcha_completed(self, req):
+        pass
+
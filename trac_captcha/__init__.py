@@ -1,5 +1,15 @@
 
-from trac_captcha.api import *
-from trac_captcha.controller import *
-from trac_captcha.ticket import *
-
+# Only the Trac components need Trac and Genshi: Helpers like 
+# trac_captcha.lib.lru_cache are used by the sidecar daemon without them.
+try:
+    import genshi
+    import trac
+except ImportError:
+    pass
+else:
+    from trac_captcha.admin import *
+    from trac_captcha.api import *
+    from trac_captcha.controller import *
+    from trac_captcha.speculative import *
+    from trac_captcha.ticket import *
+    from trac_captcha.web_ui import *
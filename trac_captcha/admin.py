@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from datetime import datetime
+import time
+
+from trac.core import Component, implements
+from trac.util.datefmt import utc
+
+from trac_captcha.controller import TracCaptchaController
+from trac_captcha.mac import calibrate_mac_engines
+
+__all__ = []
+
+# trac-admin can only be extended since Trac 0.12
+try:
+    from trac.admin.api import IAdminCommandProvider
+    from trac.util.text import printout
+except ImportError:
+    IAdminCommandProvider = None
+
+
+def format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp, utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+
+
+if IAdminCommandProvider is not None:
+    __all__.append('CaptchaAdminCommands')
+    
+    class CaptchaAdminCommands(Component):
+        
+        implements(IAdminCommandProvider)
+        
+        # --- IAdminCommandProvider --------------------------------------------
+        def get_admin_commands(self):
+            yield ('captcha rotate-key', '[grace period in seconds]',
+                   '''Generate a new captcha token key
+                   
+                   The previous key can still verify tokens until the grace 
+                   period is over (default: token lifetime, 4 hours) so users
+                   do not have to solve a captcha again.''',
+                   None, self._do_rotate_key)
+            yield ('captcha list-keys', '',
+                   'Show the active and retired captcha token keys',
+                   None, self._do_list_keys)
+            yield ('captcha benchmark', '',
+                   '''Measure captcha token signatures per second
+                   
+                   Reports the number of token signatures and verifications 
+                   per second for every MAC algorithm available on this host
+                   (see [trac-captcha] mac_algorithm).''',
+                   None, self._do_benchmark)
+        
+        # --- private API ------------------------------------------------------
+        
+        def controller(self):
+            return TracCaptchaController(self.env)
+        
+        def _do_rotate_key(self, grace_period=None):
+            if grace_period is not None:
+                grace_period = int(grace_period)
+            self.controller().rotate_token_key(grace_period=grace_period)
+            printout('New captcha token key generated.')
+            self._do_list_keys()
+        
+        def _do_list_keys(self):
+            controller = self.controller()
+            key_ring = controller.key_ring()
+            printout('%-12s key id %08x' % ('active:', key_ring.active.key_id()))
+            now = int(time.time())
+            retired = [(verifier, retire_at) for verifier, retire_at 
+                       in key_ring.verifiers.values() if retire_at is not None]
+            retired.sort(key=lambda item: item[1])
+            for verifier, retire_at in retired:
+                state = (retire_at < now) and 'retired' or 'verify-only'
+                printout('%-12s key id %08x until %s' % (state + ':', verifier.key_id(), 
+                                                         format_timestamp(retire_at)))
+        
+        def _do_benchmark(self):
+            printout('%-12s %15s %15s' % ('algorithm', 'signs/s', 'verifies/s'))
+            for name, signs, verifications in calibrate_mac_engines():
+                printout('%-12s %15d %15d' % (name, signs, verifications))
+
@@ -36,7 +36,12 @@ class CaptchaFailedError(Exception):
 
 class ICaptcha(Interface):
     """Extension point interface for components that implement a specific 
-    captcha."""
+    captcha.
+    
+    Implementations may also provide 'has_solution(req)' which returns True 
+    if the request contains a (possibly wrong) captcha solution. This is 
+    necessary for speculative verification (assert_captcha_completed() is 
+    called in a background thread then)."""
     
     def genshi_stream(self):
         "Return a Genshi stream which contains the captcha implementation."
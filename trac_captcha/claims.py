@@ -0,0 +1,144 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import struct
+
+__all__ = ['pack_claims', 'provider_claim', 'purpose_claim', 'quota_claim', 
+           'scope_claim', 'scope_matches', 'scope_realm', 'score_claim', 
+           'token_provider', 'token_purpose', 'token_quota', 'token_score', 
+           'token_scope', 'unpack_claims']
+
+# Additional (signed) information in captcha tokens. Each claim is encoded as
+# type (1 byte), length (1 byte) and value.
+CLAIM_QUOTA = 1
+CLAIM_SCOPE = 2
+CLAIM_SCORE = 3
+CLAIM_PURPOSE = 4
+CLAIM_PROVIDER = 5
+
+QUOTA_FORMAT = '>HH'
+# score (0.0 - 1.0) in thousandths
+SCORE_FORMAT = '>H'
+
+
+def pack_claims(claims):
+    if not claims:
+        return ''
+    parts = []
+    for claim_type, value in sorted(claims.items()):
+        parts.append(struct.pack('>BB', claim_type, len(value)) + value)
+    return ''.join(parts)
+
+def unpack_claims(data):
+    """Return a dict (claim type -> value) or None if the data is malformed."""
+    claims = {}
+    position = 0
+    while position < len(data):
+        if position + 2 > len(data):
+            return None
+        claim_type, length = struct.unpack('>BB', data[position:position+2])
+        position += 2
+        if position + length > len(data):
+            return None
+        claims[claim_type] = data[position:position+length]
+        position += length
+    return claims
+
+
+def quota_claim(budget, used=0):
+    """Claim for a token which can be used for 'budget' submissions, 'used'
+    submissions were already made."""
+    return {CLAIM_QUOTA: struct.pack(QUOTA_FORMAT, budget, used)}
+
+def token_quota(token):
+    """Return (budget, used submissions) for the given (unpacked) token or 
+    None if the token does not limit the number of submissions."""
+    value = token.claims.get(CLAIM_QUOTA)
+    if (value is None) or (len(value) != struct.calcsize(QUOTA_FORMAT)):
+        return None
+    return struct.unpack(QUOTA_FORMAT, value)
+
+
+def scope_claim(scope):
+    """Claim for a token which is only valid for the given scope. A scope is
+    either '*' (all forms), a realm (e.g. 'registration') or realm and 
+    resource id (e.g. 'ticket:1234')."""
+    if scope == '*':
+        return {}
+    if isinstance(scope, unicode):
+        scope = scope.encode('utf-8')
+    return {CLAIM_SCOPE: scope}
+
+def token_scope(token):
+    """Return the scope of the given (unpacked) token ('*' if the token is 
+    valid everywhere)."""
+    value = token.claims.get(CLAIM_SCOPE)
+    if value is None:
+        return '*'
+    return value.decode('utf-8', 'replace')
+
+def scope_matches(token_scope, scope):
+    return token_scope in ('*', scope)
+
+def scope_realm(scope):
+    return scope.split(':', 1)[0]
+
+
+def purpose_claim(purpose):
+    """Claim for a token which may only be presented in one place: 'form' 
+    (hidden form field) or 'cookie'."""
+    return {CLAIM_PURPOSE: purpose}
+
+def token_purpose(token):
+    """Return the purpose of the given (unpacked) token or None for tokens 
+    without purpose (issued by older versions)."""
+    return token.claims.get(CLAIM_PURPOSE)
+
+
+def provider_claim(name):
+    """Claim for a token which names the captcha that was displayed. These
+    tokens can not be used to skip a captcha (purpose 'provider')."""
+    claims = purpose_claim('provider')
+    claims[CLAIM_PROVIDER] = name
+    return claims
+
+def token_provider(token):
+    """Return the captcha name of the given (unpacked) token or None."""
+    if token_purpose(token) != 'provider':
+        return None
+    return token.claims.get(CLAIM_PROVIDER)
+
+
+def score_claim(score):
+    """Claim for a token which only caches an accepted (reCAPTCHA v3) score.
+    These tokens can not be used to skip a captcha."""
+    score = min(max(score, 0), 1)
+    return {CLAIM_SCORE: struct.pack(SCORE_FORMAT, int(round(score * 1000)))}
+
+def token_score(token):
+    """Return the cached score of the given (unpacked) token or None."""
+    value = token.claims.get(CLAIM_SCORE)
+    if (value is None) or (len(value) != struct.calcsize(SCORE_FORMAT)):
+        return None
+    return struct.unpack(SCORE_FORMAT, value)[0] / 1000.0
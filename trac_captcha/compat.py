@@ -22,7 +22,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-__all__ = ['domain_functions', 'json']
+__all__ = ['domain_functions', 'FloatOption', 'json']
 
 try:
     import json as json
@@ -46,3 +46,16 @@ except ImportError:
           }
         return [_functions[s] for s in symbols]
 
+
+# FloatOption was introduced in Trac 0.12
+try:
+    from trac.config import FloatOption
+except ImportError:
+    from trac.config import Option
+    
+    class FloatOption(Option):
+        def __get__(self, instance, owner):
+            value = Option.__get__(self, instance, owner)
+            if instance is None:
+                return value
+            return float(value or 0)
@@ -22,42 +22,257 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+from Cookie import CookieError, SimpleCookie
+import os
+import threading
+import time
+
 from genshi import HTML
 from genshi.builder import tag
 import pkg_resources
-from trac.config import ExtensionOption, Option
+from trac.config import BoolOption, ExtensionOption, IntOption, ListOption, \
+    Option, OrderedExtensionsOption
 from trac.core import Component, implements
+from trac.env import IEnvironmentSetupParticipant
 from trac.perm import IPermissionRequestor
+from trac.web.chrome import add_script, ITemplateProvider
 
 from trac_captcha.api import CaptchaFailedError, ICaptcha
+from trac_captcha.claims import provider_claim, purpose_claim, quota_claim, \
+    scope_claim, scope_matches, scope_realm, token_provider, token_purpose, \
+    token_quota, token_score, token_scope
+from trac_captcha.compat import FloatOption
 from trac_captcha.cryptobox import CryptoBox
-from trac_captcha.i18n import add_domain
+from trac_captcha.deferred import deferred_captcha_tag, included_captcha_tag, \
+    LOADER_SCRIPT
+from trac_captcha.health import ProviderHealth
+from trac_captcha.i18n import _, add_domain
+from trac_captcha.keyring import KeyRing, parse_retired_keys, serialize_retired_keys
+from trac_captcha.lib.executor import BoundedExecutor, FutureTimeout
 from trac_captcha.lib.version import Version
+from trac_captcha.mac import default_mac_engine, mac_engine_by_name
+from trac_captcha.replay_store import BloomReplayStore
+from trac_captcha.token_cache import VerifiedTokenCache
+from trac_captcha.token_key_store import provision_token_key
 from trac_captcha.trac_version import trac_version
 
-__all__ = ['initialize_captcha_data', 'TracCaptchaController']
+__all__ = ['initialize_captcha_data', 'is_shared_widget_request', 
+           'TracCaptchaController', 'WIDGET_PATH']
+
+
+CAPTCHA_COOKIE_NAME = 'trac_captcha'
+# Re-issued form tokens are carried across the redirect after a successful 
+# submission in this (short-lived) cookie.
+FORM_TOKEN_COOKIE_NAME = 'trac_captcha_form'
+FORM_TOKEN_COOKIE_TTL = 300
+# hidden form field with a (signed) token which names the captcha which was 
+# displayed
+PROVIDER_FIELD = '__captcha_provider'
+# error codes which mean that a captcha could not be verified at all
+UNAVAILABLE_ERROR_CODES = ('recaptcha-not-reachable', 'verification-timeout')
+# URL of the cacheable captcha widget (see CaptchaWidgetModule)
+WIDGET_PATH = '/captcha/widget'
 
 
 def initialize_captcha_data(req):
     if not hasattr(req, 'captcha_data'):
         req.captcha_data = dict()
 
+def is_shared_widget_request(req):
+    """Return True if the captcha is rendered for the widget endpoint. That 
+    markup is cached for all users so it must not depend on cookies."""
+    return getattr(req, 'captcha_data', {}).get('shared_widget', False)
+
+class DetachedRequest(object):
+    """Request data which a captcha needs for the verification. Speculative
+    verifications run in a worker thread which must not modify the real 
+    request while the request thread uses it: Cookies and captcha data are 
+    collected here and applied in the request thread (see `apply_to`)."""
+    
+    def __init__(self, req):
+        self.args = req.args
+        self.environ = req.environ
+        self.get_header = req.get_header
+        self.incookie = req.incookie
+        self.locale = getattr(req, 'locale', None)
+        self.path_info = req.path_info
+        self.remote_addr = req.remote_addr
+        self.base_path = req.base_path
+        self.scheme = req.scheme
+        self.outcookie = SimpleCookie()
+        self.captcha_data = dict(getattr(req, 'captcha_data', {}))
+    
+    def apply_to(self, req):
+        for name, morsel in self.outcookie.items():
+            req.outcookie[name] = morsel.value
+            req.outcookie[name].update(morsel)
+        initialize_captcha_data(req)
+        req.captcha_data.update(self.captcha_data)
+
+
 class TracCaptchaController(Component):
     
-    implements(IPermissionRequestor)
+    implements(IEnvironmentSetupParticipant, IPermissionRequestor, ITemplateProvider)
     
     captcha = ExtensionOption('trac-captcha', 'captcha', ICaptcha,
                               'reCAPTCHAImplementation',
         '''Name of the component implementing `ICaptcha`, which is used to 
         generate actual captchas.''')
     
+    ordered_captchas = OrderedExtensionsOption('trac-captcha', 'captchas', ICaptcha,
+        '', include_missing=False,
+        doc='''Ordered list of components implementing `ICaptcha`. The first 
+        healthy captcha is displayed (see `failover_error_rate` and 
+        `failover_p95`), submissions are verified by the captcha which was 
+        displayed. If empty, only `captcha` is used.''')
+    
+    failover_error_rate = FloatOption('trac-captcha', 'failover_error_rate', 0.25,
+        '''A captcha in `captchas` is skipped if this fraction of its recent 
+        verifications failed because the verification service was not 
+        available.''')
+    
+    failover_p95 = FloatOption('trac-captcha', 'failover_p95', 3,
+        '''A captcha in `captchas` is skipped if 5% of its recent 
+        verifications took longer than this number of seconds. 0 disables 
+        the latency check.''')
+    
+    failover_min_samples = IntOption('trac-captcha', 'failover_min_samples', 10,
+        '''Minimum number of recent verifications before a captcha can be 
+        skipped.''')
+    
+    health_window = IntOption('trac-captcha', 'health_window', 100,
+        '''Number of recent verifications per captcha which are used to 
+        compute latency and error rate.''')
+    
+    health_max_age = IntOption('trac-captcha', 'health_max_age', 600,
+        '''Verifications older than this number of seconds are ignored for 
+        latency and error rate. Skipped captchas are not verified anymore so
+        they are displayed again after this time to check if they 
+        recovered.''')
+    
     stored_token_key = Option('trac-captcha', 'token_key',  None, 
-        '''Generated private key which is used to encrypt captcha tokens.''')
+        '''Private key which is used to sign captcha tokens. If not set, a 
+        generated key (stored in the database) is used.''')
+    
+    stored_retired_token_keys = ListOption('trac-captcha', 'retired_token_keys', '',
+        doc='''Old token keys ("key:retirement timestamp") which can still 
+        verify captcha tokens until their retirement time. Use 
+        `trac-admin captcha rotate-key` to change the token key without 
+        invalidating tokens in flight.''')
+    
+    token_cache_size = IntOption('trac-captcha', 'token_cache_size', 1000,
+        '''Number of already verified captcha tokens which are kept in memory
+        so that repeated checks (e.g. ticket previews) are cheap.''')
+    
+    accept_legacy_tokens = BoolOption('trac-captcha', 'accept_legacy_tokens', True,
+        '''Accept captcha tokens in the old (TracCaptcha 0.3) format. You can 
+        disable this a few hours after upgrading when all old tokens expired.''')
+    
+    single_use_tokens = BoolOption('trac-captcha', 'single_use_tokens', False,
+        '''Captcha tokens can only be used for a single submission (e.g. one
+        ticket change). Used tokens are remembered in a memory-mapped file 
+        (see `replay_store_file`) which is shared by all processes on the 
+        host.''')
+    
+    replay_store_file = Option('trac-captcha', 'replay_store_file', '',
+        '''File which stores used captcha tokens if `single_use_tokens` or 
+        `token_submission_budget` is enabled (default: `db/captcha-replay.bloom` in the environment). The 
+        store layout is added to the file name so changing token lifetimes or
+        `replay_store_size` starts a new file (the old one can be deleted).''')
+    
+    replay_store_size = IntOption('trac-captcha', 'replay_store_size', 3072,
+        '''Size of the used token store in KiB (with the default size the 
+        store can hold about 2 million tokens).''')
+    
+    mac_algorithm = Option('trac-captcha', 'mac_algorithm', '',
+        '''Algorithm to sign new captcha tokens: `blake2b` (default if 
+        available, requires Python 3.6+ or pyblake2) or `hmac`. Use 
+        `trac-admin captcha benchmark` to compare the algorithms on your host.
+        Tokens signed with any available algorithm are accepted.''')
+    
+    token_ttl = IntOption('trac-captcha', 'token_ttl', CryptoBox.token_lifetime,
+        '''Lifetime of captcha tokens in seconds. The lifetime for a specific
+        realm can be set with `token_ttl.<realm>` (e.g. `token_ttl.ticket`, 
+        `token_ttl.registration`). Tokens are renewed when they are used after
+        half of their lifetime.''')
+    
+    cookie_ttl = IntOption('trac-captcha', 'cookie_ttl', 0,
+        '''After a captcha was solved, set a signed cookie which allows the
+        user to skip captchas on all protected forms (tickets, discussion, 
+        registration) for this number of seconds. 0 disables the cookie.''')
+    
+    token_submission_budget = IntOption('trac-captcha', 'token_submission_budget', 0,
+        '''Number of submissions (e.g. ticket comments) which are possible 
+        with a single solved captcha. The budget is signed into the token 
+        which is re-issued after every submission. 0 means no limit (besides 
+        the token lifetime). Superseded tokens are stored as used (see 
+        `replay_store_file`) so a leaked token can not be reused after it was
+        re-issued.''')
+    
+    speculative_verification = BoolOption('trac-captcha', 'speculative_verification', False,
+        '''Start the captcha verification in a background thread as soon as a
+        form with a captcha solution is posted so the verification overlaps
+        with Trac's own request processing.''')
+    
+    speculative_workers = IntOption('trac-captcha', 'speculative_workers', 4,
+        '''Maximum number of background threads for speculative 
+        verifications. If all threads are busy (and the queue is full), the
+        captcha is verified in the request thread.''')
+    
+    speculative_timeout = FloatOption('trac-captcha', 'speculative_timeout', 10,
+        '''Maximum time (in seconds) to wait for a speculative 
+        verification.''')
+    
+    deferred_loading = BoolOption('trac-captcha', 'deferred_loading', False,
+        '''Only insert a small placeholder and a loader script into the page.
+        The captcha widget (and all its third-party resources) is loaded when 
+        the user starts to interact with the form (focus or input). Visitors 
+        without JavaScript can not solve the captcha in this mode.''')
+    
+    deferred_preconnect = ListOption('trac-captcha', 'deferred_preconnect', 
+        'https://www.google.com, https://www.gstatic.com',
+        doc='''Origins the browser should connect to when the deferred captcha
+        is loaded (resource hints with rel="preconnect").''')
+    
+    widget_endpoint = BoolOption('trac-captcha', 'widget_endpoint', False,
+        '''Serve the captcha widget as a cacheable HTML fragment (/captcha/widget)
+        which pages fetch with a small loader script. Combined with 
+        `deferred_loading` the widget is only fetched when the user starts to
+        interact with the form. Forms which are displayed again after a 
+        submission always contain the captcha inline.''')
+    
+    widget_max_age = IntOption('trac-captcha', 'widget_max_age', 300,
+        '''Number of seconds browsers and reverse proxies may cache the captcha
+        widget fragment.''')
     
     def __init__(self):
         super(TracCaptchaController, self).__init__()
         locale_dir = pkg_resources.resource_filename(__name__, 'locale')
         add_domain(self.env.path, locale_dir)
+        # Trac creates only one controller instance per environment so the 
+        # cache is shared by all threads of the process.
+        self.token_cache = VerifiedTokenCache(maxsize=self.token_cache_size)
+        self._key_ring = None
+        self._provisioned_token_key = None
+        self._replay_store = None
+        # ((token_ttl, cookie_ttl), longest token lifetime)
+        self._max_token_ttl = None
+        # invalid MAC algorithm which was logged already
+        self._reported_mac_algorithm = None
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._health = {}
+        self._health_lock = threading.Lock()
+    
+    # --- IEnvironmentSetupParticipant -----------------------------------------
+    def environment_created(self):
+        self.token_key()
+    
+    def environment_needs_upgrade(self, db):
+        return False
+    
+    def upgrade_environment(self, db):
+        pass
     
     # --- IPermissionRequestor -------------------------------------------------
     def get_permission_actions(self):
@@ -69,44 +284,347 @@ class TracCaptchaController(Component):
             permissions.append(('TICKET_ADMIN', ['CAPTCHA_SKIP']))
         return permissions
     
+    # --- ITemplateProvider ----------------------------------------------------
+    def get_htdocs_dirs(self):
+        return [('trac_captcha', pkg_resources.resource_filename(__name__, 'htdocs'))]
+    
+    def get_templates_dirs(self):
+        return []
+    
     # --- public API -----------------------------------------------------------
-    def should_skip_captcha(self, req):
+    def should_skip_captcha(self, req, scope='*'):
+        """Return True if the user does not need to solve a captcha for the
+        given scope (see `add_token_for_request`). The token which allowed the 
+        user to skip the captcha is remembered in the request so 
+        `burn_pending_token` can mark it as used."""
+        initialize_captcha_data(req)
+        req.captcha_data.pop('pending_token', None)
         if 'CAPTCHA_SKIP' in req.perm:
             self.debug_log('Skipping CAPTCHA for %(path)s because of CAPTCHA_SKIP' % dict(path=req.path_info))
             return True
         captcha_token = req.args.get('__captcha_token')
-        if self.is_token_valid(captcha_token):
+        if self.is_token_valid(captcha_token, scope, purpose='form'):
             self.debug_log('Skipping CAPTCHA for %(path)s because request has valid token %(token)s' % dict(path=req.path_info, token=repr(captcha_token)))
             self.add_token_for_request(req, captcha_token)
+            req.captcha_data['pending_token'] = (captcha_token, 'form')
+            return True
+        cookie_token = self.cookie_token(req)
+        if (cookie_token is not None) and self.is_token_valid(cookie_token, scope, purpose='cookie'):
+            self.debug_log('Skipping CAPTCHA for %(path)s because request has valid cookie %(token)s' % dict(path=req.path_info, token=repr(cookie_token)))
+            req.captcha_data['pending_token'] = (cookie_token, 'cookie')
             return True
         return False
     
-    def check_captcha_solution(self, req):
-        if self.should_skip_captcha(req):
+    def burn_pending_token(self, req):
+        '''Call this after `check_captcha_solution` accepted a submission and
+        the protected action was committed (not for previews or submissions 
+        which failed for other reasons): The token which was used to skip the
+        captcha is marked as used (single use tokens). Tokens with a 
+        submission budget are re-issued with an incremented usage counter, 
+        tokens which are past half of their lifetime are renewed.
+        
+        Returns an error message if a concurrent submission used the same 
+        token already, None otherwise.'''
+        pending = getattr(req, 'captcha_data', {}).pop('pending_token', None)
+        if pending is None:
+            return None
+        captcha_token, source = pending
+        verified_token = self.verified_token(captcha_token)
+        if verified_token is None:
+            return None
+        quota = token_quota(verified_token)
+        # Tokens with a submission budget are always burned (they are 
+        # superseded by the re-issued token), plain cookie tokens are meant to
+        # be used for several forms.
+        burn_token = (quota is not None) or (self.single_use_tokens and (source == 'form'))
+        if burn_token:
+            if not self.replay_store().mark_used(captcha_token, verified_token.expires):
+                self.debug_log('Rejecting captcha token %(token)s because it was used by a concurrent submission' % dict(token=repr(captcha_token)))
+                req.captcha_data.pop('token', None)
+                return _(u'This captcha was already used for another submission. Please solve the captcha again.')
+            if (source == 'form') and (quota is None):
+                # the burned token must not be put in the form again
+                req.captcha_data.pop('token', None)
+        if source == 'cookie':
+            ttl = self.cookie_ttl
+        else:
+            ttl = self.token_ttl_for(token_scope(verified_token))
+        now = int(time.time())
+        expires = verified_token.expires
+        needs_renewal = (expires - now) < (ttl // 2)
+        if needs_renewal:
+            expires = now + ttl
+        if (quota is not None) or (needs_renewal and not burn_token):
+            self.reissue_token(req, verified_token, source, expires)
+        return None
+    
+    def check_captcha_solution(self, req, scope='*'):
+        if self.should_skip_captcha(req, scope):
             return None
         try:
-            self.captcha.assert_captcha_completed(req)
+            self.wait_for_verification(req)
         except CaptchaFailedError, e:
             self.debug_log('Wrong CAPTCHA solution for %(path)s: %(arguments)s' % dict(path=req.path_info, arguments=repr(req.args)))
             req.captcha_data = e.captcha_data
             return e.msg
         self.debug_log('Accepted CAPTCHA solution for %(path)s: %(arguments)s' % dict(path=req.path_info, arguments=repr(req.args)))
-        self.add_token_for_request(req)
+        self.add_token_for_request(req, scope=scope)
+        if self.cookie_ttl > 0:
+            self.set_captcha_cookie(req)
         return None
     
+    def start_speculative_verification(self, req):
+        '''Start the captcha verification in a background thread. The result
+        is used by `check_captcha_solution` later.'''
+        if not self.speculative_verification:
+            return None
+        captcha = self.captcha_for_request(req)
+        has_solution = getattr(captcha, 'has_solution', None)
+        if (has_solution is None) or (not has_solution(req)):
+            return None
+        future = self.executor().submit(self.verify_detached, captcha, DetachedRequest(req))
+        if future is not None:
+            initialize_captcha_data(req)
+            req.captcha_data['verification'] = future
+        return future
+    
+    def wait_for_verification(self, req):
+        future = getattr(req, 'captcha_data', {}).pop('verification', None)
+        if future is None:
+            self.verify_with(self.captcha_for_request(req), req)
+            return
+        try:
+            detached_req = future.result(timeout=self.speculative_timeout)
+        except FutureTimeout:
+            self.env.log.warning('Captcha verification for %s did not finish in time' % req.path_info)
+            raise CaptchaFailedError(_(u'Captcha verification timed out - please try again.'),
+                                     dict(error_code='verification-timeout'))
+        detached_req.apply_to(req)
+    
+    def executor(self):
+        max_workers = self.speculative_workers
+        executor = self._executor
+        if (executor is not None) and (executor.max_workers == max_workers):
+            return executor
+        self._executor_lock.acquire()
+        try:
+            old_executor = self._executor
+            if (old_executor is not None) and (old_executor.max_workers == max_workers):
+                return old_executor
+            executor = BoundedExecutor(max_workers=max_workers, max_pending=4 * max_workers)
+            self._executor = executor
+        finally:
+            self._executor_lock.release()
+        if old_executor is not None:
+            # let the old worker threads finish their work and exit
+            old_executor.shutdown()
+        return executor
+    
+    def verify_detached(self, captcha, detached_req):
+        '''Verify the solution in a worker thread. The DetachedRequest (with
+        cookies set by the captcha) is the result of the future.'''
+        self.verify_with(captcha, detached_req)
+        return detached_req
+    
+    def verify_with(self, captcha, req):
+        '''Verify the captcha solution with the given captcha and record 
+        latency and availability of the captcha.'''
+        start = time.time()
+        failed = True
+        try:
+            try:
+                captcha.assert_captcha_completed(req)
+                failed = False
+            except CaptchaFailedError, e:
+                # wrong solutions do not say anything about the provider
+                failed = (e.captcha_data.get('error_code') in UNAVAILABLE_ERROR_CODES) or \
+                    bool(e.captcha_data.get('circuit_open'))
+                raise
+        finally:
+            self.provider_health(captcha).record(time.time() - start, failed)
+    
+    # --- provider failover ----------------------------------------------------
+    
+    def captcha_chain(self):
+        return list(self.ordered_captchas) or [self.captcha]
+    
+    def provider_name(self, captcha):
+        return captcha.__class__.__name__
+    
+    def provider_health(self, captcha):
+        name = self.provider_name(captcha)
+        self._health_lock.acquire()
+        try:
+            health = self._health.get(name)
+            max_age = self.health_max_age or None
+            if (health is None) or (health.window != self.health_window) or \
+                (health.max_age != max_age):
+                health = ProviderHealth(window=self.health_window, max_age=max_age)
+                self._health[name] = health
+            return health
+        finally:
+            self._health_lock.release()
+    
+    def provider_health_stats(self):
+        '''Return latency (p95) and error rate for all captchas in the 
+        chain.'''
+        stats = {}
+        for captcha in self.captcha_chain():
+            stats[self.provider_name(captcha)] = self.provider_health(captcha).stats()
+        return stats
+    
+    def is_healthy(self, captcha):
+        health = self.provider_health(captcha)
+        if health.nr_samples() < self.failover_min_samples:
+            return True
+        if health.error_rate() >= self.failover_error_rate:
+            return False
+        return (self.failover_p95 <= 0) or (health.p95() <= self.failover_p95)
+    
+    def select_captcha(self):
+        '''Return the first healthy captcha of the chain (or the one with the
+        lowest error rate and latency if none is healthy).'''
+        chain = self.captcha_chain()
+        for captcha in chain:
+            if self.is_healthy(captcha):
+                return captcha
+        candidates = []
+        for index, captcha in enumerate(chain):
+            health = self.provider_health(captcha)
+            candidates.append((health.error_rate(), health.p95() or 0, index, captcha))
+        candidates.sort()
+        return candidates[0][-1]
+    
+    def submitted_captcha(self, req):
+        '''Return the captcha named by the (signed) provider field or None. 
+        The field is not trusted otherwise so users can not pick a captcha 
+        which was skipped.'''
+        provider_token = self.verified_token(req.args.get(PROVIDER_FIELD))
+        if provider_token is None:
+            return None
+        name = token_provider(provider_token)
+        for captcha in self.captcha_chain():
+            if self.provider_name(captcha) == name:
+                return captcha
+        return None
+    
+    def displayed_captcha(self, req):
+        # keep the captcha if the user has to try again (if it is healthy)
+        captcha = self.submitted_captcha(req)
+        if (captcha is None) or (not self.is_healthy(captcha)):
+            captcha = self.select_captcha()
+        return captcha
+    
+    def shared_widget_captcha(self, req):
+        '''Return the captcha named by the widget URL ("provider"). The name
+        only selects what is rendered, submissions are checked against the 
+        signed provider field in the page.'''
+        name = req.args.get('provider')
+        for captcha in self.captcha_chain():
+            if self.provider_name(captcha) == name:
+                return captcha
+        return self.select_captcha()
+    
+    def captcha_for_request(self, req):
+        '''Return the captcha which must verify the submission (the one which
+        was displayed).'''
+        chain = self.captcha_chain()
+        if len(chain) == 1:
+            return chain[0]
+        return self.submitted_captcha(req) or self.select_captcha()
+    
     # Captcha generation / Genshi stream manipulation
     def captcha_html(self, req):
-        return self.captcha.genshi_stream(req)
+        chain = self.captcha_chain()
+        if len(chain) == 1:
+            return chain[0].genshi_stream(req)
+        if is_shared_widget_request(req):
+            # the page contains the provider field (see included_captcha_html)
+            return self.shared_widget_captcha(req).genshi_stream(req)
+        captcha = self.displayed_captcha(req)
+        return tag(captcha.genshi_stream(req), self.provider_tag(captcha)).generate()
     
-    def inject_captcha_into_stream(self, req, stream, transformer):
+    def inject_captcha_into_stream(self, req, stream, transformer, scope='*'):
+        '''Insert the captcha (or the token if the captcha was solved already) 
+        with transformer.before(). 'transformer' is usually a 
+        FirstMatchInjector (see `injector_for`) but a Genshi Transformer 
+        works as well.'''
         initialize_captcha_data(req)
+        if 'token' not in req.captcha_data:
+            self.restore_carried_form_token(req, scope)
         if 'token' in req.captcha_data:
             return stream | transformer.before(self.captcha_token_tag(req))
-        if self.should_skip_captcha(req):
+        if self.should_skip_captcha(req, scope):
             return stream
-        
-        self.debug_log('Displaying captcha for %(path)s' % dict(path=req.path_info))
-        return stream | transformer.before(self.captcha_html(req))
+        if self.deferred_loading or self.uses_widget_endpoint(req):
+            # the captcha is generated lazily, too late for the <head> of the 
+            # page (Trac < 1.0)
+            add_script(req, LOADER_SCRIPT)
+        return stream | transformer.before(self.lazy_captcha_html(req))
+    
+    def lazy_captcha_html(self, req):
+        '''Return a callable which generates the captcha only when the 
+        transformer's selector matched (e.g. not for read-only pages without
+        a form). Later matches get the same (consumed) stream so the captcha
+        is only inserted once.'''
+        generated = []
+        def captcha_html():
+            if not generated:
+                self.debug_log('Displaying captcha for %(path)s' % dict(path=req.path_info))
+                if self.uses_widget_endpoint(req):
+                    html = self.included_captcha_html(req)
+                else:
+                    html = self.captcha_html(req)
+                    if self.deferred_loading:
+                        html = self.deferred_captcha_html(req, html)
+                generated.append(html)
+            return generated[0]
+        return captcha_html
+    
+    def uses_widget_endpoint(self, req):
+        return self.widget_endpoint and (req.method != 'POST')
+    
+    def deferred_captcha_html(self, req, html):
+        '''Return a placeholder and a loader script which mounts the captcha 
+        'html' when the user starts to interact with the form. If the form was
+        submitted already (e.g. wrong solution) the captcha is loaded 
+        immediately.'''
+        return deferred_captcha_tag(html, self.placeholder_id(req), 
+                                    preconnect=self.deferred_preconnect, 
+                                    immediate=(req.method == 'POST'))
+    
+    def included_captcha_html(self, req):
+        '''Return a placeholder and a loader script which fetches the captcha
+        from the (cacheable) widget endpoint. The fragment is shared by all 
+        users so everything it depends on (language, displayed captcha) is 
+        part of the URL and the signed provider field stays in the page.'''
+        params = []
+        if getattr(req, 'locale', None) is not None:
+            params.append(('lang', str(req.locale)))
+        provider_tag = None
+        if len(self.captcha_chain()) > 1:
+            captcha = self.displayed_captcha(req)
+            params.append(('provider', self.provider_name(captcha)))
+            provider_tag = self.provider_tag(captcha)
+        loader = included_captcha_tag(req.href(WIDGET_PATH, params), self.placeholder_id(req),
+                                      preconnect=self.deferred_preconnect, 
+                                      immediate=not self.deferred_loading)
+        if provider_tag is None:
+            return loader
+        return tag(loader, provider_tag)
+    
+    def placeholder_id(self, req):
+        initialize_captcha_data(req)
+        nr_widgets = req.captcha_data.get('deferred_widgets', 0) + 1
+        req.captcha_data['deferred_widgets'] = nr_widgets
+        return 'trac-captcha-%d' % nr_widgets
+    
+    def provider_token(self, captcha):
+        return self.key_ring().generate_token(claims=provider_claim(self.provider_name(captcha)))
+    
+    def provider_tag(self, captcha):
+        return tag.input(type='hidden', name=PROVIDER_FIELD, 
+                         value=self.provider_token(captcha))
     
     def captcha_token_tag(self, req):
         token = req.captcha_data['token']
@@ -114,23 +632,255 @@ class TracCaptchaController(Component):
     
     # --- private API ----------------------------------------------------------
     
-    def add_token_for_request(self, req, token=None):
+    def add_token_for_request(self, req, token=None, scope='*'):
+        """Put a captcha token in the request so the user does not need to
+        solve another captcha when the form is displayed again. New tokens are
+        only valid for the given scope: '*' (all forms), a realm (e.g. 
+        'registration') or a realm and a resource id (e.g. 'ticket:1234')."""
         if token is None:
-            token = CryptoBox(self.token_key()).generate_token()
+            token = self.key_ring().generate_token(ttl=self.token_ttl_for(scope),
+                                                   claims=self.new_token_claims(scope, 'form'))
         initialize_captcha_data(req)
         req.captcha_data['token'] = token
     
+    def new_token_claims(self, scope='*', purpose='form'):
+        claims = scope_claim(scope)
+        claims.update(purpose_claim(purpose))
+        if self.token_submission_budget > 0:
+            claims.update(quota_claim(min(self.token_submission_budget, 0xffff)))
+        return claims
+    
+    def reissue_token(self, req, verified_token, source, expires):
+        claims = dict(verified_token.claims)
+        quota = token_quota(verified_token)
+        if quota is not None:
+            budget, used = quota
+            used += 1
+            if (used >= budget) and (source == 'form'):
+                # the user has to solve a new captcha for the next submission
+                req.captcha_data.pop('token', None)
+                return
+            # Exhausted cookie tokens are re-issued as well so the browser 
+            # does not keep the old token.
+            claims.update(quota_claim(budget, used))
+        claims.update(purpose_claim(source))
+        new_token = self.key_ring().generate_token(claims=claims, expires=expires)
+        if source == 'cookie':
+            self.set_captcha_cookie(req, new_token, expires - int(time.time()))
+        else:
+            self.add_token_for_request(req, new_token)
+            self.carry_form_token(req, new_token)
+    
+    def carry_form_token(self, req, token):
+        '''Most forms redirect after a successful submission so the new token
+        in req.captcha_data would be lost. The token is put in a short-lived
+        cookie and restored when the next form is displayed.'''
+        ttl = min(FORM_TOKEN_COOKIE_TTL, self.token_expiration(token) - int(time.time()))
+        self.set_cookie(req, FORM_TOKEN_COOKIE_NAME, token, ttl)
+    
+    def restore_carried_form_token(self, req, scope):
+        cookie = req.incookie.get(FORM_TOKEN_COOKIE_NAME)
+        if (cookie is None) or (not self.is_token_valid(cookie.value, scope, purpose='form')):
+            return
+        self.add_token_for_request(req, cookie.value)
+        # the token is in the form now, the browser does not need to send it 
+        # again
+        self.set_cookie(req, FORM_TOKEN_COOKIE_NAME, '', -1)
+    
+    def token_ttl_for(self, scope):
+        '''Return the lifetime of new tokens for the given scope 
+        (`token_ttl.<realm>` or `token_ttl`).'''
+        if scope == '*':
+            return self.token_ttl
+        option_name = 'token_ttl.' + scope_realm(scope)
+        return self.config.getint('trac-captcha', option_name, self.token_ttl)
+    
+    def max_token_ttl(self):
+        '''Return the longest lifetime of all tokens. The per-realm lifetimes
+        are only looked up again if `token_ttl` or `cookie_ttl` changed 
+        (Trac reloads the environment anyway when trac.ini was modified).'''
+        key = (self.token_ttl, self.cookie_ttl)
+        cached = self._max_token_ttl
+        if (cached is not None) and (cached[0] == key):
+            return cached[1]
+        ttls = list(key)
+        for name, value in self.config.options('trac-captcha'):
+            if name.startswith('token_ttl.'):
+                ttls.append(self.config.getint('trac-captcha', name))
+        max_ttl = max(ttls)
+        self._max_token_ttl = (key, max_ttl)
+        return max_ttl
+    
+    def cookie_token(self, req):
+        if self.cookie_ttl <= 0:
+            return None
+        cookie = req.incookie.get(CAPTCHA_COOKIE_NAME)
+        if cookie is None:
+            return None
+        return cookie.value
+    
+    def set_captcha_cookie(self, req, token=None, ttl=None):
+        if ttl is None:
+            ttl = self.cookie_ttl
+        if token is None:
+            token = self.key_ring().generate_token(ttl=ttl, claims=self.new_token_claims(purpose='cookie'))
+        self.set_cookie(req, CAPTCHA_COOKIE_NAME, token, ttl)
+    
+    def set_cookie(self, req, name, value, ttl):
+        req.outcookie[name] = value
+        cookie = req.outcookie[name]
+        cookie['path'] = req.base_path or '/'
+        cookie['expires'] = ttl
+        if req.scheme == 'https':
+            cookie['secure'] = True
+        try:
+            cookie['httponly'] = True
+        except CookieError:
+            # Python < 2.6
+            pass
+    
     def token_key(self):
         '''Return the private token key stored in trac.ini. If no such key was
-        set, a new one will be generated.'''
-        if self.stored_token_key in ('', None):
+        set, the generated key from the database is used (a new key will be
+        stored if necessary).'''
+        if self.stored_token_key not in ('', None):
+            return str(self.stored_token_key)
+        if self._provisioned_token_key is None:
             new_key = CryptoBox().generate_key()
-            self.env.config.set('trac-captcha', 'token_key', new_key)
-            self.env.config.save()
-        return str(self.stored_token_key)
+            self._provisioned_token_key = provision_token_key(self.env, new_key)
+        return self._provisioned_token_key
+    
+    def retired_token_keys(self):
+        return parse_retired_keys(self.stored_retired_token_keys, log=self.env.log)
+    
+    def key_ring(self):
+        '''Return the (immutable) KeyRing for the current token keys. The ring
+        is only rebuilt if the token keys were changed.'''
+        token_key = self.token_key()
+        retired_keys = tuple(self.retired_token_keys())
+        accept_legacy_tokens = self.accept_legacy_tokens
+        mac_engine = self.mac_engine()
+        key_ring = self._key_ring
+        if (key_ring is None) or (key_ring.active.key != token_key) or \
+            (key_ring.retired_keys != retired_keys) or \
+            (key_ring.accept_legacy_tokens != accept_legacy_tokens) or \
+            (key_ring.mac_engine is not mac_engine):
+            key_ring = KeyRing(token_key, retired_keys, 
+                               accept_legacy_tokens=accept_legacy_tokens,
+                               mac_engine=mac_engine)
+            # assigning an attribute is atomic so no locking is necessary, 
+            # in the worst case some threads build a key ring at the same time
+            self._key_ring = key_ring
+        return key_ring
+    
+    def mac_engine(self):
+        if not self.mac_algorithm:
+            return default_mac_engine()
+        engine = mac_engine_by_name(self.mac_algorithm)
+        if engine is None:
+            # key_ring() is called for every request so warn only once
+            if self._reported_mac_algorithm != self.mac_algorithm:
+                self._reported_mac_algorithm = self.mac_algorithm
+                self.env.log.warning('MAC algorithm %r for captcha tokens is not available' % self.mac_algorithm)
+            return default_mac_engine()
+        return engine
+    
+    def rotate_token_key(self, grace_period=None, now=None):
+        '''Generate a new token key. The old key will still be able to verify
+        tokens for 'grace_period' seconds (default: token lifetime). Retired
+        keys which are past their retirement time are removed.'''
+        if grace_period is None:
+            grace_period = self.max_token_ttl()
+        if now is None:
+            now = int(time.time())
+        old_key = self.token_key()
+        retired_keys = [(old_key, now + grace_period)]
+        for key, retire_at in self.retired_token_keys():
+            if retire_at >= now:
+                retired_keys.append((key, retire_at))
+        new_key = CryptoBox().generate_key()
+        self.env.config.set('trac-captcha', 'token_key', new_key)
+        self.env.config.set('trac-captcha', 'retired_token_keys', 
+                            serialize_retired_keys(retired_keys))
+        self.env.config.save()
+        return new_key
+    
+    def verified_token(self, a_token):
+        '''Return the unpacked Token if the token was signed by a valid key 
+        and did not expire yet, None otherwise.'''
+        key_ring = self.key_ring()
+        verified_token = self.token_cache.lookup(key_ring.identity, a_token)
+        if verified_token is not None:
+            return verified_token
+        verified_token = key_ring.verify(a_token)
+        if (verified_token is None) or (verified_token.expires < time.time()):
+            return None
+        self.token_cache.remember(key_ring.identity, a_token, 
+                                  verified_token.expires, verified_token)
+        return verified_token
+    
+    def token_expiration(self, a_token):
+        verified_token = self.verified_token(a_token)
+        if verified_token is None:
+            return None
+        return verified_token.expires
+    
+    def is_token_valid(self, a_token, scope='*', purpose='form'):
+        '''Return True if the token allows the user to skip the captcha. 
+        'purpose' is where the token was presented ('form' or 'cookie'): form
+        tokens are burned after use (single use tokens) so a cookie must not 
+        accept them (and vice versa).'''
+        verified_token = self.verified_token(a_token)
+        if verified_token is None:
+            return False
+        if not self.is_purpose_valid(token_purpose(verified_token), purpose):
+            self.debug_log('Rejecting captcha token %(token)s because it is not valid as %(purpose)s token' % dict(token=repr(a_token), purpose=purpose))
+            return False
+        if not scope_matches(token_scope(verified_token), scope):
+            self.debug_log('Rejecting captcha token %(token)s because it is not valid for %(scope)s' % dict(token=repr(a_token), scope=scope))
+            return False
+        if token_score(verified_token) is not None:
+            self.debug_log('Rejecting captcha token %(token)s because it only caches a score' % dict(token=repr(a_token)))
+            return False
+        quota = token_quota(verified_token)
+        if (quota is not None) and (quota[1] >= quota[0]):
+            self.debug_log('Rejecting captcha token %(token)s because its submission budget is exhausted' % dict(token=repr(a_token)))
+            return False
+        if (self.single_use_tokens or (quota is not None)) and \
+            self.replay_store().was_used(a_token, verified_token.expires):
+            self.debug_log('Rejecting captcha token %(token)s because it was already used' % dict(token=repr(a_token)))
+            return False
+        return True
+    
+    def is_purpose_valid(self, token_purpose, purpose):
+        if token_purpose is None:
+            # tokens of older versions were only used in forms
+            return (purpose == 'form')
+        return (token_purpose == purpose)
+    
+    def replay_store(self):
+        filename = self.replay_store_file or \
+            os.path.join(self.env.path, 'db', 'captcha-replay.bloom')
+        max_ttl = self.max_token_ttl()
+        # the buckets must cover the longest token lifetime, long lifetimes 
+        # use larger buckets so the number of buckets stays small
+        bucket_seconds = max(3600, -(-max_ttl // 24))
+        # one additional bucket so the oldest bucket can be reset while
+        # tokens in all other buckets are still valid
+        nr_buckets = -(-max_ttl // bucket_seconds) + 2
+        bucket_size = max(1024, (self.replay_store_size * 1024) // nr_buckets)
+        store = self._replay_store
+        if (store is None) or (store.filename != filename) or \
+            (store.bucket_seconds != bucket_seconds) or \
+            (store.nr_buckets != nr_buckets) or (store.bucket_size != bucket_size):
+            store = BloomReplayStore(filename, bucket_seconds=bucket_seconds,
+                nr_buckets=nr_buckets, bucket_size=bucket_size)
+            self._replay_store = store
+        return store
     
-    def is_token_valid(self, a_token):
-        return CryptoBox(self.token_key()).is_token_valid(a_token)
+    def token_cache_stats(self):
+        '''Return hit/miss/eviction counters of the verified token cache.'''
+        return self.token_cache.stats()
     
     def debug_log(self, message):
         self.env.log.debug(message)
@@ -22,89 +22,193 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import hexlify
 from datetime import datetime, timedelta
 from hmac import HMAC
-import re
-import sys
+import struct
+import time
 
 from trac.util import hex_entropy
-from trac.util.datefmt import localtz, to_timestamp, utc
+from trac.util.datefmt import localtz, to_timestamp
 
-__all__ = ['CryptoBox']
+from trac_captcha.claims import pack_claims, unpack_claims
+from trac_captcha.mac import available_mac_engines, best_hash_algorithm, \
+    compare_digest, default_mac_engine, mac_engine_by_id, HMACEngine, MAC_SIZE
 
+__all__ = ['CryptoBox', 'TokenVerifier']
 
-class AlgorithmWrapper(object):
-    def __init__(self, algorithm):
+
+# Binary token format (version 3), base64url-encoded without padding:
+#   version (1 byte), MAC algorithm (1 byte), key id (4 bytes), 
+#   expiration as UNIX timestamp (4 bytes), optional claims, 
+#   truncated MAC over all previous bytes (16 bytes)
+# Version 2 tokens lack the algorithm byte (always HMAC).
+TOKEN_VERSION = 3
+TOKEN_HEADER = '>BBII'
+TOKEN_HEADER_SIZE = struct.calcsize(TOKEN_HEADER)
+V2_TOKEN_HEADER = '>BII'
+V2_TOKEN_HEADER_SIZE = struct.calcsize(V2_TOKEN_HEADER)
+KEY_ID_MESSAGE = 'trac-captcha key id'
+
+
+class Token(object):
+    def __init__(self, version, algorithm, key_id, expires, claims, body, mac):
+        self.version = version
         self.algorithm = algorithm
-        self.digest_size = self.algorithm().digest_size
-    
-    def new(self, *args, **kwargs):
-        return self.algorithm(*args, **kwargs)
+        self.key_id = key_id
+        self.expires = expires
+        self.claims = claims
+        self.body = body
+        self.mac = mac
+
+
+def is_legacy_token(token):
+    return hasattr(token, 'split') and ('||' in token)
+
+def encode_token(data):
+    return urlsafe_b64encode(data).rstrip('=')
+
+def unpack_token(token):
+    """Return a Token instance for the given (version 2 or 3) token string or
+    None if the string can not be parsed. The signature is not checked!"""
+    if not hasattr(token, 'encode'):
+        return None
+    try:
+        token = token.encode('ascii')
+        data = urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    except (TypeError, ValueError):
+        return None
+    if len(data) < V2_TOKEN_HEADER_SIZE + MAC_SIZE:
+        return None
+    body, mac = data[:-MAC_SIZE], data[-MAC_SIZE:]
+    version = ord(data[0])
+    if version == TOKEN_VERSION and len(body) >= TOKEN_HEADER_SIZE:
+        header_size = TOKEN_HEADER_SIZE
+        version, algorithm, key_id, expires = struct.unpack(TOKEN_HEADER, body[:header_size])
+    elif version == 2:
+        header_size = V2_TOKEN_HEADER_SIZE
+        version, key_id, expires = struct.unpack(V2_TOKEN_HEADER, body[:header_size])
+        algorithm = HMACEngine.algorithm_id
+    else:
+        return None
+    claims = unpack_claims(body[header_size:])
+    if claims is None:
+        return None
+    return Token(version, algorithm, key_id, expires, claims, body, mac)
 
 
 class CryptoBox(object):
     
-    def __init__(self, key=None):
+    # seconds
+    token_lifetime = 4 * 60 * 60
+    
+    def __init__(self, key=None, accept_legacy_tokens=True, mac_engine=None):
         self.key = key
-        self.hash_algorithm = None
+        # version 1 tokens ("<timestamp>||<hex hmac>") are still accepted so
+        # that tokens issued before an upgrade remain valid.
+        self.accept_legacy_tokens = accept_legacy_tokens
+        # engine used to sign new tokens, all available engines can verify 
+        # tokens
+        self.mac_engine = mac_engine or default_mac_engine()
     
     def generate_key(self):
         return hex_entropy(32)
     
-    def generate_token(self):
-        message = self.token_payload()
-        return message + '||' + self.sign_message(message)
+    def generate_token(self, ttl=None, claims=None, expires=None):
+        if expires is None:
+            if ttl is None:
+                ttl = self.token_lifetime
+            expires = int(time.time()) + ttl
+        algorithm = self.mac_engine.algorithm_id
+        body = struct.pack(TOKEN_HEADER, TOKEN_VERSION, algorithm, self.key_id(), expires)
+        body += pack_claims(claims)
+        return encode_token(body + self.mac(body, algorithm))
     
     def is_token_valid(self, token):
-        if not self.is_syntactically_valid_token(token):
-            return False
-        message, hash = self.parse_token(token)
-        if not self.is_correct_hash(hash, message):
+        valid_until = self.token_expiration(token)
+        if valid_until is None:
             return False
-        return self.token_is_valid_until(message) >= datetime.now(localtz)
+        return valid_until >= int(time.time())
+    
+    def token_expiration(self, token):
+        """Return the expiration time of the given token as UNIX timestamp or
+        None if the token was not signed with this key (or is garbage)."""
+        token = self.verify(token)
+        if token is None:
+            return None
+        return token.expires
+    
+    def verify(self, token):
+        """Return the unpacked Token if its signature is valid (expiration
+        is not checked), None otherwise."""
+        if is_legacy_token(token):
+            if not self.accept_legacy_tokens:
+                return None
+            return self.verify_legacy_token(token)
+        return self.verify_unpacked(unpack_token(token))
+    
+    def verify_unpacked(self, token):
+        if (token is None) or (token.key_id != self.key_id()):
+            return None
+        expected_mac = self.mac(token.body, token.algorithm)
+        if (expected_mac is None) or (not compare_digest(expected_mac, token.mac)):
+            return None
+        return token
+    
+    def key_id(self):
+        return struct.unpack('>I', self.digest(KEY_ID_MESSAGE)[:4])[0]
     
     # --- private API ----------------------------------------------------------
     
     def best_hash_algorithm(self):
-        if self.hash_algorithm is not None:
-            return self.hash_algorithm
-        # see #33, distros shipping hashlib for Python 2.4 use a version 
-        # prior to the one shipped in Python 2.5. The older hashlib always
-        # try to call '.new()' on the algorithm class which leads to an 
-        # exception like this:
-        #  File "/usr/lib64/python2.4/hmac.py", line 42, in __init__
-        #    self.outer = digestmod.new()
-        # AttributeError: 'builtin_function_or_method' object has no attribute 'new'
-        try:
-            from hashlib import sha512
-            self.hash_algorithm = sha512
-            if sys.version_info[0:2] <= (2,4):
-                self.hash_algorithm = AlgorithmWrapper(sha512)
-            return self.hash_algorithm
-        except ImportError:
-            pass
-        # no new hashlib, try pycrypto's sha256
-        try:
-            from Crypto.Hash import SHA256
-            self.hash_algorithm = SHA256
-            return SHA256
-        except ImportError:
-            pass
-        # fall back to sha1
-        import sha
-        self.hash_algorithm = sha
-        return sha
+        return best_hash_algorithm()
     
-    def sign_message(self, message):
+    def digest(self, message):
         if self.key is None:
             self.key = self.generate_key()
-        return HMAC(self.key, message, digestmod=self.best_hash_algorithm()).hexdigest()
+        return HMAC(self.key, message, digestmod=self.best_hash_algorithm()).digest()
+    
+    def keyed_state(self, algorithm):
+        engine = mac_engine_by_id(algorithm)
+        if engine is None:
+            return None
+        if self.key is None:
+            self.key = self.generate_key()
+        return engine.keyed_state(self.key)
+    
+    def mac(self, message, algorithm):
+        """Return the MAC for the message or None if the algorithm is not 
+        available."""
+        state = self.keyed_state(algorithm)
+        if state is None:
+            return None
+        state = state.copy()
+        state.update(message)
+        return state.digest()[:MAC_SIZE]
+    
+    # --- version 1 tokens -----------------------------------------------------
+    
+    def sign_message(self, message):
+        return hexlify(self.digest(message))
     
     def token_payload(self, valid_until=None):
         if valid_until is None:
-            valid_until = datetime.now(localtz) + timedelta(hours=4)
+            valid_until = datetime.now(localtz) + timedelta(seconds=self.token_lifetime)
         return str(to_timestamp(valid_until))
     
+    def verify_legacy_token(self, token):
+        if not self.is_syntactically_valid_token(token):
+            return None
+        message, hash = self.parse_token(token)
+        try:
+            message = str(message)
+        except UnicodeError:
+            return None
+        if (not message.isdigit()) or (not self.is_correct_hash(hash, message)):
+            return None
+        return Token(1, HMACEngine.algorithm_id, None, int(message), {}, message, hash)
+    
     def is_syntactically_valid_token(self, token):
         if not hasattr(token, 'split'):
             return False
@@ -113,15 +217,42 @@ class CryptoBox(object):
             return False
         return True
     
-    def token_is_valid_until(self, timestamp):
-        if re.search('\D', timestamp) is not None:
-            return datetime.fromtimestamp(0, utc)
-        return datetime.fromtimestamp(int(timestamp), utc)
-    
     def parse_token(self, token):
         return token.split('||', 1)
     
     def is_correct_hash(self, hash, message):
-        return hash == self.sign_message(message)
+        if not hasattr(hash, 'encode'):
+            return False
+        try:
+            hash = hash.encode('ascii')
+        except UnicodeError:
+            return False
+        return compare_digest(self.sign_message(message), hash)
+
 
+class TokenVerifier(CryptoBox):
+    """CryptoBox for a fixed key which can be shared between threads.
+    
+    The key setup for all MAC algorithms (e.g. HMAC padding and inner/outer
+    digest initialization) is done only once, signing a message just copies
+    the pre-keyed state."""
+    
+    def __init__(self, key, accept_legacy_tokens=True, mac_engine=None):
+        super(TokenVerifier, self).__init__(key, accept_legacy_tokens=accept_legacy_tokens,
+                                            mac_engine=mac_engine)
+        self._keyed_states = {}
+        for engine in available_mac_engines():
+            self._keyed_states[engine.algorithm_id] = engine.keyed_state(key)
+        self._key_id = super(TokenVerifier, self).key_id()
+    
+    def key_id(self):
+        return self._key_id
+    
+    def digest(self, message):
+        hmac = self._keyed_states[HMACEngine.algorithm_id].copy()
+        hmac.update(message)
+        return hmac.digest()
+    
+    def keyed_state(self, algorithm):
+        return self._keyed_states.get(algorithm)
 
@@ -0,0 +1,72 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from genshi.builder import tag
+from genshi.core import Markup, Stream
+
+from trac_captcha.injection import content_events
+
+__all__ = ['deferred_captcha_tag', 'included_captcha_tag', 'js_literal', 
+           'LOADER_SCRIPT', 'render_events']
+
+
+# path of htdocs/deferred.js (see TracCaptchaController.get_htdocs_dirs) which
+# loads the widgets, the page only contains the configuration of each widget.
+LOADER_SCRIPT = 'trac_captcha/deferred.js'
+
+
+def js_literal(value):
+    """Return 'value' as a JavaScript string literal which is safe to use 
+    inside a <script> element."""
+    replacements = (('\\', '\\\\'), ("'", "\\'"), ('\n', '\\n'), ('\r', '\\r'),
+                    ('<', '\\x3c'), (u'\u2028', '\\u2028'), (u'\u2029', '\\u2029'))
+    for old, new in replacements:
+        value = value.replace(old, new)
+    return "'%s'" % value
+
+def render_events(content):
+    """Serialize 'content' (see `content_events`) to a unicode string."""
+    return Stream(list(content_events(content))).render('xhtml', encoding=None)
+
+def loader_tag(function_name, element_id, source, preconnect, immediate):
+    origins = ', '.join([js_literal(origin) for origin in preconnect])
+    loader_call = '(window.TracCaptchaDeferredQueue = window.TracCaptchaDeferredQueue || [])' + \
+        ".push(['%s', %s, %s, [%s], %s]);" % (function_name, js_literal(element_id), 
+        js_literal(source), origins, (immediate and 'true' or 'false'))
+    placeholder = tag.div(id=element_id, class_='trac-captcha-deferred')
+    loader = tag.script(Markup(loader_call), type='text/javascript')
+    return tag(placeholder, loader)
+
+def deferred_captcha_tag(widget, element_id, preconnect=(), immediate=False):
+    """Return a placeholder element and the loader script which mounts 
+    'widget' when the surrounding form receives focus or input (or directly 
+    if 'immediate' is True). The browser opens connections to the origins in
+    'preconnect' at that point so the widget's resources load faster."""
+    return loader_tag('watch', element_id, render_events(widget), preconnect, 
+                      immediate)
+
+def included_captcha_tag(url, element_id, preconnect=(), immediate=False):
+    """Like `deferred_captcha_tag` but the loader fetches the widget markup 
+    from 'url' (a cacheable HTML fragment)."""
+    return loader_tag('include', element_id, url, preconnect, immediate)
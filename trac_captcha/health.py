@@ -0,0 +1,94 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import math
+import threading
+import time
+
+__all__ = ['ProviderHealth']
+
+
+class ProviderHealth(object):
+    """Rolling latency and error statistics for the last 'window' 
+    verifications of a captcha provider.
+    
+    Samples older than 'max_age' seconds are ignored: Verifications are only
+    recorded for captchas which are displayed so an unhealthy provider must 
+    be tried again after some time to recover."""
+    
+    def __init__(self, window=100, max_age=None, clock=None):
+        self.window = window
+        self.max_age = max_age
+        self.clock = clock or time.time
+        # ring buffer of (timestamp, latency in seconds, failed)
+        self._samples = []
+        self._position = 0
+        self._lock = threading.Lock()
+    
+    def record(self, latency, failed=False):
+        self._lock.acquire()
+        try:
+            sample = (self.clock(), latency, bool(failed))
+            if len(self._samples) < self.window:
+                self._samples.append(sample)
+            else:
+                self._samples[self._position] = sample
+            self._position = (self._position + 1) % self.window
+        finally:
+            self._lock.release()
+    
+    def recent_samples(self):
+        samples = list(self._samples)
+        if self.max_age is None:
+            return samples
+        oldest = self.clock() - self.max_age
+        return [sample for sample in samples if sample[0] >= oldest]
+    
+    def nr_samples(self):
+        return len(self.recent_samples())
+    
+    def error_rate(self):
+        samples = self.recent_samples()
+        if not samples:
+            return 0.0
+        nr_failed = len([sample for sample in samples if sample[2]])
+        return float(nr_failed) / len(samples)
+    
+    def latency_percentile(self, percentile):
+        """Return the latency (nearest rank) for the given percentile (0-100)
+        or None if there are no samples."""
+        latencies = [sample[1] for sample in self.recent_samples()]
+        if not latencies:
+            return None
+        latencies.sort()
+        rank = int(math.ceil(percentile / 100.0 * len(latencies)))
+        return latencies[max(rank, 1) - 1]
+    
+    def p95(self):
+        return self.latency_percentile(95)
+    
+    def stats(self):
+        return dict(samples=self.nr_samples(), error_rate=self.error_rate(), 
+                    p95=self.p95())
+
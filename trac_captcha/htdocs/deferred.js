@@ -0,0 +1,141 @@
+// Loads the captcha widget when the user starts to interact with the form 
+// (the markup is either embedded or fetched from a URL, e.g. /captcha/widget).
+// Scripts in the widget are executed in document order and document.write()
+// (used by reCAPTCHA's challenge script) inserts its output after the calling
+// script. Must run in old browsers so it is plain ES3.
+window.TracCaptchaDeferred = window.TracCaptchaDeferred || (function() {
+    var queue = [], busy = false;
+    var INTERACTION_EVENTS = ['focus', 'input', 'keydown', 'mousedown', 'touchstart'];
+    
+    function toArray(list) {
+        var items = [];
+        for (var i = 0; i < list.length; i++) { items.push(list[i]); }
+        return items;
+    }
+    function listen(node, name, handler, enable) {
+        if (node.addEventListener) {
+            var method = enable ? 'addEventListener' : 'removeEventListener';
+            node[method](name, handler, true);
+        } else if (node.attachEvent) {
+            name = 'on' + ((name == 'focus') ? 'focusin' : name);
+            enable ? node.attachEvent(name, handler) : node.detachEvent(name, handler);
+        }
+    }
+    function addResourceHints(origins) {
+        var head = document.getElementsByTagName('head')[0];
+        for (var i = 0; head && (i < origins.length); i++) {
+            var link = document.createElement('link');
+            link.rel = 'preconnect';
+            link.href = origins[i];
+            head.appendChild(link);
+        }
+    }
+    function runScripts(scripts, done) {
+        if (!scripts.length) { done(); return; }
+        var inert = scripts.shift();
+        var script = document.createElement('script');
+        var written = [], finished = false;
+        var originalWrite = document.write, originalWriteln = document.writeln;
+        function finish() {
+            if (finished) { return; }
+            finished = true;
+            document.write = originalWrite;
+            document.writeln = originalWriteln;
+            insertHTML(written.join(''), script.parentNode, script.nextSibling, function() {
+                runScripts(scripts, done);
+            });
+        }
+        document.write = function() { written.push(toArray(arguments).join('')); };
+        document.writeln = function() { written.push(toArray(arguments).join('') + '\n'); };
+        script.type = 'text/javascript';
+        if (inert.src) {
+            script.onload = script.onerror = finish;
+            script.onreadystatechange = function() {
+                if (/loaded|complete/.test(script.readyState)) { finish(); }
+            };
+            script.src = inert.src;
+            inert.parentNode.replaceChild(script, inert);
+        } else {
+            script.text = inert.text;
+            inert.parentNode.replaceChild(script, inert);
+            finish();
+        }
+    }
+    // scripts inserted with innerHTML are not executed so they are replaced
+    // by new script elements
+    function insertHTML(html, parent, reference, done) {
+        if (!html) { done(); return; }
+        var holder = document.createElement('div');
+        holder.innerHTML = html;
+        var scripts = toArray(holder.getElementsByTagName('script'));
+        while (holder.firstChild) {
+            parent.insertBefore(holder.firstChild, reference);
+        }
+        runScripts(scripts, done);
+    }
+    function fetch(url, done) {
+        var request = window.XMLHttpRequest ? new XMLHttpRequest() : 
+                                              new ActiveXObject('Microsoft.XMLHTTP');
+        request.open('GET', url, true);
+        request.onreadystatechange = function() {
+            if (request.readyState != 4) { return; }
+            done((request.status == 200) ? request.responseText : '');
+        };
+        request.send(null);
+    }
+    function next() {
+        var item = queue.shift();
+        if (!item) { busy = false; return; }
+        busy = true;
+        addResourceHints(item.origins);
+        if (item.url) {
+            fetch(item.url, function(html) {
+                insertHTML(html, item.placeholder, null, next);
+            });
+        } else {
+            insertHTML(item.html, item.placeholder, null, next);
+        }
+    }
+    function load(item) {
+        if (item.loaded) { return; }
+        item.loaded = true;
+        queue.push(item);
+        if (!busy) { next(); }
+    }
+    function defer(item, immediate) {
+        var form = item.placeholder;
+        while (form && (form.nodeName.toLowerCase() != 'form')) {
+            form = form.parentNode;
+        }
+        if (immediate || !form) { load(item); return; }
+        function start() {
+            for (var i = 0; i < INTERACTION_EVENTS.length; i++) {
+                listen(form, INTERACTION_EVENTS[i], start, false);
+            }
+            load(item);
+        }
+        for (var i = 0; i < INTERACTION_EVENTS.length; i++) {
+            listen(form, INTERACTION_EVENTS[i], start, true);
+        }
+    }
+    function watch(id, html, origins, immediate) {
+        defer({placeholder: document.getElementById(id), html: html, 
+               origins: origins, loaded: false}, immediate);
+    }
+    function include(id, url, origins, immediate) {
+        defer({placeholder: document.getElementById(id), url: url, 
+               origins: origins, loaded: false}, immediate);
+    }
+    var api = {watch: watch, include: include};
+    // pages register their widgets with 
+    //     (window.TracCaptchaDeferredQueue = window.TracCaptchaDeferredQueue || []).push([...])
+    // so it does not matter if this script is loaded before or after them.
+    var pending = window.TracCaptchaDeferredQueue || [];
+    window.TracCaptchaDeferredQueue = {push: function(call) {
+        api[call[0]].apply(api, call.slice(1));
+    }};
+    for (var i = 0; i < pending.length; i++) {
+        window.TracCaptchaDeferredQueue.push(pending[i]);
+    }
+    return api;
+})();
@@ -0,0 +1,95 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+
+from genshi.core import START, TEXT
+from genshi.path import Path
+
+__all__ = ['FirstMatchInjector', 'injector_for']
+
+
+def content_events(content):
+    """Return the Genshi events for 'content' which can be a builder tag, a 
+    string, an iterable of events (e.g. a Stream) or a callable which returns 
+    one of these."""
+    if hasattr(content, 'generate'):
+        return content.generate()
+    if isinstance(content, basestring):
+        return [(TEXT, content, (None, -1, -1))]
+    if hasattr(content, '__call__'):
+        return content_events(content())
+    return content
+
+
+class FirstMatchInjector(object):
+    """Stream filter with a Transformer-like API (only before()) which 
+    inserts content before the first element matching the XPath 'path'. 
+    Unlike a Transformer it does not mark every event of the page: after the 
+    first match all remaining events are passed through untouched.
+    
+        stream | FirstMatchInjector('//div[@class="buttons"]').before(content)
+    """
+    
+    def __init__(self, path):
+        self.path = Path(path)
+    
+    def before(self, content):
+        path = self.path
+        def inject_before_first_match(stream):
+            test = path.test()
+            namespaces, variables = {}, {}
+            stream = iter(stream)
+            for event in stream:
+                # the path needs all events (e.g. to track the nesting level)
+                matched = test(event, namespaces, variables)
+                if matched and (event[0] is START):
+                    for content_event in content_events(content):
+                        yield content_event
+                    yield event
+                    for event in stream:
+                        yield event
+                    return
+                yield event
+        return inject_before_first_match
+
+
+_injectors = {}
+_injectors_lock = threading.Lock()
+
+def injector_for(selector):
+    """Return a (shared) FirstMatchInjector for the given XPath selector so 
+    the path is only compiled once per process."""
+    injector = _injectors.get(selector)
+    if injector is None:
+        _injectors_lock.acquire()
+        try:
+            injector = _injectors.get(selector)
+            if injector is None:
+                injector = FirstMatchInjector(selector)
+                _injectors[selector] = injector
+        finally:
+            _injectors_lock.release()
+    return injector
+
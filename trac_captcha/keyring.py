@@ -0,0 +1,125 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+
+from trac_captcha.cryptobox import is_legacy_token, unpack_token, TokenVerifier
+
+__all__ = ['KeyRing', 'parse_retired_keys', 'serialize_retired_keys']
+
+
+def parse_retired_keys(values, log=None):
+    """Return a list of (key, retirement timestamp) tuples for the given
+    'key:timestamp' strings (as stored in trac.ini)."""
+    retired_keys = []
+    for value in values:
+        parts = value.strip().rsplit(':', 1)
+        if (len(parts) != 2) or (not parts[0]) or (not parts[1].isdigit()):
+            if log is not None:
+                log.warning('Ignoring invalid retired captcha token key %r' % value)
+            continue
+        retired_keys.append((str(parts[0]), int(parts[1])))
+    return retired_keys
+
+def serialize_retired_keys(retired_keys):
+    return ','.join(['%s:%d' % (key, retire_at) for key, retire_at in retired_keys])
+
+
+class KeyRing(object):
+    """Holds the active token key (used to sign new tokens) and any number of
+    retired keys which can only verify tokens until their retirement time.
+    
+    Every key has its own TokenVerifier (with precomputed HMAC state) and 
+    version 2 tokens carry the key id so finding the right verifier is just a
+    dict lookup."""
+    
+    def __init__(self, active_key, retired_keys=(), accept_legacy_tokens=True,
+                 mac_engine=None):
+        self.active = TokenVerifier(active_key, accept_legacy_tokens=accept_legacy_tokens,
+                                    mac_engine=mac_engine)
+        self.retired_keys = tuple(retired_keys)
+        self.accept_legacy_tokens = accept_legacy_tokens
+        self.mac_engine = self.active.mac_engine
+        self.verifiers = {}
+        for key, retire_at in self.retired_keys:
+            verifier = TokenVerifier(key, accept_legacy_tokens=accept_legacy_tokens)
+            self.verifiers[verifier.key_id()] = (verifier, retire_at)
+        self.verifiers[self.active.key_id()] = (self.active, None)
+        # changes whenever the set of keys changes
+        self.identity = active_key + '|' + serialize_retired_keys(self.retired_keys)
+    
+    def generate_token(self, ttl=None, claims=None, expires=None):
+        return self.active.generate_token(ttl=ttl, claims=claims, expires=expires)
+    
+    def is_token_valid(self, token):
+        valid_until = self.token_expiration(token)
+        if valid_until is None:
+            return False
+        return valid_until >= int(time.time())
+    
+    def token_expiration(self, token, now=None):
+        """Return the expiration time of the token as UNIX timestamp (at most
+        the retirement time of the signing key) or None if the token was not 
+        signed by any valid key."""
+        token = self.verify(token, now=now)
+        if token is None:
+            return None
+        return token.expires
+    
+    def verify(self, token, now=None):
+        """Return the unpacked Token if it was signed by a valid key, None 
+        otherwise. The token's expiration time is capped at the retirement 
+        time of the signing key."""
+        if now is None:
+            now = int(time.time())
+        if is_legacy_token(token):
+            # old tokens do not contain a key id so we have to try all keys
+            return self._verify_with_any_key(token, now)
+        unpacked_token = unpack_token(token)
+        if unpacked_token is None:
+            return None
+        entry = self.verifiers.get(unpacked_token.key_id)
+        if entry is None:
+            return None
+        verifier, retire_at = entry
+        if (retire_at is not None) and (retire_at < now):
+            return None
+        return self._cap_expiration(verifier.verify_unpacked(unpacked_token), retire_at)
+    
+    # --- private API ----------------------------------------------------------
+    
+    def _verify_with_any_key(self, token, now):
+        for verifier, retire_at in self.verifiers.values():
+            if (retire_at is not None) and (retire_at < now):
+                continue
+            verified_token = verifier.verify(token)
+            if verified_token is not None:
+                return self._cap_expiration(verified_token, retire_at)
+        return None
+    
+    def _cap_expiration(self, token, retire_at):
+        if (token is not None) and (retire_at is not None):
+            token.expires = min(token.expires, retire_at)
+        return token
+
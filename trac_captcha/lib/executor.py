@@ -0,0 +1,158 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import Queue
+import sys
+import threading
+
+__all__ = ['BoundedExecutor', 'Future', 'FutureTimeout']
+
+
+class Future(object):
+    """Result of a function which is executed in a different thread."""
+    
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+    
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+    
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+    
+    def done(self):
+        return self._done.isSet()
+    
+    def wait(self, timeout=None):
+        """Return True if the function finished within 'timeout' seconds."""
+        self._done.wait(timeout)
+        return self._done.isSet()
+    
+    def result(self, timeout=None):
+        """Return the function's result (or raise its exception). If the 
+        function did not finish within 'timeout' seconds, a FutureTimeout
+        exception is raised."""
+        if not self.wait(timeout):
+            raise FutureTimeout('function did not finish in time')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class FutureTimeout(Exception):
+    pass
+
+
+class BoundedExecutor(object):
+    """Executes functions with up to 'max_workers' threads (started on 
+    demand). At most 'max_pending' functions can wait for a free worker, 
+    submit() returns None if the queue is full (or the executor was shut 
+    down) so the caller can do the work itself."""
+    
+    def __init__(self, max_workers=4, max_pending=16):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._queue = Queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        self._workers = []
+        self.is_shut_down = False
+        self.submitted = 0
+        self.rejected = 0
+    
+    def submit(self, function, *args, **kwargs):
+        if self.is_shut_down:
+            return None
+        future = Future()
+        self._start_worker_if_necessary()
+        try:
+            self._queue.put_nowait((future, function, args, kwargs))
+        except Queue.Full:
+            self._lock.acquire()
+            try:
+                self.rejected += 1
+            finally:
+                self._lock.release()
+            return None
+        self._lock.acquire()
+        try:
+            self.submitted += 1
+        finally:
+            self._lock.release()
+        return future
+    
+    def shutdown(self):
+        """Stop all worker threads after they executed the pending functions.
+        This blocks until the pending functions were taken from the queue."""
+        self._lock.acquire()
+        try:
+            self.is_shut_down = True
+            nr_workers = len(self._workers)
+        finally:
+            self._lock.release()
+        for i in range(nr_workers):
+            self._queue.put(None)
+    
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return dict(workers=len(self._workers), max_workers=self.max_workers,
+                        pending=self._queue.qsize(), submitted=self.submitted, 
+                        rejected=self.rejected)
+        finally:
+            self._lock.release()
+    
+    # --- private API ----------------------------------------------------------
+    
+    def _start_worker_if_necessary(self):
+        self._lock.acquire()
+        try:
+            if len(self._workers) >= self.max_workers:
+                return
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True)
+            self._workers.append(worker)
+        finally:
+            self._lock.release()
+        worker.start()
+    
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            future, function, args, kwargs = task
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception:
+                future.set_exception(sys.exc_info()[1])
+        self._lock.acquire()
+        try:
+            self._workers.remove(threading.currentThread())
+        finally:
+            self._lock.release()
+
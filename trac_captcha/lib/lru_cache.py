@@ -0,0 +1,128 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# This module must not depend on Trac, the sidecar daemon uses it as well.
+import threading
+
+__all__ = ['LRUCache']
+
+
+class LRUCache(object):
+    """Bounded, thread-safe mapping which discards the least recently used
+    item once more than 'maxsize' items were added.
+    
+    The cache keeps counters for hits, misses and evictions so you can check
+    if the configured size is sensible for your workload."""
+    
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._reset()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def _reset(self):
+        self._items = {}
+        # circular doubly linked list, each link is [previous, next, key, value]
+        root = []
+        root[:] = [root, root, None, None]
+        self._root = root
+    
+    def _unlink(self, link):
+        previous_link, next_link = link[0], link[1]
+        previous_link[1] = next_link
+        next_link[0] = previous_link
+    
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = link
+        root[0] = link
+    
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._items.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self._unlink(link)
+            self._append(link)
+            self.hits += 1
+            return link[3]
+        finally:
+            self._lock.release()
+    
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            link = self._items.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[3] = value
+                self._append(link)
+                return
+            link = [None, None, key, value]
+            self._append(link)
+            self._items[key] = link
+            while len(self._items) > self.maxsize:
+                oldest = self._root[1]
+                self._unlink(oldest)
+                del self._items[oldest[2]]
+                self.evictions += 1
+        finally:
+            self._lock.release()
+    
+    def pop(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._items.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            return link[3]
+        finally:
+            self._lock.release()
+    
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._reset()
+        finally:
+            self._lock.release()
+    
+    def __contains__(self, key):
+        return key in self._items
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, 
+                    evictions=self.evictions, size=len(self), 
+                    maxsize=self.maxsize)
+
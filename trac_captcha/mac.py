@@ -0,0 +1,181 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from hmac import HMAC
+import sys
+import time
+
+__all__ = ['available_mac_engines', 'calibrate_mac_engines', 'compare_digest',
+           'default_mac_engine', 'mac_engine_by_id', 'mac_engine_by_name']
+
+# length of the (truncated) MAC in bytes
+MAC_SIZE = 16
+
+
+try:
+    from hmac import compare_digest
+except ImportError:
+    # Python < 2.7.7
+    def compare_digest(a, b):
+        """Compare both strings in constant time (regarding their content) to 
+        prevent timing attacks."""
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+
+class AlgorithmWrapper(object):
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.digest_size = self.algorithm().digest_size
+    
+    def new(self, *args, **kwargs):
+        return self.algorithm(*args, **kwargs)
+
+
+_hash_algorithm = None
+
+def best_hash_algorithm():
+    global _hash_algorithm
+    if _hash_algorithm is None:
+        _hash_algorithm = find_best_hash_algorithm()
+    return _hash_algorithm
+
+def find_best_hash_algorithm():
+    # see #33, distros shipping hashlib for Python 2.4 use a version 
+    # prior to the one shipped in Python 2.5. The older hashlib always
+    # try to call '.new()' on the algorithm class which leads to an 
+    # exception like this:
+    #  File "/usr/lib64/python2.4/hmac.py", line 42, in __init__
+    #    self.outer = digestmod.new()
+    # AttributeError: 'builtin_function_or_method' object has no attribute 'new'
+    try:
+        from hashlib import sha512
+        if sys.version_info[0:2] <= (2,4):
+            return AlgorithmWrapper(sha512)
+        return sha512
+    except ImportError:
+        pass
+    # no new hashlib, try pycrypto's sha256
+    try:
+        from Crypto.Hash import SHA256
+        return SHA256
+    except ImportError:
+        pass
+    # fall back to sha1
+    import sha
+    return sha
+
+
+class HMACEngine(object):
+    """HMAC with the best available hash function (usually SHA-512)."""
+    
+    algorithm_id = 0
+    name = 'hmac'
+    
+    def is_available(self):
+        return True
+    
+    def keyed_state(self, key):
+        return HMAC(key, digestmod=best_hash_algorithm())
+
+
+class BLAKE2bEngine(object):
+    """Keyed BLAKE2b: a single hash pass per message (HMAC needs two) and the
+    key setup is part of the hash function itself."""
+    
+    algorithm_id = 1
+    name = 'blake2b'
+    
+    def is_available(self):
+        return blake2b is not None
+    
+    def keyed_state(self, key):
+        if len(key) > 64:
+            key = blake2b(key).digest()
+        return blake2b(key=key, digest_size=MAC_SIZE)
+
+
+# ordered by preference
+mac_engines = (BLAKE2bEngine(), HMACEngine())
+
+def available_mac_engines():
+    return [engine for engine in mac_engines if engine.is_available()]
+
+def default_mac_engine():
+    return available_mac_engines()[0]
+
+def mac_engine_by_id(algorithm_id):
+    for engine in available_mac_engines():
+        if engine.algorithm_id == algorithm_id:
+            return engine
+    return None
+
+def mac_engine_by_name(name):
+    for engine in available_mac_engines():
+        if engine.name == name:
+            return engine
+    return None
+
+
+def calibrate_mac_engines(duration=0.5, message='x' * 10):
+    """Return a list of (engine name, signs per second, verifications per 
+    second) for all MAC engines available on this host."""
+    results = []
+    for engine in available_mac_engines():
+        prototype = engine.keyed_state('0123456789abcdef' * 2)
+        def sign():
+            state = prototype.copy()
+            state.update(message)
+            return state.digest()[:MAC_SIZE]
+        expected_mac = sign()
+        def verify():
+            return compare_digest(expected_mac, sign())
+        results.append((engine.name, operations_per_second(sign, duration),
+                        operations_per_second(verify, duration)))
+    return results
+
+def operations_per_second(operation, duration):
+    iterations = 0
+    batch_size = 100
+    start = time.time()
+    while True:
+        for i in xrange(batch_size):
+            operation()
+        iterations += batch_size
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            return int(iterations / elapsed)
+
@@ -0,0 +1,212 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, only threads are synchronized
+    fcntl = None
+
+__all__ = ['BloomReplayStore']
+
+
+class BloomReplayStore(object):
+    """Remembers used captcha tokens so they can not be replayed.
+    
+    The store consists of several Bloom filters ("buckets"), one per time 
+    interval of 'bucket_seconds'. A token is put into the bucket of its 
+    expiration time so a whole bucket can be reset once all its tokens are
+    expired anyway. All buckets live in a memory-mapped file so every process
+    on the host shares the same data. Memory usage is fixed (nr_buckets * 
+    bucket_size bytes).
+    
+    Bloom filters may yield false positives (a token was not used but is
+    reported as used) - with the default settings the probability is less than
+    1% for 400.000 tokens per bucket. The user just has to solve another 
+    captcha in that case.
+    
+    File layout: header, then for each bucket the bucket number (8 bytes) 
+    followed by the bit array. The settings are part of the file name (see 
+    `path`) so other settings never resize or reset a file which is mapped by
+    running processes."""
+    
+    magic = 'TCRS0001'
+    header_format = '>8sIIII'
+    bucket_number_format = '>Q'
+    
+    def __init__(self, filename, bucket_seconds=3600, nr_buckets=6, 
+                 bucket_size=512*1024, nr_hashes=7, clock=None):
+        self.filename = filename
+        root, extension = os.path.splitext(filename)
+        self.path = '%s-%dx%dx%dx%d%s' % (root, bucket_seconds, nr_buckets, 
+                                          bucket_size, nr_hashes, extension)
+        self.bucket_seconds = bucket_seconds
+        self.nr_buckets = nr_buckets
+        self.bucket_size = bucket_size
+        self.nr_bits = bucket_size * 8
+        self.nr_hashes = nr_hashes
+        self.clock = clock or time.time
+        self._lock = threading.Lock()
+        self.header = struct.pack(self.header_format, self.magic, bucket_seconds,
+                                  nr_buckets, bucket_size, nr_hashes)
+        self.bucket_offset = len(self.header)
+        self.slot_size = struct.calcsize(self.bucket_number_format) + bucket_size
+        self.file_size = self.bucket_offset + nr_buckets * self.slot_size
+        self._fp = None
+        self._map = None
+    
+    def was_used(self, token, valid_until):
+        bucket_number = self.bucket_number(valid_until)
+        slot_start = self.slot_start(bucket_number)
+        if self.read_bucket_number(slot_start) != bucket_number:
+            return False
+        return self.is_marked(slot_start, token)
+    
+    def mark_used(self, token, valid_until):
+        """Mark the token as used. Returns False if the token was used already
+        (check and update are atomic so only one of several concurrent 
+        submissions with the same token gets True)."""
+        bucket_number = self.bucket_number(valid_until)
+        data = self.mapping()
+        slot_start = self.slot_start(bucket_number)
+        bits_start = slot_start + struct.calcsize(self.bucket_number_format)
+        self.acquire_lock()
+        try:
+            stored_number = self.read_bucket_number(slot_start)
+            if stored_number > bucket_number:
+                # very old token, bucket was already reused
+                return True
+            if stored_number < bucket_number:
+                data[slot_start:slot_start+self.slot_size] = \
+                    struct.pack(self.bucket_number_format, bucket_number) + \
+                    '\x00' * self.bucket_size
+            elif self.is_marked(slot_start, token):
+                return False
+            for bit in self.bit_positions(token):
+                position = bits_start + (bit >> 3)
+                data[position] = chr(ord(data[position]) | (1 << (bit & 7)))
+            return True
+        finally:
+            self.release_lock()
+    
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._fp.close()
+        self._map = None
+        self._fp = None
+    
+    # --- private API ----------------------------------------------------------
+    
+    def bucket_number(self, valid_until):
+        # tokens must not be stored in a bucket which is currently in use for
+        # still valid tokens
+        now = int(self.clock())
+        highest_bucket = (now // self.bucket_seconds) + self.nr_buckets - 1
+        return min(int(valid_until) // self.bucket_seconds, highest_bucket)
+    
+    def slot_start(self, bucket_number):
+        return self.bucket_offset + (bucket_number % self.nr_buckets) * self.slot_size
+    
+    def read_bucket_number(self, slot_start):
+        end = slot_start + struct.calcsize(self.bucket_number_format)
+        return struct.unpack(self.bucket_number_format, self.mapping()[slot_start:end])[0]
+    
+    def is_marked(self, slot_start, token):
+        data = self.mapping()
+        bits_start = slot_start + struct.calcsize(self.bucket_number_format)
+        for bit in self.bit_positions(token):
+            byte = ord(data[bits_start + (bit >> 3)])
+            if not (byte & (1 << (bit & 7))):
+                return False
+        return True
+    
+    def bit_positions(self, token):
+        if isinstance(token, unicode):
+            token = token.encode('utf-8')
+        digest = sha1(token).digest()
+        # double hashing (Kirsch/Mitzenmacher) to derive all bit positions from
+        # a single digest
+        first, second = struct.unpack('>QQ', digest[:16])
+        return [(first + i * second) % self.nr_bits for i in range(self.nr_hashes)]
+    
+    def acquire_lock(self):
+        self._lock.acquire()
+        if fcntl is not None:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_EX)
+    
+    def release_lock(self):
+        if fcntl is not None:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+        self._lock.release()
+    
+    def mapping(self):
+        if self._map is None:
+            self._lock.acquire()
+            try:
+                if self._map is None:
+                    self._open()
+            finally:
+                self._lock.release()
+        return self._map
+    
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        fp = os.fdopen(fd, 'r+b')
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            fp.seek(0, 2)
+            size = fp.tell()
+            fp.seek(0)
+            if size == 0:
+                # new file: start with empty buckets
+                fp.write(self.header)
+                empty_slot = struct.pack(self.bucket_number_format, 0) + '\x00' * self.bucket_size
+                for i in range(self.nr_buckets):
+                    fp.write(empty_slot)
+                fp.flush()
+            elif (size != self.file_size) or (fp.read(len(self.header)) != self.header):
+                # never reset the file, it contains used tokens which are 
+                # still valid (and other processes may map it)
+                fp.close()
+                raise ValueError('%s is not a replay store with the expected '
+                                 'layout, please remove it.' % self.path)
+        finally:
+            if (fcntl is not None) and (not fp.closed):
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+        self._fp = fp
+        self._map = mmap.mmap(fp.fileno(), self.file_size)
+
@@ -0,0 +1,47 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from trac.core import Component, implements
+from trac.web.api import IRequestFilter
+
+from trac_captcha.controller import TracCaptchaController
+
+__all__ = ['SpeculativeCaptchaVerification']
+
+
+class SpeculativeCaptchaVerification(Component):
+    """Starts the captcha verification for posted forms before Trac processes
+    the request (see `[trac-captcha] speculative_verification`)."""
+    
+    implements(IRequestFilter)
+    
+    # --- IRequestFilter -------------------------------------------------------
+    def pre_process_request(self, req, handler):
+        if req.method == 'POST':
+            TracCaptchaController(self.env).start_speculative_verification(req)
+        return handler
+    
+    def post_process_request(self, req, template, data, content_type):
+        return (template, data, content_type)
+
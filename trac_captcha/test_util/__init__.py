@@ -2,3 +2,4 @@
 from trac_captcha.test_util.captcha_test import *
 from trac_captcha.test_util.fake_captcha import *
 
+from trac_captcha.test_util.http_server import *
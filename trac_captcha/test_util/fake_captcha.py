@@ -37,6 +37,9 @@ class FakeCaptcha(Component):
         element = tag.div('fake captcha: ' + req.captcha_data.get('old_input', ''))
         return element.generate()
     
+    def has_solution(self, req):
+        return 'fake_captcha' in req.args
+    
     def assert_captcha_completed(self, req):
         if req.args.get('fake_captcha') == 'open sesame':
             return
@@ -0,0 +1,113 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import socket
+import threading
+import time
+
+__all__ = ['LocalHTTPServer']
+
+
+class LocalHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP/1.1 (keep-alive) server on localhost for tests which need a real
+    verify server. 'responder' is a callable(path, body) which returns 
+    (status, content). 'content' can also be a list of parts which are sent
+    with a delay of 'part_delay' seconds in between (slow servers). If the 
+    responder returns None, the connection is closed without a response."""
+    
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, responder=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), KeepAliveHandler)
+        self.responder = responder or (lambda path, body: (200, 'true\n'))
+        self.part_delay = 0
+        self.nr_connections = 0
+        self.connections = []
+        self.requests = []
+        self._thread = None
+    
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+    
+    def close_connections(self):
+        """Close all (keep-alive) connections like a server does after its 
+        idle timeout."""
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.connections = []
+    
+    def handle_error(self, request, client_address):
+        # clients closing connections early (e.g. after a timeout) are fine
+        pass
+    
+    def url(self, path='/'):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.nr_connections += 1
+        self.server.connections.append(self.connection)
+    
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        self.server.requests.append((self.path, body))
+        response = self.server.responder(self.path, body)
+        if response is None:
+            self.close_connection = 1
+            return
+        status, content = response
+        parts = content
+        if not isinstance(content, list):
+            parts = [content]
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(''.join(parts))))
+        self.end_headers()
+        for i, part in enumerate(parts):
+            if i > 0:
+                time.sleep(self.server.part_delay)
+            self.wfile.write(part)
+            self.wfile.flush()
+    
+    def log_message(self, format, *args):
+        pass
+
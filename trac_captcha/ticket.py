@@ -22,35 +22,78 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from genshi.filters.transform import Transformer
+import threading
+
 from trac.core import Component, implements
-from trac.ticket.api import ITicketManipulator
+from trac.ticket.api import ITicketChangeListener, ITicketManipulator
 from trac.web.api import ITemplateStreamFilter
 
 from trac_captcha.controller import TracCaptchaController
+from trac_captcha.injection import injector_for
 
 __all__ = ['TicketCaptcha']
 
 
 class TicketCaptcha(Component):
-    implements(ITemplateStreamFilter, ITicketManipulator)
+    implements(ITemplateStreamFilter, ITicketChangeListener, ITicketManipulator)
+    
+    def __init__(self):
+        # Trac validates and saves the ticket in the request thread, the 
+        # validated (ticket, request) is kept until the ticket was saved
+        self._validated = threading.local()
     
     # --- ITemplateStreamFilter ------------------------------------------------
     def filter_stream(self, req, method, filename, stream, data):
         if filename != 'ticket.html':
             return stream
-        transformer = Transformer('//div[@class="buttons"]')
-        return TracCaptchaController(self.env).inject_captcha_into_stream(req, stream, transformer)
+        injector = injector_for('//div[@class="buttons"]')
+        scope = self.captcha_scope(data.get('ticket'))
+        return TracCaptchaController(self.env).inject_captcha_into_stream(req, stream, injector, scope)
     
     # --- ITicketManipulator ---------------------------------------------------
     def prepare_ticket(self, req, ticket, fields, actions):
         pass
     
     def validate_ticket(self, req, ticket):
-        error_message = TracCaptchaController(self.env).check_captcha_solution(req)
-        if error_message is None:
-            return ()
-        return ((None, error_message),)
+        scope = self.captcha_scope(ticket)
+        controller = TracCaptchaController(self.env)
+        error_message = controller.check_captcha_solution(req, scope)
+        if error_message is not None:
+            return ((None, error_message),)
+        if 'preview' not in req.args:
+            # Trac calls all manipulators even if the ticket is invalid (and it
+            # validates previews as well) so the token is only used up when 
+            # the ticket was actually saved.
+            self._validated.submission = (ticket, req)
+        return ()
+    
+    # --- ITicketChangeListener ------------------------------------------------
+    def ticket_created(self, ticket):
+        self.burn_token_for(ticket)
+    
+    def ticket_changed(self, ticket, comment, author, old_values):
+        self.burn_token_for(ticket)
+    
+    def ticket_deleted(self, ticket):
+        pass
+    
+    # --- private API ----------------------------------------------------------
+    def burn_token_for(self, ticket):
+        submission = getattr(self._validated, 'submission', None)
+        if (submission is None) or (submission[0] is not ticket):
+            return
+        self._validated.submission = None
+        req = submission[1]
+        error_message = TracCaptchaController(self.env).burn_pending_token(req)
+        if error_message is not None:
+            self.env.log.warning('Captcha token for ticket %s was used by a concurrent submission' % ticket.id)
+    
+    def captcha_scope(self, ticket):
+        # tokens for the new ticket form can not be used to modify existing 
+        # tickets
+        if (ticket is None) or (not ticket.id):
+            return 'ticket:new'
+        return 'ticket:%s' % ticket.id
     
 
 
@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from trac_captcha.lib.lru_cache import LRUCache
+
+__all__ = ['VerifiedTokenCache']
+
+
+class VerifiedTokenCache(object):
+    """Remembers tokens which were already verified successfully so that
+    repeated checks of the same token (e.g. when previewing a ticket several
+    times) do not need to recompute the HMAC.
+    
+    Entries are dropped when the token expires. The whole cache is cleared if
+    the token key changes because all tokens signed with the old key are
+    invalid then."""
+    
+    def __init__(self, maxsize=1000, clock=None):
+        self.cache = LRUCache(maxsize=maxsize)
+        self.clock = clock or time.time
+        self.key_fingerprint = None
+        self.expired = 0
+    
+    def fingerprint(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return sha1(value).digest()
+    
+    def ensure_token_key(self, token_key):
+        fingerprint = self.fingerprint(token_key)
+        if fingerprint != self.key_fingerprint:
+            self.cache.clear()
+            self.key_fingerprint = fingerprint
+    
+    def is_known_valid(self, token_key, token):
+        return self.expiration(token_key, token) is not None
+    
+    def expiration(self, token_key, token):
+        """Return the expiration time of a known (and still valid) token or
+        None."""
+        entry = self._entry(token_key, token)
+        if entry is None:
+            return None
+        return entry[0]
+    
+    def lookup(self, token_key, token):
+        """Return the verified token (as passed to remember()) for a known 
+        (and still valid) token or None."""
+        entry = self._entry(token_key, token)
+        if entry is None:
+            return None
+        return entry[1]
+    
+    def remember(self, token_key, token, valid_until, verified_token=None):
+        self.ensure_token_key(token_key)
+        self.cache.set(self.fingerprint(token), (valid_until, verified_token))
+    
+    def _entry(self, token_key, token):
+        if not hasattr(token, 'encode'):
+            return None
+        self.ensure_token_key(token_key)
+        token_digest = self.fingerprint(token)
+        entry = self.cache.get(token_digest)
+        if entry is None:
+            return None
+        if entry[0] < self.clock():
+            self.cache.pop(token_digest)
+            self.expired += 1
+            return None
+        return entry
+    
+    def stats(self):
+        stats = self.cache.stats()
+        stats['expired'] = self.expired
+        return stats
+
@@ -0,0 +1,64 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+__all__ = ['load_token_key', 'provision_token_key']
+
+# The generated token key is stored in Trac's 'system' table. Its primary key
+# on 'name' turns the INSERT into an atomic "insert if absent" so concurrent
+# processes always agree on a single key (and trac.ini is never rewritten 
+# while serving requests).
+TOKEN_KEY_NAME = 'trac_captcha_token_key'
+
+
+def load_token_key(env, db=None):
+    db = db or env.get_db_cnx()
+    cursor = db.cursor()
+    cursor.execute('SELECT value FROM system WHERE name=%s', (TOKEN_KEY_NAME,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return str(row[0])
+
+def provision_token_key(env, new_key):
+    """Return the token key stored in the database. If there is no key yet, 
+    'new_key' is stored unless another process was faster."""
+    db = env.get_db_cnx()
+    stored_key = load_token_key(env, db=db)
+    if stored_key is not None:
+        return stored_key
+    try:
+        cursor = db.cursor()
+        cursor.execute('INSERT INTO system (name, value) VALUES (%s, %s)', 
+                       (TOKEN_KEY_NAME, new_key))
+        db.commit()
+        return new_key
+    except Exception, e:
+        # exception classes are specific to the database backend
+        env.log.debug('Could not store captcha token key: %s' % e)
+        db.rollback()
+    stored_key = load_token_key(env)
+    if stored_key is None:
+        raise AssertionError('Unable to provision a captcha token key')
+    return stored_key
+
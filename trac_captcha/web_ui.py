@@ -0,0 +1,106 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import re
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from trac.core import Component, implements
+from trac.web.api import IRequestHandler, RequestDone
+
+from trac_captcha.controller import initialize_captcha_data, \
+    TracCaptchaController, WIDGET_PATH
+from trac_captcha.deferred import render_events
+
+__all__ = ['CaptchaWidgetModule']
+
+# Babel is optional (Trac works without translations)
+try:
+    from babel.core import Locale, UnknownLocaleError
+except ImportError:
+    Locale = None
+
+
+class CaptchaWidgetModule(Component):
+    """Serves the captcha widget as an HTML fragment which browsers and 
+    reverse proxies can cache. The fragment only depends on the URL (language
+    and displayed captcha are query parameters) and never on the session. The
+    request does not touch tickets or other resources."""
+    
+    implements(IRequestHandler)
+    
+    # --- IRequestHandler ------------------------------------------------------
+    def match_request(self, req):
+        if req.path_info != WIDGET_PATH:
+            return False
+        return TracCaptchaController(self.env).widget_endpoint
+    
+    def process_request(self, req):
+        controller = TracCaptchaController(self.env)
+        initialize_captcha_data(req)
+        req.captcha_data['shared_widget'] = True
+        # responses are shared so the user's session must not change them
+        req.locale = self.widget_locale(req.args.get('lang'))
+        body = render_events(controller.captcha_html(req)).encode('utf-8')
+        etag = '"%s"' % sha1(body).hexdigest()
+        if self.etag_matches(req, etag):
+            req.send_response(304)
+            self.send_cache_headers(req, etag)
+            req.send_header('Content-Length', 0)
+            req.end_headers()
+            raise RequestDone
+        req.send_response(200)
+        req.send_header('Content-Type', 'text/html;charset=utf-8')
+        req.send_header('Content-Length', len(body))
+        self.send_cache_headers(req, etag)
+        req.end_headers()
+        if req.method != 'HEAD':
+            req.write(body)
+        raise RequestDone
+    
+    # --- private API ----------------------------------------------------------
+    def etag_matches(self, req, etag):
+        if_none_match = req.get_header('If-None-Match')
+        if not if_none_match:
+            return False
+        # also accept weak validators (some proxies weaken ETags when they 
+        # compress the response)
+        candidates = [re.sub('^W/', '', tag.strip()) for tag in if_none_match.split(',')]
+        return (etag in candidates) or ('*' in candidates)
+    
+    def widget_locale(self, lang):
+        if (not lang) or (Locale is None):
+            return None
+        try:
+            return Locale.parse(lang)
+        except (ValueError, UnknownLocaleError):
+            return None
+    
+    def send_cache_headers(self, req, etag):
+        max_age = max(TracCaptchaController(self.env).widget_max_age, 0)
+        req.send_header('ETag', etag)
+        req.send_header('Cache-Control', 'public, max-age=%d' % max_age)
+
@@ -1,3 +1,13 @@
 
-from trac_recaptcha.integration import *
+# Only the Trac components need Trac and Genshi: The verification client (e.g.
+# the sidecar daemon) must be importable without them.
+try:
+    import genshi
+    import trac
+except ImportError:
+    pass
+else:
+    from trac_recaptcha.integration import *
+    
+    from trac_recaptcha.providers import *
 
@@ -22,9 +22,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import httplib
 from urllib import urlencode
 import urllib2
 
+from trac_recaptcha.coalescing import SingleFlightTimeout
+from trac_recaptcha.resilience import BulkheadFullError, Deadline
+
 try:
     # try not to depend on trac_captcha so this file can be reused within other
     # software without dependencies on TracCaptcha or Trac.
@@ -40,7 +44,9 @@ except ImportError:
             self.captcha_data = captcha_data or dict()
 
 
-__all__ = ['is_empty', 'reCAPTCHAClient']
+__all__ = ['is_empty', 'reCAPTCHAClient', 'UrlopenTransport']
+
+READ_CHUNK_SIZE = 1024
 
 
 def is_string(instance):
@@ -50,9 +56,57 @@ def is_empty(parameter):
     return (not is_string(parameter)) or parameter.strip() == ''
 
 
+class UrlopenTransport(object):
+    """Sends requests with urllib2. urllib2 only supports a single 'timeout'
+    for each socket operation (connecting and every read) so there are no 
+    separate connect and read timeouts. The optional deadline reduces the 
+    timeout to the remaining time when connecting and is checked again before
+    each read. Errors of the HTTP protocol are raised as IOError (urllib2 
+    does not wrap httplib's exceptions, e.g. BadStatusLine)."""
+    
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+    
+    def __call__(self, url, data, deadline=None):
+        try:
+            return self._fetch(url, data, deadline)
+        except httplib.HTTPException, e:
+            raise IOError('%s: %s' % (e.__class__.__name__, e))
+    
+    def _fetch(self, url, data, deadline):
+        if deadline is None:
+            deadline = Deadline()
+        timeout = deadline.timeout(self.timeout)
+        if timeout is None:
+            response = urllib2.urlopen(url, data)
+        else:
+            response = urllib2.urlopen(url, data, timeout)
+        try:
+            chunks = []
+            while True:
+                deadline.timeout()
+                chunk = response.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            response.close()
+        return ''.join(chunks)
+
+urlopen_transport = UrlopenTransport()
+
+
 class reCAPTCHAClient(object):
-    def __init__(self, private_key):
+    def __init__(self, private_key, transport=None, circuit_breaker=None, 
+                 coalescer=None):
         self.private_key = private_key
+        # callable(url, data, deadline=None) which returns the response body,
+        # raises IOError if the server is not reachable (e.g. a PooledTransport)
+        self.transport = transport or urlopen_transport
+        self.circuit_breaker = circuit_breaker
+        # e.g. a VerificationCoalescer so duplicate submissions of the same 
+        # solution only cause a single request to the verify server
+        self.coalescer = coalescer
     
     def verify_server(self):
         return 'http://www.google.com/recaptcha/api/verify'
@@ -61,8 +115,13 @@ class reCAPTCHAClient(object):
         msg = msg or _(u'Incorrect captcha input - please try again…')
         raise CaptchaFailedError(msg, dict(error_code=error_code))
     
-    def raise_server_unreachable_error(self):
-        self.raise_error('recaptcha-not-reachable')
+    def raise_server_unreachable_error(self, circuit_open=False):
+        msg = _(u'Incorrect captcha input - please try again…')
+        captcha_data = dict(error_code='recaptcha-not-reachable')
+        if circuit_open:
+            # verify server was not contacted at all
+            captcha_data['circuit_open'] = True
+        raise CaptchaFailedError(msg, captcha_data)
     
     def raise_incorrect_solution_error(self, error_code='incorrect-captcha-sol'):
         self.raise_error(error_code)
@@ -71,12 +130,28 @@ class reCAPTCHAClient(object):
         def to_utf8(value):
             return hasattr(value, 'encode') and value.encode('utf-8') or value
         utf8_parameters = dict([(key, to_utf8(value)) for key, value in parameters.items()])
+        breaker = self.circuit_breaker
+        if (breaker is not None) and (not breaker.allow_request()):
+            self.raise_server_unreachable_error(circuit_open=True)
         try:
-            response = urllib2.urlopen(url, urlencode(utf8_parameters))
-            response_content = response.read()
-            response.close()
+            response_content = self.transport(url, urlencode(utf8_parameters))
+        except BulkheadFullError:
+            # too many local requests, says nothing about the server
+            if breaker is not None:
+                breaker.record_skipped()
+            self.raise_server_unreachable_error()
         except IOError:
+            if breaker is not None:
+                breaker.record_failure()
             self.raise_server_unreachable_error()
+        except Exception:
+            # unexpected errors must be recorded as well, otherwise a probe of
+            # a half-open circuit breaker would never finish
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+        if breaker is not None:
+            breaker.record_success()
         return response_content
     
     def assert_server_accepted_solution(self, response):
@@ -106,7 +181,19 @@ class reCAPTCHAClient(object):
         parameters = dict(privatekey=self.private_key, remoteip=remote_ip,
                           challenge=challenge, response=response)
         verify_method = probe and probe or self.ask_verify_server
-        response = verify_method(self.verify_server(), parameters)
-        self.assert_server_accepted_solution(response)
+        def verify_remotely():
+            response = verify_method(self.verify_server(), parameters)
+            self.assert_server_accepted_solution(response)
+        key = (self.private_key, remote_ip, challenge, response)
+        self.verify_coalesced(key, verify_remotely)
+    
+    def verify_coalesced(self, key, verify_remotely):
+        if self.coalescer is None:
+            return verify_remotely()
+        try:
+            return self.coalescer.verify(key, verify_remotely)
+        except SingleFlightTimeout:
+            # the identical verification is still running
+            self.raise_server_unreachable_error()
 
 
@@ -0,0 +1,167 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+import time
+
+from trac_captcha.lib.lru_cache import LRUCache
+
+__all__ = ['coalescer_for', 'SingleFlight', 'SingleFlightTimeout', 
+           'VerificationCoalescer']
+
+
+class SingleFlightTimeout(IOError):
+    """Raised if the running call for the same key did not finish in time."""
+
+
+class Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Runs only one call per key at a time: Concurrent callers with the same
+    key wait for the running call and get its result (or exception)."""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+    
+    def do(self, key, function, timeout=None):
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key)
+            is_leader = (call is None)
+            if is_leader:
+                call = Call()
+                self._calls[key] = call
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        finally:
+            self._lock.release()
+        
+        if is_leader:
+            try:
+                call.result = function()
+            except Exception, e:
+                call.error = e
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call.done.set()
+        else:
+            call.done.wait(timeout)
+            if not call.done.isSet():
+                raise SingleFlightTimeout('timeout while waiting for identical request')
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class VerificationCoalescer(object):
+    """Coalesces concurrent verifications of the same captcha solution (e.g.
+    double-clicked submit buttons) and remembers the verdict for 'ttl' 
+    seconds so duplicates which arrive a bit later get the same result.
+    
+    Verify functions must return normally for a correct solution or raise
+    an exception which has a 'captcha_data' attribute (CaptchaFailedError). 
+    Only verdicts of the verify server are cached, not transient errors 
+    (error codes listed in 'uncacheable_errors')."""
+    
+    uncacheable_errors = ('recaptcha-not-reachable',)
+    
+    def __init__(self, ttl=5, maxsize=1000, wait_timeout=None, clock=None):
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.clock = clock or time.time
+        self.single_flight = SingleFlight()
+        self.verdicts = LRUCache(maxsize=maxsize)
+    
+    def verify(self, key, verify_function):
+        verdict = self.cached_verdict(key)
+        if verdict is None:
+            verdict = self.single_flight.do(key, lambda: self._verify(key, verify_function),
+                                            timeout=self.wait_timeout)
+        error = verdict[1]
+        if error is not None:
+            # every caller gets its own exception instance
+            raise error.__class__(error.msg, dict(error.captcha_data))
+        return verdict[0]
+    
+    def cached_verdict(self, key):
+        entry = self.verdicts.get(key)
+        if entry is None:
+            return None
+        expires, verdict = entry
+        if expires < self.clock():
+            self.verdicts.pop(key)
+            return None
+        return verdict
+    
+    def stats(self):
+        stats = self.verdicts.stats()
+        stats['executed'] = self.single_flight.executed
+        stats['coalesced'] = self.single_flight.coalesced
+        return stats
+    
+    # --- private API ----------------------------------------------------------
+    
+    def _verify(self, key, verify_function):
+        try:
+            verdict = (verify_function(), None)
+        except Exception, e:
+            captcha_data = getattr(e, 'captcha_data', None)
+            if captcha_data is None:
+                raise
+            verdict = (None, e)
+            if captcha_data.get('error_code') in self.uncacheable_errors:
+                return verdict
+        if self.ttl > 0:
+            self.verdicts.set(key, (self.clock() + self.ttl, verdict))
+        return verdict
+
+
+_coalescers = {}
+_coalescers_lock = threading.Lock()
+
+def coalescer_for(name, ttl=5, wait_timeout=None):
+    """Return the per-process VerificationCoalescer with the given name."""
+    _coalescers_lock.acquire()
+    try:
+        coalescer = _coalescers.get(name)
+        if (coalescer is None) or (coalescer.ttl != ttl) or \
+            (coalescer.wait_timeout != wait_timeout):
+            coalescer = VerificationCoalescer(ttl=ttl, wait_timeout=wait_timeout)
+            _coalescers[name] = coalescer
+        return coalescer
+    finally:
+        _coalescers_lock.release()
+
@@ -0,0 +1,366 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import httplib
+import select
+import socket
+import threading
+import time
+import urlparse
+
+from trac_recaptcha.resilience import DeadlineExceeded
+
+__all__ = ['DNSCache', 'HTTPConnectionPool', 'PooledTransport', 'pool_for_url',
+           'SharedPoolTransport']
+
+# The response is read in small chunks so the socket timeout can be reduced
+# to the remaining time (deadline) before each read.
+READ_CHUNK_SIZE = 1024
+
+
+class DNSCache(object):
+    """Caches the results of getaddrinfo() for 'ttl' seconds so that new 
+    connections to the verify server do not need a DNS lookup."""
+    
+    def __init__(self, ttl=300, resolver=None, clock=None):
+        self.ttl = ttl
+        self.resolver = resolver or socket.getaddrinfo
+        self.clock = clock or time.time
+        self._lock = threading.Lock()
+        self._addresses = {}
+    
+    def resolve(self, host, port):
+        key = (host, port)
+        now = self.clock()
+        self._lock.acquire()
+        try:
+            entry = self._addresses.get(key)
+        finally:
+            self._lock.release()
+        if (entry is not None) and (entry[0] > now):
+            return entry[1]
+        addresses = self.resolver(host, port, 0, socket.SOCK_STREAM)
+        self._lock.acquire()
+        try:
+            self._addresses[key] = (now + self.ttl, addresses)
+        finally:
+            self._lock.release()
+        return addresses
+    
+    def forget(self, host, port):
+        self._lock.acquire()
+        try:
+            self._addresses.pop((host, port), None)
+        finally:
+            self._lock.release()
+    
+    def create_connection(self, address, timeout=None, source_address=None):
+        """Replacement for socket.create_connection() which uses the cached
+        addresses."""
+        host, port = address
+        last_error = None
+        for family, socktype, proto, canonname, sockaddr in self.resolve(host, port):
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if timeout is not None:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except socket.error, e:
+                last_error = e
+                if sock is not None:
+                    sock.close()
+        # maybe the host moved to a different address
+        self.forget(host, port)
+        if last_error is None:
+            last_error = socket.error('getaddrinfo returned no addresses')
+        raise last_error
+
+
+class HTTPConnectionPool(object):
+    """Keeps up to 'maxsize' idle HTTP/1.1 connections to a single host so 
+    that requests do not need a new TCP connection (and TLS handshake).
+    
+    Idle connections are discarded after 'idle_timeout' seconds because the 
+    server will close them anyway. If a reused connection turns out to be 
+    closed by the server while sending the request, the request is retried 
+    once with a new connection. Requests are never sent again once they were
+    sent completely (the server might have processed them already)."""
+    
+    def __init__(self, scheme, host, port=None, maxsize=4, idle_timeout=60,
+                 timeout=None, dns_cache=None, clock=None):
+        if scheme == 'https':
+            self.connection_class = getattr(httplib, 'HTTPSConnection', None)
+            if self.connection_class is None:
+                raise ValueError('HTTPS is not supported (no SSL support in Python)')
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.dns_cache = dns_cache
+        self.clock = clock or time.time
+        self._lock = threading.Lock()
+        self._idle = []
+        self.created = 0
+        self.reused = 0
+    
+    def request(self, method, path, body=None, headers=None, 
+                connect_timeout=None, read_timeout=None, deadline=None):
+        """Send the request and return (status, response body).
+        
+        'connect_timeout' and 'read_timeout' limit each socket operation, the
+        optional 'deadline' (resilience.Deadline) limits the whole request 
+        (socket timeouts are reduced to the remaining time before each 
+        read)."""
+        timeouts = (connect_timeout, read_timeout, deadline)
+        connection, is_reused = self.get_connection()
+        try:
+            self._send(connection, method, path, body, headers, *timeouts)
+        except socket.timeout:
+            # the server is just slow, a retry would exceed the timeout
+            connection.close()
+            raise
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not is_reused:
+                raise
+            # the server closed the idle connection in the meantime
+            connection = self.new_connection()
+            try:
+                self._send(connection, method, path, body, headers, *timeouts)
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                raise
+        try:
+            return self._receive(connection, read_timeout, deadline)
+        except (httplib.HTTPException, socket.error, DeadlineExceeded):
+            # no retry: the server may have processed the request already
+            connection.close()
+            raise
+    
+    def get_connection(self):
+        """Return (connection, is_reused)."""
+        now = self.clock()
+        self._lock.acquire()
+        try:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+                if (last_used + self.idle_timeout > now) and \
+                    (not self._is_dropped(connection)):
+                    self.reused += 1
+                    return connection, True
+                connection.close()
+        finally:
+            self._lock.release()
+        return self.new_connection(), False
+    
+    def new_connection(self):
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        connection = self.connection_class(self.host, self.port, **kwargs)
+        if (self.dns_cache is not None) and hasattr(connection, '_create_connection'):
+            # Python 2.7+
+            connection._create_connection = self.dns_cache.create_connection
+        self._lock.acquire()
+        try:
+            self.created += 1
+        finally:
+            self._lock.release()
+        return connection
+    
+    def release(self, connection):
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.maxsize:
+                self._idle.append((connection, self.clock()))
+                return
+        finally:
+            self._lock.release()
+        connection.close()
+    
+    def prewarm(self, nr_connections=1):
+        """Open connections in advance so the first request does not need to
+        wait for the TCP/TLS handshake."""
+        nr_connections = min(nr_connections, self.maxsize)
+        for i in range(nr_connections):
+            connection = self.new_connection()
+            connection.connect()
+            self.release(connection)
+    
+    def close(self):
+        self._lock.acquire()
+        try:
+            idle_connections = self._idle
+            self._idle = []
+        finally:
+            self._lock.release()
+        for connection, last_used in idle_connections:
+            connection.close()
+    
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return dict(created=self.created, reused=self.reused, 
+                        idle=len(self._idle), maxsize=self.maxsize)
+        finally:
+            self._lock.release()
+    
+    # --- private API ----------------------------------------------------------
+    
+    def _timeout(self, limit, deadline):
+        if limit is None:
+            limit = self.timeout
+        if deadline is None:
+            return limit
+        return deadline.timeout(limit)
+    
+    def _is_dropped(self, connection):
+        # An idle connection is only readable if the server closed it (or
+        # sent garbage) - either way it can not be used anymore.
+        if connection.sock is None:
+            return True
+        try:
+            readable = select.select([connection.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+    
+    def _send(self, connection, method, path, body, headers, 
+              connect_timeout=None, read_timeout=None, deadline=None):
+        if connection.sock is None:
+            connection.timeout = self._timeout(connect_timeout, deadline)
+            connection.connect()
+        connection.sock.settimeout(self._timeout(read_timeout, deadline))
+        connection.request(method, path, body, headers or {})
+    
+    def _set_timeout(self, sock, timeout):
+        try:
+            sock.settimeout(timeout)
+        except socket.error:
+            # httplib closed the connection after getresponse() already 
+            # ('Connection: close'), the previous timeout still applies
+            pass
+    
+    def _receive(self, connection, read_timeout=None, deadline=None):
+        sock = connection.sock
+        response = connection.getresponse()
+        chunks = []
+        while True:
+            self._set_timeout(sock, self._timeout(read_timeout, deadline))
+            chunk = response.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        content = ''.join(chunks)
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(connection)
+        return response.status, content
+
+
+class PooledTransport(object):
+    """Sends form-encoded POST requests using a connection pool. Instances
+    are callables with the same signature as the transport of 
+    reCAPTCHAClient: transport(url, data, deadline=None) -> response body. 
+    IOError is raised if the server is not reachable."""
+    
+    def __init__(self, pool, connect_timeout=None, read_timeout=None):
+        self.pool = pool
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+    
+    def __call__(self, url, data, deadline=None):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        try:
+            status, content = self.pool.request('POST', path or '/', data, headers,
+                connect_timeout=self.connect_timeout, read_timeout=self.read_timeout,
+                deadline=deadline)
+        except (httplib.HTTPException, socket.error), e:
+            raise IOError(str(e))
+        if status != 200:
+            raise IOError('HTTP status %d' % status)
+        return content
+
+
+class SharedPoolTransport(object):
+    """Like PooledTransport but uses the per-process pool for the host of 
+    each URL so one transport can be shared by different verify servers."""
+    
+    def __init__(self, maxsize=4, idle_timeout=60, connect_timeout=None, 
+                 read_timeout=None, dns_cache_ttl=300):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+    
+    def __call__(self, url, data, deadline=None):
+        pool = pool_for_url(url, maxsize=self.maxsize, idle_timeout=self.idle_timeout,
+                            timeout=self.connect_timeout, dns_cache_ttl=self.dns_cache_ttl)
+        transport = PooledTransport(pool, connect_timeout=self.connect_timeout,
+                                    read_timeout=self.read_timeout)
+        return transport(url, data, deadline=deadline)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def pool_for_url(url, maxsize=4, idle_timeout=60, timeout=None, dns_cache_ttl=300):
+    """Return the per-process connection pool for the host of 'url' (a new
+    pool is created if no pool with the same settings exists yet)."""
+    scheme, netloc = urlparse.urlsplit(url)[:2]
+    host, port = netloc, None
+    if ':' in netloc:
+        host, port = netloc.rsplit(':', 1)
+        port = int(port)
+    key = (scheme, host, port)
+    settings = (maxsize, idle_timeout, timeout, dns_cache_ttl)
+    _pools_lock.acquire()
+    try:
+        pool, pool_settings = _pools.get(key, (None, None))
+        if pool_settings != settings:
+            if pool is not None:
+                pool.close()
+            dns_cache = None
+            if dns_cache_ttl > 0:
+                dns_cache = DNSCache(ttl=dns_cache_ttl)
+            pool = HTTPConnectionPool(scheme, host, port, maxsize=maxsize, 
+                idle_timeout=idle_timeout, timeout=timeout, dns_cache=dns_cache)
+            _pools[key] = (pool, settings)
+        return pool
+    finally:
+        _pools_lock.release()
+
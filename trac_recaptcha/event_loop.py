@@ -0,0 +1,352 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncore
+import socket
+import sys
+import threading
+import time
+import urlparse
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+from trac_captcha.lib.executor import Future, FutureTimeout
+from trac_recaptcha.connection_pool import DNSCache
+from trac_recaptcha.resilience import DeadlineExceeded
+
+__all__ = ['AsyncTransport', 'engine_for', 'EventLoopEngine']
+
+
+class EventLoopEngine(object):
+    """Runs a single (asyncore) event loop in a background thread which 
+    handles all outbound verify requests of the process. Callers in other 
+    threads submit requests and wait for a Future, so many verifications can
+    be in flight without using a thread for each of them.
+    
+    Each request has its own connection ("Connection: close") which is 
+    closed when the deadline (absolute time) is reached."""
+    
+    def __init__(self, dns_cache=None, ssl_context=None, clock=None):
+        self.dns_cache = dns_cache or DNSCache()
+        self.ssl_context = ssl_context
+        self.clock = clock or time.time
+        self.socket_map = {}
+        self.requests = []
+        self._tasks = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._waker = None
+        self.completed = 0
+        self.failed = 0
+    
+    def start(self):
+        self._lock.acquire()
+        try:
+            if self._thread is not None:
+                return self
+            if hasattr(socket, 'socketpair'):
+                self._waker = Waker(self.socket_map)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+        finally:
+            self._lock.release()
+        return self
+    
+    def submit(self, url, data, expires=None):
+        """Send a POST request with the form-encoded 'data' to 'url' and return
+        a Future for (status, response body). The request is aborted at 
+        'expires' (UNIX timestamp), failures raise IOError."""
+        self.start()
+        future = Future()
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        host, port = netloc, (scheme == 'https') and 443 or 80
+        if ':' in netloc:
+            host, port = netloc.rsplit(':', 1)
+            port = int(port)
+        try:
+            if (scheme == 'https') and (not has_nonblocking_ssl):
+                raise IOError('HTTPS is not supported (requires Python 2.7.9+ with SSL support)')
+            address_info = self.dns_cache.resolve(host, port)[0]
+        except (IOError, socket.error), e:
+            future.set_exception(IOError(str(e)))
+            return future
+        request = '\r\n'.join([
+            'POST %s HTTP/1.0' % (path or '/'),
+            'Host: %s' % netloc,
+            'Content-Type: application/x-www-form-urlencoded',
+            'Content-Length: %d' % len(data),
+            'Connection: close',
+            '', data])
+        def start_request():
+            dispatcher = HTTPRequestDispatcher(self, scheme, host, address_info,
+                                               request, future, expires)
+            self.requests.append(dispatcher)
+            dispatcher.start()
+        self._call_soon(start_request)
+        return future
+    
+    def stats(self):
+        return dict(in_flight=len(self.requests), completed=self.completed, 
+                    failed=self.failed)
+    
+    # --- private API ----------------------------------------------------------
+    
+    def _call_soon(self, task):
+        self._lock.acquire()
+        try:
+            self._tasks.append(task)
+        finally:
+            self._lock.release()
+        if self._waker is not None:
+            self._waker.wake()
+    
+    def _run_tasks(self):
+        self._lock.acquire()
+        try:
+            tasks = self._tasks
+            self._tasks = []
+        finally:
+            self._lock.release()
+        for task in tasks:
+            try:
+                task()
+            except Exception:
+                # errors are reported via the future, the loop must go on
+                pass
+    
+    def _expire_requests(self):
+        now = self.clock()
+        next_expiration = None
+        for dispatcher in list(self.requests):
+            if dispatcher.expires is None:
+                continue
+            if dispatcher.expires <= now:
+                dispatcher.fail(DeadlineExceeded('verify server did not answer in time'))
+            elif (next_expiration is None) or (dispatcher.expires < next_expiration):
+                next_expiration = dispatcher.expires
+        return next_expiration
+    
+    def _run(self):
+        while True:
+            self._run_tasks()
+            next_expiration = self._expire_requests()
+            timeout = (self._waker is not None) and 1.0 or 0.05
+            if next_expiration is not None:
+                timeout = max(0, min(timeout, next_expiration - self.clock()))
+            if self.socket_map:
+                asyncore.loop(timeout=timeout, map=self.socket_map, count=1)
+            else:
+                time.sleep(timeout)
+    
+    def _finished(self, dispatcher, success):
+        if dispatcher in self.requests:
+            self.requests.remove(dispatcher)
+        if success:
+            self.completed += 1
+        else:
+            self.failed += 1
+
+
+class Waker(asyncore.dispatcher):
+    """Interrupts the event loop's select() when new requests are 
+    submitted."""
+    
+    def __init__(self, socket_map):
+        self._reader, self._writer = socket.socketpair()
+        self._writer.setblocking(False)
+        asyncore.dispatcher.__init__(self, self._reader, map=socket_map)
+    
+    def wake(self):
+        try:
+            self._writer.send('x')
+        except socket.error:
+            # buffer full, the loop will wake up anyway
+            pass
+    
+    def writable(self):
+        return False
+    
+    def handle_read(self):
+        try:
+            self.recv(1024)
+        except socket.error:
+            pass
+
+
+class HTTPRequestDispatcher(asyncore.dispatcher):
+    
+    def __init__(self, engine, scheme, host, address_info, request, future, expires):
+        asyncore.dispatcher.__init__(self, map=engine.socket_map)
+        self.engine = engine
+        self.scheme = scheme
+        self.host = host
+        self.address_info = address_info
+        self.outgoing = request
+        self.incoming = []
+        self.future = future
+        self.expires = expires
+        self.handshake_done = (scheme != 'https')
+    
+    def start(self):
+        family, socktype, proto, canonname, sockaddr = self.address_info
+        self.create_socket(family, socktype)
+        try:
+            self.connect(sockaddr)
+        except socket.error, e:
+            self.fail(IOError(str(e)))
+    
+    def fail(self, exception):
+        self.close()
+        if not self.future.done():
+            self.future.set_exception(exception)
+        self.engine._finished(self, False)
+    
+    def writable(self):
+        return (not self.connected) or (not self.handshake_done) or bool(self.outgoing)
+    
+    def handle_connect(self):
+        if self.scheme != 'https':
+            return
+        context = self.engine.ssl_context
+        if context is None:
+            context = ssl.create_default_context()
+        self.del_channel()
+        wrapped_socket = context.wrap_socket(self.socket, do_handshake_on_connect=False,
+                                             server_hostname=self.host)
+        self.set_socket(wrapped_socket, self.engine.socket_map)
+    
+    def handle_write(self):
+        if not self.handshake_done:
+            return self.do_handshake()
+        try:
+            sent = self.send(self.outgoing)
+        except ssl_want_errors:
+            return
+        self.outgoing = self.outgoing[sent:]
+    
+    def handle_read(self):
+        if not self.handshake_done:
+            return self.do_handshake()
+        try:
+            data = self.recv(8192)
+            while data:
+                self.incoming.append(data)
+                if (ssl is None) or (not hasattr(self.socket, 'pending')) or \
+                    (not self.socket.pending()):
+                    break
+                data = self.recv(8192)
+        except ssl_want_errors:
+            return
+        except ssl_errors:
+            if not self.incoming:
+                raise
+            # many servers close TLS connections without close_notify
+            self.handle_close()
+    
+    def do_handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl_want_errors:
+            return
+        self.handshake_done = True
+    
+    def handle_close(self):
+        self.close()
+        if self.future.done():
+            return
+        response = ''.join(self.incoming)
+        try:
+            headers, content = response.split('\r\n\r\n', 1)
+            status = int(headers.split('\r\n', 1)[0].split(' ')[1])
+        except (ValueError, IndexError):
+            self.fail(IOError('invalid response from verify server'))
+            return
+        self.future.set_result((status, content))
+        self.engine._finished(self, True)
+    
+    def handle_error(self):
+        exception = sys.exc_info()[1]
+        self.fail(IOError(str(exception)))
+
+
+class NoSSLError(Exception):
+    pass
+
+# Non-blocking TLS (SSLContext, SSLWantReadError) was added in Python 2.7.9. 
+# Older versions can import this module but only send requests with HTTP.
+has_nonblocking_ssl = hasattr(ssl, 'SSLWantReadError')
+ssl_want_errors = (getattr(ssl, 'SSLWantReadError', NoSSLError), 
+                   getattr(ssl, 'SSLWantWriteError', NoSSLError))
+ssl_errors = (getattr(ssl, 'SSLError', NoSSLError),)
+
+
+class AsyncTransport(object):
+    """Transport for reCAPTCHAClient (callable(url, data, deadline=None)) 
+    which sends requests via the EventLoopEngine. 'timeout' limits the 
+    whole request."""
+    
+    def __init__(self, engine, timeout=None, clock=None):
+        self.engine = engine
+        self.timeout = timeout
+        self.clock = clock or time.time
+    
+    def __call__(self, url, data, deadline=None):
+        timeout = self.timeout
+        if deadline is not None:
+            timeout = deadline.timeout(timeout)
+        expires = None
+        if timeout is not None:
+            expires = self.clock() + timeout
+        future = self.engine.submit(url, data, expires)
+        try:
+            # the engine enforces the deadline, just wait a bit longer
+            status, content = future.result(timeout=(timeout is not None) and timeout + 1 or None)
+        except FutureTimeout:
+            raise DeadlineExceeded('verify server did not answer in time')
+        if status != 200:
+            raise IOError('HTTP status %d' % status)
+        return content
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+def engine_for(name, dns_cache_ttl=300):
+    """Return the per-process EventLoopEngine with the given name."""
+    _engines_lock.acquire()
+    try:
+        engine = _engines.get(name)
+        if engine is None:
+            engine = EventLoopEngine(dns_cache=DNSCache(ttl=dns_cache_ttl))
+            _engines[name] = engine
+        return engine
+    finally:
+        _engines_lock.release()
+
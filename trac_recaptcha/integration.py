@@ -22,17 +22,28 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import os
+import threading
 import urlparse
 
 from genshi.builder import tag
-from trac.config import BoolOption, Option
-from trac.core import Component, implements
+from genshi.core import Markup, Stream, TEXT
+from trac.config import BoolOption, IntOption, Option
+from trac.core import Component, ExtensionPoint, implements
 from trac.web.href import Href
 
-from trac_captcha.api import ICaptcha
+from trac_captcha.api import CaptchaFailedError, ICaptcha
+from trac_captcha.compat import FloatOption
 from trac_captcha.controller import TracCaptchaController
 from trac_captcha.i18n import _
-from trac_recaptcha.client import reCAPTCHAClient, is_empty
+from trac_captcha.lib.lru_cache import LRUCache
+from trac_recaptcha.client import reCAPTCHAClient, is_empty, UrlopenTransport
+from trac_recaptcha.coalescing import coalescer_for
+from trac_recaptcha.connection_pool import pool_for_url, SharedPoolTransport
+from trac_recaptcha.resilience import bulkhead_for, circuit_breaker_for, \
+    ResilientTransport
+from trac_recaptcha.sidecar import sidecar_client_for, SidecarUnavailable
+from trac_recaptcha.siteverify import provider_names
 from trac_recaptcha.genshi_widget import GenshiReCAPTCHAWidget
 
 __all__ = ['reCAPTCHAImplementation']
@@ -61,24 +72,138 @@ class reCAPTCHAImplementation(Component):
     theme = Option('recaptcha', 'theme')
     require_javascript = BoolOption('recaptcha', 'require_javascript', False)
     
+    connection_pool_size = IntOption('recaptcha', 'connection_pool_size', 4,
+        '''Maximum number of idle (keep-alive) connections to the reCAPTCHA 
+        verify server per process. 0 disables connection reuse.''')
+    
+    connection_idle_timeout = IntOption('recaptcha', 'connection_idle_timeout', 60,
+        '''Idle connections to the verify server are closed after this number
+        of seconds.''')
+    
+    dns_cache_ttl = IntOption('recaptcha', 'dns_cache_ttl', 300,
+        '''Number of seconds the IP addresses of the verify server are cached
+        (0 disables caching).''')
+    
+    prewarm_connections = BoolOption('recaptcha', 'prewarm_connections', False,
+        '''Open a connection to the verify servers of the configured captchas 
+        when the plugin is loaded so the first captcha verification does not
+        need to wait for the connection setup.''')
+    
+    verification_engine = Option('recaptcha', 'verification_engine', 'threads',
+        '''How requests to the verify server are sent: `threads` (every web
+        server thread sends its own request using the connection pool) or 
+        `event_loop` (a single background thread per process multiplexes all
+        requests so many verifications can be in flight at the same time, 
+        HTTPS verify servers require Python 2.7.9+).''')
+    
+    connect_timeout = FloatOption('recaptcha', 'connect_timeout', 3,
+        '''Maximum time (in seconds) to connect to the verify server.''')
+    
+    read_timeout = FloatOption('recaptcha', 'read_timeout', 5,
+        '''Maximum time (in seconds) to wait for data from the verify server.
+        Without connection pool (`connection_pool_size = 0`) urllib2 uses the
+        larger of both timeouts for connecting and reading.''')
+    
+    total_timeout = FloatOption('recaptcha', 'total_timeout', 8,
+        '''Maximum time (in seconds) for a captcha verification including 
+        waiting for a free slot (see `max_concurrent_verifications`). If the
+        verify server does not answer in time, the user gets an error 
+        message and can try again.''')
+    
+    max_concurrent_verifications = IntOption('recaptcha', 'max_concurrent_verifications', 8,
+        '''Maximum number of concurrent captcha verifications per process so 
+        that a stalled verify server can not block all worker threads. 0 
+        disables the limit.''')
+    
+    verification_slot_wait = FloatOption('recaptcha', 'verification_slot_wait', 0,
+        '''Time (in seconds) to wait for a free verification slot if 
+        `max_concurrent_verifications` is reached. 0 means fail 
+        immediately.''')
+    
+    circuit_error_rate = FloatOption('recaptcha', 'circuit_error_rate', 0.5,
+        '''Stop contacting the verify server for some time 
+        (`circuit_reset_timeout`) if this fraction of the recent verifications
+        (`circuit_window`) failed.''')
+    
+    circuit_window = IntOption('recaptcha', 'circuit_window', 20,
+        '''Number of recent verifications which are used to compute the error
+        rate. 0 disables the circuit breaker.''')
+    
+    circuit_min_calls = IntOption('recaptcha', 'circuit_min_calls', 5,
+        '''Minimum number of recent verifications before the circuit breaker
+        can open.''')
+    
+    circuit_reset_timeout = IntOption('recaptcha', 'circuit_reset_timeout', 30,
+        '''Number of seconds without any requests to the verify server after
+        the circuit breaker opened. Afterwards a single verification is sent
+        to check if the server is available again.''')
+    
+    circuit_open_policy = Option('recaptcha', 'circuit_open_policy', 'reject',
+        '''What to do with captcha submissions while the verify server is
+        considered down: `reject` (users see an error message), `accept` 
+        (submissions are accepted without verification, a warning is logged)
+        or `fallback` (display the captcha configured in `fallback_captcha` 
+        instead).''')
+    
+    fallback_captcha = Option('recaptcha', 'fallback_captcha', '',
+        '''Name of the component implementing `ICaptcha` which is used if
+        `circuit_open_policy` is `fallback`.''')
+    
+    verdict_cache_ttl = IntOption('recaptcha', 'verdict_cache_ttl', 5,
+        '''Number of seconds the verification result for a captcha solution 
+        is remembered so that duplicate submissions (e.g. double-clicked 
+        submit buttons) get the same result without asking the verify server
+        again. Concurrent duplicates always wait for a single verification.''')
+    
+    sidecar_socket = Option('recaptcha', 'sidecar_socket', '',
+        '''Path of the Unix socket of the verification daemon 
+        (`trac-captcha-sidecar`) which shares connections, cached verdicts and
+        the circuit breakers between all Trac processes on this host (for 
+        reCAPTCHA and all siteverify captchas). If the socket does not exist,
+        captchas are verified in-process.''')
+    
+    widget_cache_size = IntOption('recaptcha', 'widget_cache_size', 200,
+        '''Number of pre-rendered reCAPTCHA widgets (per language, theme and
+        error code) which are kept in memory. 0 disables the cache.''')
+    
+    captchas = ExtensionPoint(ICaptcha)
+    
+    def __init__(self):
+        super(reCAPTCHAImplementation, self).__init__()
+        self._widget_cache = None
+        self._widget_cache_settings = None
+        if self.prewarm_connections and (self.connection_pool_size > 0):
+            thread = threading.Thread(target=self.prewarm_connection_pool)
+            thread.setDaemon(True)
+            thread.start()
+    
     # --- ICaptcha -------------------------------------------------------------
     def genshi_stream(self, req):
         error_xml = self.warn_if_private_key_or_public_key_not_set(req)
         if error_xml is not None:
             return error_xml.generate()
+        fallback = self.active_fallback_captcha()
+        if fallback is not None:
+            return fallback.genshi_stream(req)
         error_code = self.error_code_from_request(req)
-        widget = GenshiReCAPTCHAWidget(self.public_key, 
-                                       error=error_code, js_config=self.js_config(req), 
-                                       log=self.env.log, noscript=not self.require_javascript)
-        genshi_element = widget.xml()
-        return genshi_element.generate()
+        return self.widget_stream(error_code, self.js_config(req))
+    
+    def has_solution(self, req):
+        return 'recaptcha_response_field' in req.args
     
     def assert_captcha_completed(self, req, client_class=None):
+        fallback = self.active_fallback_captcha()
+        if (fallback is not None) and ('recaptcha_response_field' not in req.args):
+            # user got the fallback captcha
+            return fallback.assert_captcha_completed(req)
         client = self.client(client_class)
         remote_ip = req.remote_addr
         challenge = req.args.get('recaptcha_challenge_field')
         response = req.args.get('recaptcha_response_field')
-        client.verify(remote_ip, challenge, response)
+        verified = self.verify_with_circuit_policy(req, 
+            lambda: self.verify_solution(client, remote_ip, challenge, response))
+        if not verified:
+            return
         
         controller = TracCaptchaController(self.env)
         base_message = 'Captcha for %(path)s successfully solved with %(challenge)s/%(response)s and %(arguments)s'
@@ -90,7 +215,187 @@ class reCAPTCHAImplementation(Component):
     
     def client(self, client_class):
         client_class = client_class and client_class or reCAPTCHAClient
-        return client_class(self.private_key)
+        return client_class(self.private_key, transport=self.transport(),
+                            circuit_breaker=self.circuit_breaker(),
+                            coalescer=self.coalescer())
+    
+    def widget_stream(self, error_code, js_config):
+        '''Return the widget as a stream with a single (pre-rendered) event. 
+        The markup only depends on public key, language, theme, error code 
+        and the noscript setting so it is cached.'''
+        noscript = not self.require_javascript
+        def build_widget():
+            return GenshiReCAPTCHAWidget(self.public_key, error=error_code, 
+                                         js_config=js_config, log=self.env.log, 
+                                         noscript=noscript)
+        cache = self.widget_cache()
+        if cache is None:
+            return build_widget().xml().generate()
+        language = (js_config or {}).get('lang')
+        key = (self.public_key, language, self.theme, error_code, noscript)
+        markup = cache.get(key)
+        if markup is None:
+            stream = build_widget().xml().generate()
+            markup = Markup(stream.render('xhtml', encoding=None))
+            cache.set(key, markup)
+        return Stream([(TEXT, markup, (None, -1, -1))])
+    
+    def widget_cache(self):
+        # the cache is discarded if the [recaptcha] settings changed
+        settings = (self.widget_cache_size, self.public_key, self.theme, 
+                    self.require_javascript)
+        if self._widget_cache_settings != settings:
+            cache = None
+            if self.widget_cache_size > 0:
+                cache = LRUCache(maxsize=self.widget_cache_size)
+            self._widget_cache = cache
+            self._widget_cache_settings = settings
+        return self._widget_cache
+    
+    def verify_with_circuit_policy(self, req, verify):
+        '''Call 'verify' and apply the `circuit_open_policy` if the verify 
+        server is considered down. Return False if the submission was 
+        accepted without verification.'''
+        try:
+            verify()
+        except CaptchaFailedError, e:
+            if not e.captcha_data.get('circuit_open'):
+                raise
+            if self.circuit_open_policy != 'accept':
+                # 'fallback': the fallback captcha is displayed with the error
+                raise
+            self.env.log.warning('Accepted captcha for %s without verification because the verify server is not available' % req.path_info)
+            return False
+        return True
+    
+    def verify_solution(self, client, remote_ip, challenge, response):
+        sidecar = self.sidecar()
+        if sidecar is not None:
+            try:
+                return sidecar.verify(self.private_key, remote_ip, challenge, response)
+            except SidecarUnavailable, e:
+                self.env.log.debug('reCAPTCHA sidecar not available (%s), verifying in-process' % e)
+        client.verify(remote_ip, challenge, response)
+    
+    def sidecar(self):
+        if (not self.sidecar_socket) or (not os.path.exists(self.sidecar_socket)):
+            return None
+        return sidecar_client_for(self.sidecar_socket, timeout=self.total_timeout or None)
+    
+    def coalescer(self):
+        return coalescer_for('recaptcha', ttl=self.verdict_cache_ttl,
+                             wait_timeout=self.total_timeout or None)
+    
+    def circuit_breaker(self, name='recaptcha'):
+        '''Return the circuit breaker for the verify server of the given 
+        provider (all providers share the same settings).'''
+        if self.circuit_window <= 0:
+            return None
+        def log_circuit_transition(old_state, new_state):
+            self.env.log.warning('%s circuit breaker changed from %s to %s' % (name, old_state, new_state))
+        return circuit_breaker_for(name, error_rate=self.circuit_error_rate,
+            window=self.circuit_window, min_calls=self.circuit_min_calls, 
+            reset_timeout=self.circuit_reset_timeout, 
+            listener=log_circuit_transition)
+    
+    def active_fallback_captcha(self, name='recaptcha', current=None):
+        '''Return the fallback captcha if the verify server (of provider 
+        'name') is considered down and the fallback policy is active, None 
+        otherwise.'''
+        current = current or self
+        if self.circuit_open_policy != 'fallback':
+            return None
+        breaker = self.circuit_breaker(name)
+        if (breaker is None) or (not breaker.is_open()):
+            return None
+        for captcha in self.captchas:
+            if (captcha.__class__.__name__ == self.fallback_captcha) and (captcha is not current):
+                return captcha
+        self.env.log.warning('Fallback captcha %r not found' % self.fallback_captcha)
+        return None
+    
+    def connection_pool(self, verify_url=None):
+        if verify_url is None:
+            verify_url = reCAPTCHAClient(self.private_key).verify_server()
+        return pool_for_url(verify_url, maxsize=self.connection_pool_size,
+                            idle_timeout=self.connection_idle_timeout,
+                            timeout=self.connect_timeout,
+                            dns_cache_ttl=self.dns_cache_ttl)
+    
+    def bulkhead(self):
+        if self.max_concurrent_verifications <= 0:
+            return None
+        return bulkhead_for('recaptcha', self.max_concurrent_verifications, 
+                            max_wait=self.verification_slot_wait)
+    
+    def transport(self):
+        '''Return the transport which is shared by all providers (requests to
+        different verify servers use separate connection pools).'''
+        if self.verification_engine == 'event_loop':
+            # the engine is optional, only load it if it is configured
+            from trac_recaptcha.event_loop import AsyncTransport, engine_for
+            engine = engine_for('recaptcha', dns_cache_ttl=self.dns_cache_ttl)
+            transport = AsyncTransport(engine, 
+                timeout=(self.connect_timeout + self.read_timeout) or None)
+        elif self.connection_pool_size > 0:
+            transport = SharedPoolTransport(maxsize=self.connection_pool_size,
+                idle_timeout=self.connection_idle_timeout, 
+                connect_timeout=self.connect_timeout, read_timeout=self.read_timeout,
+                dns_cache_ttl=self.dns_cache_ttl)
+        else:
+            # urllib2 uses the same timeout for connecting and each read
+            transport = UrlopenTransport(
+                timeout=max(self.connect_timeout, self.read_timeout) or None)
+        return ResilientTransport(transport, bulkhead=self.bulkhead(), 
+                                  total_timeout=self.total_timeout or None)
+    
+    def verification_stats(self):
+        '''Return counters of the verification bulkhead (including the time 
+        spent waiting for a free slot), the circuit breaker and the 
+        coalescing of duplicate verifications (and of the event loop if 
+        enabled). The circuit breakers of the siteverify providers are listed
+        in 'providers'.'''
+        stats = dict(bulkhead=None, circuit_breaker=None)
+        bulkhead = self.bulkhead()
+        if bulkhead is not None:
+            stats['bulkhead'] = bulkhead.stats()
+        breaker = self.circuit_breaker()
+        if breaker is not None:
+            stats['circuit_breaker'] = breaker.stats()
+            stats['providers'] = dict([(name, self.circuit_breaker(name).stats()) 
+                                       for name in provider_names()])
+        stats['coalescer'] = self.coalescer().stats()
+        if self.verification_engine == 'event_loop':
+            from trac_recaptcha.event_loop import engine_for
+            stats['event_loop'] = engine_for('recaptcha').stats()
+        return stats
+    
+    def verify_urls(self):
+        '''Return the URLs of the verify servers of all configured captchas
+        (reCAPTCHA and siteverify captchas).'''
+        verify_urls = []
+        for captcha in TracCaptchaController(self.env).captcha_chain():
+            if captcha is self:
+                verify_url = reCAPTCHAClient(self.private_key).verify_server()
+            elif getattr(captcha, 'provider', None) is not None:
+                verify_url = captcha.provider.verify_url
+            else:
+                continue
+            if verify_url not in verify_urls:
+                verify_urls.append(verify_url)
+        return verify_urls
+    
+    def prewarm_connection_pool(self):
+        try:
+            verify_urls = self.verify_urls()
+        except Exception, e:
+            self.env.log.warning('Could not determine the verify servers: %s' % e)
+            return
+        for verify_url in verify_urls:
+            try:
+                self.connection_pool(verify_url).prewarm()
+            except Exception, e:
+                self.env.log.warning('Could not connect to the verify server %s: %s' % (verify_url, e))
     
     def error_code_from_request(self, req):
         if hasattr(req, 'captcha_data'):
@@ -0,0 +1,263 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from genshi.builder import tag
+from trac.config import IntOption, Option
+from trac.core import Component, ExtensionPoint, implements
+
+from trac_captcha.api import CaptchaFailedError, ICaptcha
+from trac_captcha.claims import score_claim, token_score
+from trac_captcha.compat import FloatOption
+from trac_captcha.controller import is_shared_widget_request, TracCaptchaController
+from trac_captcha.i18n import _
+from trac_recaptcha.client import is_empty
+from trac_recaptcha.integration import reCAPTCHAImplementation
+from trac_recaptcha.sidecar import SidecarUnavailable
+from trac_recaptcha.siteverify import hCaptchaProvider, reCAPTCHAv2Provider, \
+    reCAPTCHAv3Provider, SiteverifyClient, TurnstileProvider
+from trac_recaptcha.siteverify_widget import SiteverifyWidget
+
+__all__ = ['hCaptchaImplementation', 'reCAPTCHAv2Implementation', 
+           'reCAPTCHAv3Implementation', 'TurnstileImplementation']
+
+SCORE_COOKIE_NAME = 'trac_captcha_score'
+# form field which marks submissions of the escalation captcha
+ESCALATED_FIELD = '__captcha_escalated'
+
+
+class SiteverifyCaptcha(Component):
+    """Base class for captchas which are verified with a siteverify API. 
+    Transport, timeouts, circuit breaker settings and metrics are shared with
+    reCAPTCHAImplementation (configured in [recaptcha])."""
+    
+    abstract = True
+    implements(ICaptcha)
+    
+    # SiteverifyProvider, set by subclasses
+    provider = None
+    # subclasses declare the options 'site_key', 'secret_key' and 'theme' in 
+    # the section named like the provider.
+    
+    # --- ICaptcha -------------------------------------------------------------
+    def genshi_stream(self, req):
+        error_xml = self.warn_if_keys_not_set()
+        if error_xml is not None:
+            return error_xml.generate()
+        fallback = self.recaptcha().active_fallback_captcha(self.provider.name, current=self)
+        if fallback is not None:
+            return fallback.genshi_stream(req)
+        return self.widget_xml(req).generate()
+    
+    def has_solution(self, req):
+        return self.provider.response_field in req.args
+    
+    def assert_captcha_completed(self, req, client=None):
+        recaptcha = self.recaptcha()
+        fallback = recaptcha.active_fallback_captcha(self.provider.name, current=self)
+        if (fallback is not None) and (not self.has_solution(req)):
+            # user got the fallback captcha
+            return fallback.assert_captcha_completed(req)
+        client = client or self.client()
+        response = req.args.get(self.provider.response_field)
+        recaptcha.verify_with_circuit_policy(req, 
+            lambda: self.verify_response(req, client, response))
+    
+    # --- private --------------------------------------------------------------
+    
+    def recaptcha(self):
+        return reCAPTCHAImplementation(self.env)
+    
+    def client(self):
+        recaptcha = self.recaptcha()
+        return SiteverifyClient(self.provider, self.secret_key, site_key=self.site_key,
+                                transport=recaptcha.transport(),
+                                circuit_breaker=recaptcha.circuit_breaker(self.provider.name),
+                                coalescer=recaptcha.coalescer())
+    
+    def verify_response(self, req, client, response):
+        return self.verify_solution(client, req.remote_addr, response)
+    
+    def verify_solution(self, client, remote_ip, response, expected_action=None):
+        sidecar = self.recaptcha().sidecar()
+        if sidecar is not None:
+            try:
+                return sidecar.siteverify(self.provider.name, self.secret_key, 
+                    self.site_key, remote_ip, response, expected_action)
+            except SidecarUnavailable, e:
+                self.env.log.debug('%s sidecar not available (%s), verifying in-process' % (self.provider.name, e))
+        return client.verify(remote_ip, response, expected_action=expected_action)
+    
+    def widget(self, req):
+        language = None
+        if getattr(req, 'locale', None) is not None:
+            # For trac 0.12 without Babel installed, req.locale is None
+            language = req.locale.language
+        return SiteverifyWidget(self.provider, self.site_key, 
+                                theme=getattr(self, 'theme', None), language=language)
+    
+    def widget_xml(self, req):
+        return self.widget(req).xml()
+    
+    def warn_if_keys_not_set(self):
+        if is_empty(self.site_key) or is_empty(self.secret_key):
+            return tag.div(
+                _(u'No keys for %(provider)s configured. Please add your keys '
+                  u'to your trac.ini ([%(section)s] site_key, secret_key).') % 
+                dict(provider=self.provider.name, section=self.provider.name))
+        return None
+
+
+class reCAPTCHAv2Implementation(SiteverifyCaptcha):
+    provider = reCAPTCHAv2Provider()
+    
+    site_key = Option('recaptcha-v2', 'site_key')
+    secret_key = Option('recaptcha-v2', 'secret_key')
+    theme = Option('recaptcha-v2', 'theme', '',
+        '''Widget theme (`light` or `dark`).''')
+
+
+class reCAPTCHAv3Implementation(SiteverifyCaptcha):
+    """Invisible captcha: the user only has to solve an interactive captcha 
+    (`escalation_captcha`) if the reCAPTCHA score is too low."""
+    
+    provider = reCAPTCHAv3Provider()
+    
+    site_key = Option('recaptcha-v3', 'site_key')
+    secret_key = Option('recaptcha-v3', 'secret_key')
+    action = Option('recaptcha-v3', 'action', 'submit',
+        '''Action name which is sent with the token and checked during 
+        verification.''')
+    min_score = FloatOption('recaptcha-v3', 'min_score', 0.5,
+        '''Minimum score (0.0 - 1.0) for a submission to be accepted.''')
+    escalation_captcha = Option('recaptcha-v3', 'escalation_captcha', 
+        'reCAPTCHAv2Implementation',
+        '''Name of the component implementing `ICaptcha` which is displayed
+        if the score was too low. Leave empty to reject these submissions.''')
+    score_cache_ttl = IntOption('recaptcha-v3', 'score_cache_ttl', 300,
+        '''Number of seconds an accepted score is remembered in a signed 
+        cookie. Further submissions in this time are accepted without 
+        contacting the verify server (and the widget script is not loaded). 
+        0 disables the cache.''')
+    
+    captchas = ExtensionPoint(ICaptcha)
+    
+    # --- ICaptcha -------------------------------------------------------------
+    def genshi_stream(self, req):
+        escalation = self.active_escalation_captcha(req)
+        if escalation is not None:
+            marker = tag.input(type='hidden', name=ESCALATED_FIELD, value='1')
+            return tag(escalation.genshi_stream(req), marker).generate()
+        if (not is_shared_widget_request(req)) and (self.cached_score(req) is not None):
+            return tag().generate()
+        return SiteverifyCaptcha.genshi_stream(self, req)
+    
+    def assert_captcha_completed(self, req, client=None):
+        escalation = self.find_escalation_captcha()
+        if (escalation is not None) and req.args.get(ESCALATED_FIELD):
+            try:
+                escalation.assert_captcha_completed(req)
+            except CaptchaFailedError, e:
+                # display the interactive captcha again
+                e.captcha_data['escalate'] = True
+                raise
+            return
+        if self.cached_score(req) is not None:
+            return
+        SiteverifyCaptcha.assert_captcha_completed(self, req, client)
+    
+    # --- private --------------------------------------------------------------
+    
+    def verify_response(self, req, client, response):
+        if is_empty(response) and (self.find_escalation_captcha() is not None):
+            # the reCAPTCHA script was not loaded (e.g. blocked), the widget
+            # lets the form submit without token
+            captcha_data = dict(error_code='missing-input-response', escalate=True)
+            raise CaptchaFailedError(_(u'Please solve the captcha to continue.'), captcha_data)
+        result = self.verify_solution(client, req.remote_addr, response, 
+                                      expected_action=self.action)
+        score = result.get('score', 0)
+        if score < self.min_score:
+            self.env.log.debug('reCAPTCHA v3 score %s for %s is too low' % (score, req.path_info))
+            captcha_data = dict(error_code='low-score')
+            if self.find_escalation_captcha() is not None:
+                captcha_data['escalate'] = True
+            raise CaptchaFailedError(_(u'Please solve the captcha to continue.'), captcha_data)
+        if self.score_cache_ttl > 0:
+            self.remember_score(req, score)
+        return result
+    
+    def widget_xml(self, req):
+        return self.widget(req).xml(invisible_action=self.action)
+    
+    def find_escalation_captcha(self):
+        for captcha in self.captchas:
+            if (captcha.__class__.__name__ == self.escalation_captcha) and (captcha is not self):
+                return captcha
+        return None
+    
+    def active_escalation_captcha(self, req):
+        if not getattr(req, 'captcha_data', {}).get('escalate'):
+            return None
+        return self.find_escalation_captcha()
+    
+    def cached_score(self, req):
+        """Return the score from the score cookie if it is still valid and 
+        high enough, None otherwise."""
+        if self.score_cache_ttl <= 0:
+            return None
+        cookie = req.incookie.get(SCORE_COOKIE_NAME)
+        if cookie is None:
+            return None
+        verified_token = TracCaptchaController(self.env).verified_token(cookie.value)
+        if verified_token is None:
+            return None
+        score = token_score(verified_token)
+        if (score is None) or (score < self.min_score):
+            return None
+        return score
+    
+    def remember_score(self, req, score):
+        controller = TracCaptchaController(self.env)
+        token = controller.key_ring().generate_token(ttl=self.score_cache_ttl, 
+                                                     claims=score_claim(score))
+        controller.set_cookie(req, SCORE_COOKIE_NAME, token, self.score_cache_ttl)
+
+
+class hCaptchaImplementation(SiteverifyCaptcha):
+    provider = hCaptchaProvider()
+    
+    site_key = Option('hcaptcha', 'site_key')
+    secret_key = Option('hcaptcha', 'secret_key')
+    theme = Option('hcaptcha', 'theme', '',
+        '''Widget theme (`light` or `dark`).''')
+
+
+class TurnstileImplementation(SiteverifyCaptcha):
+    provider = TurnstileProvider()
+    
+    site_key = Option('turnstile', 'site_key')
+    secret_key = Option('turnstile', 'secret_key')
+    theme = Option('turnstile', 'theme', '',
+        '''Widget theme (`light`, `dark` or `auto`).''')
+
@@ -0,0 +1,317 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+import time
+
+__all__ = ['Bulkhead', 'bulkhead_for', 'BulkheadFullError', 'CircuitBreaker',
+           'circuit_breaker_for', 'Deadline', 'DeadlineExceeded', 
+           'ResilientTransport']
+
+
+class DeadlineExceeded(IOError):
+    pass
+
+
+class BulkheadFullError(IOError):
+    pass
+
+
+class Deadline(object):
+    """Time budget for a single verification (including waiting for a 
+    bulkhead slot, connecting and reading the response)."""
+    
+    def __init__(self, seconds=None, clock=None):
+        self.clock = clock or time.time
+        self.expires = None
+        if seconds is not None:
+            self.expires = self.clock() + seconds
+    
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return self.expires - self.clock()
+    
+    def timeout(self, limit=None):
+        """Return the timeout for the next operation: 'limit' but at most the
+        remaining time. DeadlineExceeded is raised if no time is left."""
+        remaining = self.remaining()
+        if remaining is None:
+            return limit
+        if remaining <= 0:
+            raise DeadlineExceeded('time budget for captcha verification exceeded')
+        if limit is None:
+            return remaining
+        return min(limit, remaining)
+
+
+class Bulkhead(object):
+    """Limits the number of concurrent verifications so that a stalled verify
+    server can only block a few worker threads. Callers which do not get a 
+    slot within 'max_wait' seconds fail with BulkheadFullError (with the 
+    default max_wait=0 they fail immediately).
+    
+    The time callers spent waiting for a slot is recorded (see stats())."""
+    
+    def __init__(self, max_concurrent, max_wait=0, clock=None):
+        self.max_concurrent = max_concurrent
+        self.max_wait = max_wait
+        self.clock = clock or time.time
+        self._condition = threading.Condition(threading.Lock())
+        self.in_use = 0
+        self.acquired = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.longest_wait = 0.0
+    
+    def acquire(self, timeout=None):
+        """Wait at most 'timeout' seconds (default: max_wait) for a slot and 
+        return the time spent waiting."""
+        if timeout is None:
+            timeout = self.max_wait
+        start = self.clock()
+        self._condition.acquire()
+        try:
+            while self.in_use >= self.max_concurrent:
+                remaining = start + timeout - self.clock()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise BulkheadFullError('too many concurrent captcha verifications')
+                self._condition.wait(remaining)
+            self.in_use += 1
+            waited = self.clock() - start
+            self.acquired += 1
+            self.total_wait += waited
+            self.longest_wait = max(self.longest_wait, waited)
+            return waited
+        finally:
+            self._condition.release()
+    
+    def release(self):
+        self._condition.acquire()
+        try:
+            self.in_use -= 1
+            self._condition.notify()
+        finally:
+            self._condition.release()
+    
+    def stats(self):
+        self._condition.acquire()
+        try:
+            return dict(in_use=self.in_use, max_concurrent=self.max_concurrent,
+                        acquired=self.acquired, rejected=self.rejected, 
+                        total_wait=self.total_wait, longest_wait=self.longest_wait)
+        finally:
+            self._condition.release()
+
+
+_bulkheads = {}
+_registry_lock = threading.Lock()
+
+def bulkhead_for(name, max_concurrent, max_wait=0):
+    """Return the per-process bulkhead with the given name (a new bulkhead is
+    created if the limits changed)."""
+    _registry_lock.acquire()
+    try:
+        bulkhead = _bulkheads.get(name)
+        if (bulkhead is None) or (bulkhead.max_concurrent != max_concurrent) or \
+            (bulkhead.max_wait != max_wait):
+            bulkhead = Bulkhead(max_concurrent, max_wait=max_wait)
+            _bulkheads[name] = bulkhead
+        return bulkhead
+    finally:
+        _registry_lock.release()
+
+
+class CircuitBreaker(object):
+    """Stops calling the verify server after too many failures.
+    
+    The breaker opens if at least 'error_rate' of the last 'window' calls 
+    failed (but only after 'min_calls' calls). While open, no calls are made 
+    for 'reset_timeout' seconds. Afterwards a single probe call is allowed 
+    ("half open"): If it succeeds, the breaker closes, otherwise it opens 
+    again.
+    
+    All state changes are counted (see stats()) and reported to the optional
+    'listener' (callable(old_state, new_state))."""
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    
+    def __init__(self, error_rate=0.5, window=20, min_calls=5, reset_timeout=30,
+                 listener=None, clock=None):
+        self.error_rate = error_rate
+        self.window = window
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.listener = listener
+        self.clock = clock or time.time
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.outcomes = []
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.transitions = {}
+    
+    def allow_request(self):
+        self._lock.acquire()
+        try:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if self.opened_at + self.reset_timeout > self.clock():
+                    return False
+                self._change_state(self.HALF_OPEN)
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+            return True
+        finally:
+            self._lock.release()
+    
+    def record_success(self):
+        self._record(True)
+    
+    def record_failure(self):
+        self._record(False)
+    
+    def record_skipped(self):
+        """The allowed call was not made (e.g. because of local limits)."""
+        self._lock.acquire()
+        try:
+            self.probe_in_flight = False
+        finally:
+            self._lock.release()
+    
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.outcomes = []
+            self.probe_in_flight = False
+            if self.state != self.CLOSED:
+                self._change_state(self.CLOSED)
+        finally:
+            self._lock.release()
+    
+    def is_open(self):
+        """Return True if calls would be rejected right now."""
+        self._lock.acquire()
+        try:
+            if self.state == self.OPEN:
+                return self.opened_at + self.reset_timeout > self.clock()
+            if self.state == self.HALF_OPEN:
+                return self.probe_in_flight
+            return False
+        finally:
+            self._lock.release()
+    
+    def stats(self):
+        self._lock.acquire()
+        try:
+            failures = self.outcomes.count(False)
+            return dict(state=self.state, calls=len(self.outcomes), 
+                        failures=failures, transitions=self.transitions.copy())
+        finally:
+            self._lock.release()
+    
+    # --- private API ----------------------------------------------------------
+    
+    def _record(self, success):
+        self._lock.acquire()
+        try:
+            if self.state == self.HALF_OPEN:
+                self.probe_in_flight = False
+                if success:
+                    self.outcomes = []
+                    self._change_state(self.CLOSED)
+                else:
+                    self._open()
+                return
+            if self.state == self.OPEN:
+                # late result of a call which started before the breaker opened
+                return
+            self.outcomes.append(success)
+            del self.outcomes[:-self.window]
+            failures = self.outcomes.count(False)
+            if (len(self.outcomes) >= self.min_calls) and \
+                (failures >= self.error_rate * len(self.outcomes)):
+                self._open()
+        finally:
+            self._lock.release()
+    
+    def _open(self):
+        self.opened_at = self.clock()
+        self._change_state(self.OPEN)
+    
+    def _change_state(self, new_state):
+        old_state = self.state
+        self.state = new_state
+        transition = '%s->%s' % (old_state, new_state)
+        self.transitions[transition] = self.transitions.get(transition, 0) + 1
+        if self.listener is not None:
+            self.listener(old_state, new_state)
+
+
+_circuit_breakers = {}
+
+def circuit_breaker_for(name, **settings):
+    """Return the per-process circuit breaker with the given name so that all
+    threads share the same state (a new breaker is created if the settings 
+    changed)."""
+    listener = settings.pop('listener', None)
+    _registry_lock.acquire()
+    try:
+        breaker, breaker_settings = _circuit_breakers.get(name, (None, None))
+        if breaker_settings != settings:
+            breaker = CircuitBreaker(listener=listener, **settings)
+            _circuit_breakers[name] = (breaker, settings)
+        return breaker
+    finally:
+        _registry_lock.release()
+
+
+class ResilientTransport(object):
+    """Wraps a transport (callable(url, data, deadline=None)) so that every
+    call has a total time budget of 'total_timeout' seconds and needs a slot
+    in the bulkhead. Both failures raise IOError subclasses so the 
+    reCAPTCHAClient reports 'recaptcha-not-reachable'."""
+    
+    def __init__(self, transport, bulkhead=None, total_timeout=None, clock=None):
+        self.transport = transport
+        self.bulkhead = bulkhead
+        self.total_timeout = total_timeout
+        self.clock = clock
+    
+    def __call__(self, url, data, deadline=None):
+        if deadline is None:
+            deadline = Deadline(self.total_timeout, clock=self.clock)
+        if self.bulkhead is None:
+            return self.transport(url, data, deadline=deadline)
+        self.bulkhead.acquire(timeout=deadline.timeout(self.bulkhead.max_wait))
+        try:
+            return self.transport(url, data, deadline=deadline)
+        finally:
+            self.bulkhead.release()
+
@@ -0,0 +1,414 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Standalone daemon which verifies captcha solutions (reCAPTCHA v1 and all
+siteverify providers) for all Trac processes on a host so the connection 
+pool, the verdict cache and the circuit breakers are shared (instead of one
+copy per process).
+
+    trac-captcha-sidecar --socket /var/run/trac/recaptcha.sock
+
+Trac uses the daemon if '[recaptcha] sidecar_socket' is set and falls back
+to in-process verification if the socket does not exist or the daemon is not
+running.
+
+Protocol: every message is a frame (4 byte length, big endian) which 
+contains a list of byte strings (2 byte length + string each).
+    request:  'verify', private_key, remote_ip, challenge, response
+              'siteverify', provider, secret_key, site_key, remote_ip, 
+              response, expected_action
+    response: 'ok' (siteverify: 'ok', verification result as JSON) or 
+              'error', error_code, message, circuit_open ('1'/'0')
+"""
+
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+from optparse import OptionParser
+from SocketServer import StreamRequestHandler, ThreadingUnixStreamServer
+
+from trac_recaptcha.client import CaptchaFailedError, reCAPTCHAClient
+from trac_recaptcha.coalescing import coalescer_for
+from trac_recaptcha.connection_pool import pool_for_url, PooledTransport
+from trac_recaptcha.resilience import bulkhead_for, circuit_breaker_for, \
+    ResilientTransport
+from trac_recaptcha.siteverify import json, provider_by_name, SiteverifyClient
+
+__all__ = ['main', 'SidecarClient', 'sidecar_client_for', 'SidecarServer', 
+           'SidecarUnavailable']
+
+
+MAX_FRAME_SIZE = 64 * 1024
+
+class SidecarUnavailable(IOError):
+    pass
+
+
+def pack_frame(fields):
+    payload = ''.join([struct.pack('>H', len(field)) + field for field in fields])
+    return struct.pack('>I', len(payload)) + payload
+
+def unpack_fields(payload):
+    fields = []
+    position = 0
+    while position < len(payload):
+        if position + 2 > len(payload):
+            raise IOError('truncated field')
+        length = struct.unpack('>H', payload[position:position+2])[0]
+        position += 2
+        if position + length > len(payload):
+            raise IOError('truncated field')
+        fields.append(payload[position:position+length])
+        position += length
+    return fields
+
+def read_frame(read):
+    """Read a frame with 'read' (callable(nr_bytes) which returns exactly 
+    nr_bytes or less at the end of the stream). Returns None if the stream 
+    ended before a new frame."""
+    header = read(4)
+    if not header:
+        return None
+    if len(header) < 4:
+        raise IOError('truncated frame')
+    length = struct.unpack('>I', header)[0]
+    if length > MAX_FRAME_SIZE:
+        raise IOError('frame too large')
+    payload = read(length)
+    if len(payload) < length:
+        raise IOError('truncated frame')
+    return unpack_fields(payload)
+
+
+def to_utf8(value):
+    if value is None:
+        return ''
+    return hasattr(value, 'encode') and value.encode('utf-8') or value
+
+
+class SidecarClient(object):
+    """Sends verification requests to the sidecar daemon, connections are
+    kept open for later requests."""
+    
+    def __init__(self, socket_path, timeout=None, max_idle=8):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+    
+    def verify(self, private_key, remote_ip, challenge, response):
+        """Raises CaptchaFailedError like reCAPTCHAClient.verify() and 
+        SidecarUnavailable if the daemon could not be reached (the solution 
+        was not verified in that case)."""
+        request = pack_frame(['verify'] + map(to_utf8, [private_key, remote_ip, challenge, response]))
+        fields = self._request(request)
+        if fields[0] == 'ok':
+            return
+        self._raise_error(fields)
+    
+    def siteverify(self, provider_name, secret_key, site_key, remote_ip, 
+                   response, expected_action=None):
+        """Like SiteverifyClient.verify(): return the verification result if
+        the solution was accepted, raise CaptchaFailedError otherwise. Raises
+        SidecarUnavailable if the daemon could not be reached or does not 
+        support siteverify requests (the solution was not verified)."""
+        if json is None:
+            # the in-process client reports the missing JSON module
+            raise SidecarUnavailable('JSON module not available')
+        request = pack_frame(['siteverify'] + map(to_utf8, [provider_name, 
+            secret_key, site_key, remote_ip, response, expected_action]))
+        fields = self._request(request)
+        if (fields[0] == 'ok') and (len(fields) == 2):
+            try:
+                return json.loads(fields[1])
+            except ValueError:
+                self._raise_not_reachable()
+        if (fields[0] == 'error') and (fields[1:2] == ['invalid-request']):
+            # older daemon which only verifies reCAPTCHA v1 solutions
+            raise SidecarUnavailable('sidecar does not support siteverify requests')
+        self._raise_error(fields)
+    
+    def close(self):
+        self._lock.acquire()
+        try:
+            for connection in self._idle:
+                connection.close()
+            self._idle = []
+        finally:
+            self._lock.release()
+    
+    # --- private API ----------------------------------------------------------
+    
+    def _raise_error(self, fields):
+        if (fields[0] != 'error') or (len(fields) < 4):
+            raise SidecarUnavailable('invalid response from sidecar')
+        error_code, msg, circuit_open = fields[1:4]
+        captcha_data = dict(error_code=error_code)
+        if circuit_open == '1':
+            captcha_data['circuit_open'] = True
+        raise CaptchaFailedError(msg.decode('utf-8'), captcha_data)
+    
+    def _request(self, request):
+        # nothing was sent if connecting fails (SidecarUnavailable) so the 
+        # caller can verify the solution in-process.
+        connection, reused = self._get_connection()
+        try:
+            fields = self._send(connection, request)
+        except (IOError, socket.error), e:
+            connection.close()
+            if (not reused) or isinstance(e, socket.timeout):
+                self._raise_not_reachable()
+            # idle connection was closed by the daemon (e.g. restart), a 
+            # duplicate request is answered from the verdict cache.
+            try:
+                connection, reused = self._get_connection(new=True)
+                fields = self._send(connection, request)
+            except (IOError, socket.error):
+                connection.close()
+                self._raise_not_reachable()
+        self._release(connection)
+        return fields
+    
+    def _raise_not_reachable(self):
+        # the request might have reached the daemon so the solution must not 
+        # be verified again in-process (reCAPTCHA solutions are single use).
+        reCAPTCHAClient(None).raise_server_unreachable_error()
+    
+    def _get_connection(self, new=False):
+        if not new:
+            self._lock.acquire()
+            try:
+                if self._idle:
+                    return (self._idle.pop(), True)
+            finally:
+                self._lock.release()
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        try:
+            connection.connect(self.socket_path)
+        except socket.error, e:
+            connection.close()
+            raise SidecarUnavailable(str(e))
+        return (connection, False)
+    
+    def _send(self, connection, request):
+        connection.sendall(request)
+        def read(nr_bytes):
+            chunks = []
+            missing = nr_bytes
+            while missing > 0:
+                data = connection.recv(missing)
+                if not data:
+                    break
+                chunks.append(data)
+                missing -= len(data)
+            return ''.join(chunks)
+        fields = read_frame(read)
+        if not fields:
+            raise IOError('sidecar closed the connection')
+        return fields
+    
+    def _release(self, connection):
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        finally:
+            self._lock.release()
+        connection.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def sidecar_client_for(socket_path, timeout=None):
+    """Return the per-process SidecarClient for the given socket."""
+    _clients_lock.acquire()
+    try:
+        client = _clients.get(socket_path)
+        if (client is None) or (client.timeout != timeout):
+            client = SidecarClient(socket_path, timeout=timeout)
+            _clients[socket_path] = client
+        return client
+    finally:
+        _clients_lock.release()
+
+
+class SidecarRequestHandler(StreamRequestHandler):
+    
+    def handle(self):
+        while True:
+            try:
+                fields = read_frame(self.rfile.read)
+            except IOError:
+                return
+            if fields is None:
+                return
+            self.wfile.write(pack_frame(self.server.handle_request(fields)))
+            self.wfile.flush()
+
+
+class SidecarServer(ThreadingUnixStreamServer):
+    """'client_factory' is a callable(private_key) which returns a 
+    reCAPTCHAClient, 'siteverify_client_factory' a callable(provider, 
+    secret_key, site_key) which returns a SiteverifyClient (siteverify 
+    requests are rejected if it is None)."""
+    
+    daemon_threads = True
+    
+    def __init__(self, socket_path, client_factory, mode=0660, 
+                 siteverify_client_factory=None):
+        if os.path.exists(socket_path):
+            # stale socket from a previous run
+            os.unlink(socket_path)
+        ThreadingUnixStreamServer.__init__(self, socket_path, SidecarRequestHandler)
+        os.chmod(socket_path, mode)
+        self.socket_path = socket_path
+        self.client_factory = client_factory
+        self.siteverify_client_factory = siteverify_client_factory
+    
+    def handle_request(self, fields):
+        if (len(fields) == 5) and (fields[0] == 'verify'):
+            handler = self.verify
+        elif (len(fields) == 7) and (fields[0] == 'siteverify') and \
+                (self.siteverify_client_factory is not None):
+            handler = self.siteverify
+        else:
+            return self.invalid_request()
+        arguments = [field.decode('utf-8') for field in fields[1:]]
+        try:
+            return handler(*arguments)
+        except CaptchaFailedError, e:
+            circuit_open = e.captcha_data.get('circuit_open') and '1' or '0'
+            return ['error', to_utf8(e.captcha_data.get('error_code')), 
+                    to_utf8(e.msg), circuit_open]
+    
+    def verify(self, private_key, remote_ip, challenge, response):
+        self.client_factory(private_key).verify(remote_ip, challenge, response)
+        return ['ok']
+    
+    def siteverify(self, provider_name, secret_key, site_key, remote_ip, 
+                   response, expected_action):
+        try:
+            provider = provider_by_name(provider_name)
+        except KeyError:
+            return self.invalid_request()
+        client = self.siteverify_client_factory(provider, secret_key, site_key or None)
+        result = client.verify(remote_ip, response, expected_action=expected_action or None)
+        return ['ok', json.dumps(result)]
+    
+    def invalid_request(self):
+        return ['error', 'invalid-request', 'Invalid request', '0']
+    
+    def server_close(self):
+        ThreadingUnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def build_transport(options, verify_url):
+    pool = pool_for_url(verify_url, maxsize=options.pool_size, 
+                        timeout=options.connect_timeout)
+    transport = PooledTransport(pool, connect_timeout=options.connect_timeout,
+                                read_timeout=options.read_timeout)
+    bulkhead = None
+    if options.max_concurrent > 0:
+        bulkhead = bulkhead_for('sidecar', options.max_concurrent, max_wait=0)
+    return ResilientTransport(transport, bulkhead=bulkhead,
+                              total_timeout=options.total_timeout or None)
+
+def build_circuit_breaker(options, name):
+    if options.circuit_window <= 0:
+        return None
+    return circuit_breaker_for(name, 
+        error_rate=options.circuit_error_rate, window=options.circuit_window, 
+        min_calls=options.circuit_min_calls, 
+        reset_timeout=options.circuit_reset_timeout)
+
+def build_coalescer(options):
+    return coalescer_for('sidecar', ttl=options.verdict_cache_ttl, 
+                         wait_timeout=options.total_timeout or None)
+
+def build_client_factory(options):
+    def client_factory(private_key):
+        verify_url = reCAPTCHAClient(private_key).verify_server()
+        return reCAPTCHAClient(private_key, 
+                               transport=build_transport(options, verify_url), 
+                               circuit_breaker=build_circuit_breaker(options, 'sidecar'), 
+                               coalescer=build_coalescer(options))
+    return client_factory
+
+def build_siteverify_client_factory(options):
+    def siteverify_client_factory(provider, secret_key, site_key):
+        # every provider has its own circuit breaker (like in Trac)
+        breaker = build_circuit_breaker(options, 'sidecar-' + provider.name)
+        return SiteverifyClient(provider, secret_key, site_key=site_key,
+                                transport=build_transport(options, provider.verify_url),
+                                circuit_breaker=breaker, 
+                                coalescer=build_coalescer(options))
+    return siteverify_client_factory
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog --socket PATH [options]')
+    parser.add_option('--socket', help='path of the Unix socket')
+    parser.add_option('--mode', default='660', help='permissions of the socket (octal)')
+    parser.add_option('--pool-size', dest='pool_size', type='int', default=8)
+    parser.add_option('--connect-timeout', dest='connect_timeout', type='float', default=3)
+    parser.add_option('--read-timeout', dest='read_timeout', type='float', default=5)
+    parser.add_option('--total-timeout', dest='total_timeout', type='float', default=8)
+    parser.add_option('--max-concurrent', dest='max_concurrent', type='int', default=32)
+    parser.add_option('--circuit-error-rate', dest='circuit_error_rate', type='float', default=0.5)
+    parser.add_option('--circuit-window', dest='circuit_window', type='int', default=20)
+    parser.add_option('--circuit-min-calls', dest='circuit_min_calls', type='int', default=5)
+    parser.add_option('--circuit-reset-timeout', dest='circuit_reset_timeout', type='int', default=30)
+    parser.add_option('--verdict-cache-ttl', dest='verdict_cache_ttl', type='int', default=5)
+    options, arguments = parser.parse_args(argv)
+    if not options.socket:
+        parser.error('--socket is required')
+    
+    server = SidecarServer(options.socket, build_client_factory(options), 
+                           mode=int(options.mode, 8),
+                           siteverify_client_factory=build_siteverify_client_factory(options))
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
@@ -0,0 +1,181 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Client for the JSON "siteverify" API which is used by reCAPTCHA v2/v3, 
+hCaptcha and Cloudflare Turnstile. The differences between these services 
+are described by provider adapters so all of them share the same transport, 
+circuit breaker and coalescing as the (v1) reCAPTCHAClient.
+
+Like client.py this module does not depend on Trac."""
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+from trac_recaptcha.client import _, is_empty, reCAPTCHAClient
+
+__all__ = ['hCaptchaProvider', 'provider_by_name', 'provider_names', 
+           'reCAPTCHAv2Provider', 
+           'reCAPTCHAv3Provider', 'SiteverifyClient', 'TurnstileProvider']
+
+
+class SiteverifyProvider(object):
+    # short identifier, also used to name the circuit breaker
+    name = None
+    verify_url = None
+    # name of the form field which contains the widget's response token
+    response_field = None
+    script_url = None
+    # CSS class of the element which is rendered as widget
+    widget_class = None
+    # name of the script URL parameter which sets the widget language
+    language_parameter = 'hl'
+    
+    def parameters(self, secret, remote_ip, response, site_key=None):
+        parameters = dict(secret=secret, response=response)
+        if remote_ip:
+            parameters['remoteip'] = remote_ip
+        return parameters
+    
+    def rejection_reason(self, result, expected_action=None):
+        """Return an error code if the verification 'result' (parsed JSON) 
+        means the solution is not acceptable, None otherwise."""
+        if result.get('success') is not True:
+            error_codes = result.get('error-codes') or ['incorrect-captcha-sol']
+            return error_codes[0]
+        return None
+
+
+class reCAPTCHAv2Provider(SiteverifyProvider):
+    name = 'recaptcha-v2'
+    verify_url = 'https://www.google.com/recaptcha/api/siteverify'
+    response_field = 'g-recaptcha-response'
+    script_url = 'https://www.google.com/recaptcha/api.js'
+    widget_class = 'g-recaptcha'
+
+
+class reCAPTCHAv3Provider(reCAPTCHAv2Provider):
+    """reCAPTCHA v3 is invisible: the widget script computes a token when the
+    form is submitted and the verify server returns a score (0.0 - 1.0)."""
+    name = 'recaptcha-v3'
+    
+    def rejection_reason(self, result, expected_action=None):
+        error_code = reCAPTCHAv2Provider.rejection_reason(self, result)
+        if error_code is not None:
+            return error_code
+        if (expected_action is not None) and (result.get('action') != expected_action):
+            return 'action-mismatch'
+        return None
+
+
+class hCaptchaProvider(SiteverifyProvider):
+    name = 'hcaptcha'
+    verify_url = 'https://api.hcaptcha.com/siteverify'
+    response_field = 'h-captcha-response'
+    script_url = 'https://js.hcaptcha.com/1/api.js'
+    widget_class = 'h-captcha'
+    
+    def parameters(self, secret, remote_ip, response, site_key=None):
+        parameters = SiteverifyProvider.parameters(self, secret, remote_ip, response)
+        if site_key:
+            # hCaptcha checks that the token was issued for this site key
+            parameters['sitekey'] = site_key
+        return parameters
+
+
+class TurnstileProvider(SiteverifyProvider):
+    name = 'turnstile'
+    verify_url = 'https://challenges.cloudflare.com/turnstile/v0/siteverify'
+    response_field = 'cf-turnstile-response'
+    script_url = 'https://challenges.cloudflare.com/turnstile/v0/api.js'
+    widget_class = 'cf-turnstile'
+    # Turnstile uses a data attribute instead of an URL parameter
+    language_parameter = None
+
+
+_providers = dict([(provider.name, provider) for provider in 
+    (reCAPTCHAv2Provider(), reCAPTCHAv3Provider(), hCaptchaProvider(), TurnstileProvider())])
+
+def provider_by_name(name):
+    return _providers[name]
+
+def provider_names():
+    return sorted(_providers.keys())
+
+
+class SiteverifyClient(reCAPTCHAClient):
+    """Verifies widget responses with the siteverify API of 'provider'. 
+    Transport, circuit breaker and coalescer work like for reCAPTCHAClient.
+    'private_key' is the provider's secret key."""
+    
+    def __init__(self, provider, private_key, site_key=None, **kwargs):
+        reCAPTCHAClient.__init__(self, private_key, **kwargs)
+        self.provider = provider
+        self.site_key = site_key
+    
+    def verify_server(self):
+        return self.provider.verify_url
+    
+    def raise_missing_private_key_error(self):
+        msg = _(u'Can not verify captcha because the secret key is missing. '
+                u'Please add your secret key to your trac.ini ([%(section)s] '
+                u'secret_key).') % dict(section=self.provider.name)
+        self.raise_error('missing-input-secret', msg=msg)
+    
+    def parse_result(self, response_content):
+        if json is None:
+            # Python < 2.6 needs simplejson to parse the response
+            msg = _(u'Can not verify captcha because simplejson is not installed.')
+            self.raise_error('json-not-available', msg=msg)
+        try:
+            result = json.loads(response_content)
+        except ValueError:
+            result = None
+        if not isinstance(result, dict):
+            self.raise_server_unreachable_error()
+        return result
+    
+    def verify(self, remote_ip, response, expected_action=None):
+        """Return the verification result (parsed JSON) if the solution was 
+        accepted, raise CaptchaFailedError otherwise."""
+        if is_empty(response):
+            self.raise_incorrect_solution_error('missing-input-response')
+        if is_empty(self.private_key):
+            self.raise_missing_private_key_error()
+        parameters = self.provider.parameters(self.private_key, remote_ip, 
+                                              response, site_key=self.site_key)
+        def verify_remotely():
+            response_content = self.ask_verify_server(self.verify_server(), parameters)
+            result = self.parse_result(response_content)
+            error_code = self.provider.rejection_reason(result, expected_action)
+            if error_code is not None:
+                self.raise_incorrect_solution_error(error_code)
+            return result
+        key = (self.provider.name, self.private_key, remote_ip, response, expected_action)
+        return self.verify_coalesced(key, verify_remotely)
+
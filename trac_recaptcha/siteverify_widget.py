@@ -0,0 +1,130 @@
+# -*- coding: UTF-8 -*-
+# 
+# The MIT License
+# 
+# Copyright (c) 2013 Felix Schwarz <felix.schwarz@oss.schwarz.eu>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from urllib import urlencode
+
+from genshi.builder import tag
+from genshi.core import Markup
+
+__all__ = ['SiteverifyWidget']
+
+
+# reCAPTCHA v3 computes the token when the form is submitted. The clicked 
+# submit button (e.g. "preview") is preserved as form.submit() would drop it.
+invisible_widget_js = '''(function() {
+    var field = document.getElementById(%(field_id)s);
+    var form = field.form;
+    // event.submitter is not available in older browsers (e.g. Safari < 15.4)
+    var lastButton = null;
+    function submitButton(element) {
+        while (element && (element !== form)) {
+            var type = (element.type || '').toLowerCase();
+            if ((element.form === form) && ((type === 'submit') || (type === 'image'))) {
+                return element;
+            }
+            element = element.parentNode;
+        }
+        return null;
+    }
+    form.addEventListener('click', function(event) {
+        var button = submitButton(event.target);
+        if (button) {
+            lastButton = button;
+        }
+    }, true);
+    form.addEventListener('submit', function(event) {
+        if (field.value || !window.grecaptcha) {
+            // without token the server asks for a visible captcha
+            return;
+        }
+        event.preventDefault();
+        var button = event.submitter || lastButton;
+        grecaptcha.ready(function() {
+            grecaptcha.execute(%(site_key)s, {action: %(action)s}).then(function(token) {
+                field.value = token;
+                if (button && button.name) {
+                    var input = document.createElement('input');
+                    input.type = 'hidden';
+                    input.name = button.name;
+                    input.value = button.value;
+                    form.appendChild(input);
+                }
+                form.submit();
+            });
+        });
+    });
+})();'''
+
+
+def js_string(value):
+    value = value.replace('\\', '\\\\').replace("'", "\\'").replace('<', '\\x3c')
+    return "'%s'" % value
+
+
+class SiteverifyWidget(object):
+    """Generates the widget markup for a SiteverifyProvider."""
+    
+    def __init__(self, provider, site_key, theme=None, language=None):
+        self.provider = provider
+        self.site_key = site_key
+        self.theme = theme
+        self.language = language
+    
+    def script_url(self, parameters=None):
+        parameters = dict(parameters or ())
+        if self.language and self.provider.language_parameter:
+            parameters[self.provider.language_parameter] = self.language
+        if not parameters:
+            return self.provider.script_url
+        return self.provider.script_url + '?' + urlencode(sorted(parameters.items()))
+    
+    def script_tag(self, parameters=None):
+        return tag.script(src=self.script_url(parameters), type='text/javascript', 
+                          async='async', defer='defer')
+    
+    def widget_tag(self):
+        attributes = {'class': self.provider.widget_class, 'data-sitekey': self.site_key}
+        if self.theme:
+            attributes['data-theme'] = self.theme
+        if self.language and (self.provider.language_parameter is None):
+            attributes['data-language'] = self.language
+        return tag.div(**attributes)
+    
+    def invisible_widget_tags(self, action):
+        field_id = 'captcha-' + self.provider.response_field
+        js = invisible_widget_js % dict(field_id=js_string(field_id), 
+            site_key=js_string(self.site_key), action=js_string(action))
+        return [
+            self.script_tag(dict(render=self.site_key)),
+            tag.input(type='hidden', name=self.provider.response_field, id=field_id),
+            tag.script(Markup(js), type='text/javascript'),
+        ]
+    
+    def xml(self, invisible_action=None):
+        """Return the widget. If 'invisible_action' is given, an invisible 
+        widget (reCAPTCHA v3) for this action is generated."""
+        if invisible_action is not None:
+            return tag.span(*self.invisible_widget_tags(invisible_action))
+        return tag.span(self.script_tag(), self.widget_tag())
+